@@ -0,0 +1,115 @@
+# Benchmark how the runtime of the blockwise T2 scales with the number of blocks, for the loop and the summed-area table engines.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python benchmark_blockwise_t2.py --n_hei 1024 --n_wid 1024 --ls_num_blocks 4,16,64,256,1024
+import numpy as np
+import tensorflow as tf
+import argparse
+import sys
+import time
+import types
+from unittest import mock
+
+from control_chart.hotelling import *
+
+
+def Even_Grid_Pts(n_pix, num_blocks):
+    """ The start points of num_blocks nearly equal blocks along one axis. """
+    return list(np.linspace(0, n_pix, num_blocks+1).astype(int)[:-1])
+
+
+def Min_Time(func, num_repeats):
+    ls_time = []
+    for _ in range(num_repeats):
+        start_time = time.perf_counter()
+        func()
+        ls_time.append(time.perf_counter()-start_time)
+    return np.min(ls_time)
+
+
+def main(_):
+    np.random.seed(FLAGS.rand_seed)
+    n_hei, n_wid, score_dim = FLAGS.n_hei, FLAGS.n_wid, FLAGS.score_dim
+    scores = np.random.normal(0, 1, (n_hei*n_wid, score_dim))
+    mu_train, Sinv_train = np.zeros(score_dim), np.eye(score_dim)
+    flags_no_plot = types.SimpleNamespace(training_res_folder='')
+
+    print("Grids of blocks:")
+    print("{:>10s} {:>10s} {:>10s} {:>10s} {:>12s}".format('num_blocks', 'loop(s)', 'sat(s)', 'speedup', 'max_abs_diff'))
+    sat_build_time = Min_Time(lambda: Score_Summed_Area_Table(scores, n_hei, n_wid), FLAGS.num_repeats)
+    sat = Score_Summed_Area_Table(scores, n_hei, n_wid)
+    for num_blocks in [int(num) for num in FLAGS.ls_num_blocks.split(',')]:
+        num_row_blocks = int(np.sqrt(num_blocks))
+        ls_row_grid_pts, ls_col_grid_pts = Even_Grid_Pts(n_hei, num_row_blocks), Even_Grid_Pts(n_wid, num_blocks//num_row_blocks)
+        run_engine = lambda engine, sat=None: SpatialBlockwiseT2(scores, n_hei, n_wid, ls_row_grid_pts, ls_col_grid_pts, 0, mu_train, Sinv_train,
+                                                                 '', flags_no_plot, engine=engine, sat=sat)
+        # Only the computation is timed, not the heat map or the printing of SpatialBlockwiseT2.
+        with mock.patch('control_chart.hotelling.print', create=True), mock.patch('control_chart.hotelling.PlotSaveSpatialHeatMap'):
+            loop_time = Min_Time(lambda: run_engine('loop'), FLAGS.num_repeats)
+            sat_time = Min_Time(lambda: run_engine('sat', sat), FLAGS.num_repeats)
+            max_abs_diff = np.max(np.abs(run_engine('loop')-run_engine('sat', sat)))
+        print("{:>10d} {:>10.4f} {:>10.4f} {:>10.1f} {:>12.2e}".format(
+            len(ls_row_grid_pts)*len(ls_col_grid_pts), loop_time, sat_time, loop_time/sat_time, max_abs_diff))
+    print("Building the summed-area table once takes {:.4f}s.\n".format(sat_build_time))
+
+    print("Sliding blocks (stride {}) of several sizes from one summed-area table:".format(FLAGS.stride))
+    print("{:>10s} {:>10s} {:>10s} {:>14s}".format('block_size', 'num_blocks', 'sat(s)', 'blocks/s'))
+    for block_size in [int(size) for size in FLAGS.ls_block_sizes.split(',')]:
+        sat_time = Min_Time(lambda: SpatialSlidingBlockT2(None, n_hei, n_wid, block_size, block_size, mu_train, Sinv_train, stride=FLAGS.stride, sat=sat),
+                            FLAGS.num_repeats)
+        num_blocks = ((n_hei-block_size)//FLAGS.stride+1)*((n_wid-block_size)//FLAGS.stride+1)
+        print("{:>10d} {:>10d} {:>10.4f} {:>14.0f}".format(block_size, num_blocks, sat_time, num_blocks/sat_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--n_hei",
+        type=int,
+        default=1024,
+        help="The number of pixels in height of the score map.")
+
+    parser.add_argument(
+        "--n_wid",
+        type=int,
+        default=1024,
+        help="The number of pixels in width of the score map.")
+
+    parser.add_argument(
+        "--score_dim",
+        type=int,
+        default=10,
+        help="The dimension of the scores.")
+
+    parser.add_argument(
+        "--ls_num_blocks",
+        type=str,
+        default="4,16,64,256,1024,4096",
+        help="The numbers of blocks in the grids, separated by comma.")
+
+    parser.add_argument(
+        "--ls_block_sizes",
+        type=str,
+        default="8,32,128",
+        help="The sizes of the sliding blocks, separated by comma.")
+
+    parser.add_argument(
+        "--stride",
+        type=int,
+        default=1,
+        help="The stride of the sliding blocks.")
+
+    parser.add_argument(
+        "--num_repeats",
+        type=int,
+        default=3,
+        help="The number of timed runs. The minimum time is reported.")
+
+    parser.add_argument(
+        "--rand_seed",
+        type=int,
+        default=0,
+        help="The random seed.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
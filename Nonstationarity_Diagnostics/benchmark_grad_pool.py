@@ -0,0 +1,104 @@
+# Benchmark repeated cal_metrics of the neural network with the per-call loky workers (grad_engine paral) and the
+# persistent gradient worker pool (grad_engine pool), e.g., for the folds of cross-validation or multiple images.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python benchmark_grad_pool.py --img_size 64 --num_calls 5 --grad_n_jobs 4
+import numpy as np
+import tensorflow as tf
+import logging
+import sys
+import os
+import time
+import shutil
+import tempfile
+import datetime as dt
+
+from control_chart.utils import *
+from control_chart.data_generation import *
+from regression.regressors import *
+from single_sim_call import build_parser
+from benchmark_pipeline import Generate_Bench_Img
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('benchmark_grad_pool')
+logging.getLogger('benchmark_grad_pool').setLevel(logging.INFO)
+
+
+def Repeated_Cal_Metrics(reg_model, ls_weights, X, y, grad_engine):
+    """ Call cal_metrics once for each set of weights (as for a new model each time) with grad_engine.
+
+        Returns:
+            The list of the times of the calls and the list of gradients.
+    """
+    reg_model.FLAGS.grad_engine = grad_engine
+    ls_time, ls_grads = [], []
+    for model_weights in ls_weights:
+        reg_model.model.set_weights(model_weights)
+        start_time = time.perf_counter()
+        ls_grads.append(reg_model.cal_metrics(X, y, data_info='bench')[2])
+        ls_time.append(time.perf_counter()-start_time)
+    reg_model.close_grad_pool()
+    return ls_time, ls_grads
+
+
+def main(_):
+    tf.random.set_seed(FLAGS.rand_seed)
+    np.random.seed(FLAGS.rand_seed)
+    work_dir = tempfile.mkdtemp(prefix='benchmark_grad_pool_')
+    FLAGS.res_root_dir, FLAGS.model_file_folder = work_dir, 'bench_model'
+    FLAGS.training_res_folder = os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder)
+    os.makedirs(FLAGS.training_res_folder)
+    FLAGS.max_steps, FLAGS.nnet = FLAGS.bench_max_steps, 1
+    # Both engines use the same number of processes.
+    FLAGS.grad_n_jobs = FLAGS.grad_n_jobs or GRAD_POOL_NUM_WORKERS
+    if not FLAGS.reg_model:
+        FLAGS.reg_model = 'lin'
+
+    img_arr = Generate_Bench_Img(FLAGS.img_size, FLAGS.rand_seed)
+    X, y, _, _ = Generate_Materials_Data(img_arr, FLAGS)
+    model_time_stamp = dt.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')
+    reg_model = Nnet_Reg(X, y, X, y, [10], 'l2', FLAGS.penal_param, FLAGS.stopping_lag, FLAGS.training_batch_size,
+                         FLAGS.learning_rate, True, model_time_stamp, FLAGS, normal_flag=False, cv_tasks_info=None, plot_trace_flag=False)
+    # Perturbed weights stand for the models of the folds (or the updates) that cal_metrics is called with.
+    base_weights = reg_model.model.get_weights()
+    ls_weights = [[w+0.01*idx*np.random.normal(0, 1, w.shape).astype(w.dtype) for w in base_weights] for idx in range(FLAGS.num_calls)]
+
+    dict_res = {}
+    for grad_engine in ['paral', 'pool']:
+        dict_res[grad_engine] = Repeated_Cal_Metrics(reg_model, ls_weights, X, y, grad_engine)
+    max_abs_diff = np.max([np.max(np.abs(grads_paral-grads_pool)) for grads_paral, grads_pool in zip(dict_res['paral'][1], dict_res['pool'][1])])
+    shutil.rmtree(work_dir)
+
+    print("{} calls of cal_metrics on {} samples with {} workers:".format(FLAGS.num_calls, X.shape[0], FLAGS.grad_n_jobs))
+    print("{:>8s} {:>12s} {:>12s} {:>12s}".format('engine', 'first(s)', 'later(s)', 'total(s)'))
+    for grad_engine, (ls_time, _) in dict_res.items():
+        later_time = np.mean(ls_time[1:]) if len(ls_time) > 1 else np.nan
+        print("{:>8s} {:>12.3f} {:>12.3f} {:>12.3f}".format(grad_engine, ls_time[0], later_time, np.sum(ls_time)))
+    print("Speedup of the total time: {:.1f}x. The max abs difference of gradients: {:.2e}.".format(
+        np.sum(dict_res['paral'][0])/np.sum(dict_res['pool'][0]), max_abs_diff))
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+
+    parser.add_argument(
+        "--img_size",
+        type=int,
+        default=64,
+        help="The size of the synthetic AR-2D image.")
+
+    parser.add_argument(
+        "--num_calls",
+        type=int,
+        default=5,
+        help="The number of calls of cal_metrics, each with different weights.")
+
+    parser.add_argument(
+        "--bench_max_steps",
+        type=int,
+        default=200,
+        help="The max_steps of fitting the neural network (the fit is not timed).")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,72 @@
+# Benchmark the k-means sweep of PlotSaveClusteringSpatialScore3D (the inertia curve and the fit with n_comp clusters)
+# for the full, warm-started and mini-batch engines, with the agreement (ARI) of the clusters with the full sweep.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python benchmark_kmeans_sweep.py --num_pts 250000 --km_max_n_clusters 10 --n_comp 4
+import numpy as np
+import tensorflow as tf
+import argparse
+import sys
+import time
+
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score
+from control_chart.hotelling import KMeans_Sweep
+
+
+def main(_):
+    # Clusters of different spreads in 3D, as the PCA embedding of the spatial EWMA of scores.
+    data, _ = make_blobs(n_samples=FLAGS.num_pts, n_features=3, centers=FLAGS.n_comp,
+                         cluster_std=np.linspace(0.5, 2.0, FLAGS.n_comp), random_state=FLAGS.rand_seed)
+
+    dict_res = {}
+    for engine in FLAGS.engines.split(','):
+        start_time = time.perf_counter()
+        km_inertia, km_cluster = KMeans_Sweep(data, FLAGS.km_max_n_clusters, FLAGS.n_comp, FLAGS.rand_seed, engine=engine)
+        dict_res[engine] = (time.perf_counter()-start_time, np.array(km_inertia), km_cluster.labels_)
+
+    run_time_full, inertia_full, labels_full = dict_res['full']
+    print("The k-means sweep of 1 to {} clusters and the fit of {} clusters on {} points:".format(FLAGS.km_max_n_clusters, FLAGS.n_comp, FLAGS.num_pts))
+    print("{:>10s} {:>10s} {:>10s} {:>8s} {:>18s}".format('engine', 'time(s)', 'speedup', 'ARI', 'max_inertia_diff'))
+    for engine, (run_time, km_inertia, labels) in dict_res.items():
+        print("{:>10s} {:>10.2f} {:>10.1f} {:>8.4f} {:>17.2%}".format(
+            engine, run_time, run_time_full/run_time, adjusted_rand_score(labels_full, labels), np.max(np.abs(km_inertia/inertia_full-1))))
+    print("The relative inertia difference for 1 to {} clusters:".format(FLAGS.km_max_n_clusters))
+    for engine, (_, km_inertia, _) in dict_res.items():
+        print("{:>10s} ".format(engine)+' '.join('{:>6.1%}'.format(diff) for diff in km_inertia/inertia_full-1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_pts",
+        type=int,
+        default=250000,
+        help="The number of points (pixels) to cluster.")
+
+    parser.add_argument(
+        "--km_max_n_clusters",
+        type=int,
+        default=10,
+        help="The maximum number of clusters of the sweep.")
+
+    parser.add_argument(
+        "--n_comp",
+        type=int,
+        default=4,
+        help="The number of clusters of the final fit (and of the synthetic data).")
+
+    parser.add_argument(
+        "--engines",
+        type=str,
+        default="full,warm,minibatch",
+        help="The engines of KMeans_Sweep to compare, separated by comma. The first one should be full.")
+
+    parser.add_argument(
+        "--rand_seed",
+        type=int,
+        default=0,
+        help="The random seed.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,276 @@
+# Benchmark the time and memory of each stage of the nonstationarity diagnostic pipeline on synthetic AR-2D images.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python benchmark_pipeline.py --img_sizes 64,128 --save_path bench_baseline.json
+#   python benchmark_pipeline.py --img_sizes 64,128 --save_path bench_new.json --baseline_path bench_baseline.json --regression_threshold 0.2
+# The other arguments of single_sim_call.py (e.g., --wind_hei, --activation) can also be given to change the settings.
+import numpy as np
+import tensorflow as tf
+import logging
+import argparse
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import tracemalloc
+import traceback
+import datetime as dt
+
+from control_chart.utils import *
+from control_chart.data_generation import *
+from regression.regressors import *
+from control_chart.hotelling import *
+from single_sim_call import build_parser
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('benchmark_pipeline')
+logging.getLogger('benchmark_pipeline').setLevel(logging.INFO)
+
+BENCH_AR_WIND = 2 # The AR-2D image is generated with a 3x3 window (8 lag terms).
+BENCH_AR_COEFF = 0.1 # All lag coefficients, which keeps the AR-2D process stationary.
+
+
+def Generate_Bench_Img(img_size, rand_seed):
+    """ A synthetic AR-2D image normalized in the same way as the real images in simulation_real_img_reg_retro. """
+    np.random.seed(rand_seed)
+    init_vals = np.random.normal(0, 1, (img_size+BENCH_AR_WIND, img_size+BENCH_AR_WIND))
+    coeffs = BENCH_AR_COEFF*np.ones((BENCH_AR_WIND+1)**2-1)
+    _, _, _, gen_img = Generate_AR_2D_Data(float, 1.0, BENCH_AR_WIND, BENCH_AR_WIND, init_vals, coeffs)
+    return (gen_img.astype(np.float32)-np.mean(gen_img))/np.std(gen_img)
+
+
+def Run_Stage(stage_func, num_repeats, profile_memory):
+    """ Run a stage num_repeats times for the (minimum) wall time, and once more under tracemalloc for the peak memory.
+
+        Returns:
+            The output of the stage and a dict of the measurements. If the stage raises, the output is None and the
+            error is recorded, so that the other stages can still be measured.
+    """
+    res = {'status': 'ok'}
+    output = None
+    try:
+        ls_time = []
+        for _ in range(num_repeats):
+            start_time = time.perf_counter()
+            output = stage_func()
+            ls_time.append(time.perf_counter()-start_time)
+        res['time_s'] = float(np.min(ls_time))
+        if profile_memory:
+            tracemalloc.start()
+            output = stage_func()
+            res['peak_mem_mb'] = tracemalloc.get_traced_memory()[1]/2**20
+            tracemalloc.stop()
+        # ru_maxrss is in KB on Linux. It also covers the memory not traced by tracemalloc (e.g., TensorFlow).
+        res['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+    except Exception as err:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        res = {'status': 'error', 'error': '{}: {}'.format(type(err).__name__, err)}
+        logger.info("The stage failed:\n%s", traceback.format_exc(), extra=d)
+        output = None
+    return output, res
+
+
+def Benchmark_Pipeline(img_size, FLAGS):
+    """ Measure the stages of the pipeline on one synthetic image for each regression model.
+
+        A failed stage is recorded with its error, and the stages that need its output are skipped.
+    """
+    ls_res = []
+
+    def record(stage, reg_model, res):
+        res.update({'img_size': img_size, 'reg_model': reg_model, 'stage': stage})
+        logger.info("Image size %d, %s, %s: %s", img_size, reg_model, stage,
+                    ', '.join('{}={}'.format(k, '{:.4f}'.format(v) if isinstance(v, float) else v) for k, v in res.items() if k not in ['img_size', 'reg_model', 'stage']), extra=d)
+        ls_res.append(res)
+
+    img_arr = Generate_Bench_Img(img_size, FLAGS.rand_seed)
+    data, res = Run_Stage(lambda: Generate_Materials_Data(img_arr, FLAGS), FLAGS.num_repeats, FLAGS.profile_memory)
+    record('Generate_Materials_Data', '-', res)
+    if res['status'] != 'ok':
+        # All the other stages need X and y, so they are skipped for this image size.
+        return ls_res
+    X, y, moni_stat_hei, moni_stat_wid = data
+    FLAGS.moni_stat_hei, FLAGS.moni_stat_wid = moni_stat_hei, moni_stat_wid
+
+    for reg_model_name in FLAGS.bench_reg_models.split(','):
+        model_time_stamp = dt.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')
+        if reg_model_name == 'nnet':
+            FLAGS.nnet = 1
+            fit_func = lambda: Nnet_Reg(X, y, X, y, [10], 'l2', FLAGS.penal_param, FLAGS.stopping_lag, FLAGS.training_batch_size,
+                                        FLAGS.learning_rate, True, model_time_stamp, FLAGS, normal_flag=False, cv_tasks_info=None, plot_trace_flag=False)
+        else:
+            FLAGS.nnet = 0
+            fit_func = lambda: Linear_Reg(np.vstack(X), np.hstack(y), 10**(-8), True, model_time_stamp, FLAGS)
+        reg_model, res = Run_Stage(fit_func, 1, 0) # Fitting is too slow to be repeated.
+        record('fit', reg_model_name, res)
+        if reg_model is None:
+            continue
+
+        metrics, res = Run_Stage(lambda: reg_model.cal_metrics(X, y, data_info='train'), FLAGS.num_repeats, FLAGS.profile_memory)
+        record('cal_metrics', reg_model_name, res)
+        if metrics is None:
+            continue
+        scores = -np.array(metrics[2])
+        FLAGS.mu_train = np.mean(scores, axis=0)
+
+        score_spatial_ewma_arr, res = Run_Stage(lambda: ScoresSpatialEWMA(scores, moni_stat_hei, moni_stat_wid, FLAGS.spatial_ewma_sigma, FLAGS.spatial_ewma_wind_len),
+                                                FLAGS.num_repeats, FLAGS.profile_memory)
+        record('ScoresSpatialEWMA', reg_model_name, res)
+
+        fig_name = 'bench_{}_{}.png'.format(reg_model_name, img_size)
+        _, res = Run_Stage(lambda: SpatialHotellingT2Retro(scores, moni_stat_hei, moni_stat_wid, FLAGS.spatial_ewma_sigma, FLAGS.spatial_ewma_wind_len, fig_name, FLAGS),
+                           1, FLAGS.profile_memory)
+        record('SpatialHotellingT2Retro', reg_model_name, res)
+        plt.close('all')
+
+        if score_spatial_ewma_arr is None:
+            continue
+        t2_n_hei, t2_n_wid = moni_stat_hei-2*FLAGS.spatial_ewma_wind_len, moni_stat_wid-2*FLAGS.spatial_ewma_wind_len
+        _, res = Run_Stage(lambda: PlotSaveClusteringSpatialScore3D(score_spatial_ewma_arr.reshape(-1, score_spatial_ewma_arr.shape[-1]), FLAGS.mu_train,
+                                                                    t2_n_hei, t2_n_wid, fig_name, FLAGS, n_comp=FLAGS.n_comp),
+                           1, FLAGS.profile_memory)
+        record('PlotSaveClusteringSpatialScore3D', reg_model_name, res)
+        plt.close('all')
+    return ls_res
+
+
+def Compare_With_Baseline(ls_res, ls_base_res, threshold, min_time_diff):
+    """ Compare the measurements with the baseline and list the regressions.
+
+        A stage regresses if its time grows by more than the threshold (relative) and by more than min_time_diff seconds
+        (so that the noise of fast stages is ignored), if its traced peak memory grows by more than the threshold, or if
+        it fails while it succeeded in the baseline.
+    """
+    dict_base = {(res['img_size'], res['reg_model'], res['stage']): res for res in ls_base_res}
+    ls_regressions = []
+    print("{:>8s} {:>6s} {:>34s} {:>10s} {:>10s} {:>7s} {:>11s} {:>11s} {:>7s}".format(
+        'img_size', 'model', 'stage', 'base(s)', 'new(s)', 'ratio', 'base(MB)', 'new(MB)', 'ratio'))
+    for res in ls_res:
+        key = (res['img_size'], res['reg_model'], res['stage'])
+        base = dict_base.get(key)
+        if base is None or base['status'] != 'ok':
+            continue
+        if res['status'] != 'ok':
+            ls_regressions.append((key, 'failed: {}'.format(res['error'])))
+            continue
+        time_ratio = res['time_s']/max(base['time_s'], 1e-12)
+        if time_ratio > 1+threshold and res['time_s']-base['time_s'] > min_time_diff:
+            ls_regressions.append((key, 'time {:.4f}s -> {:.4f}s'.format(base['time_s'], res['time_s'])))
+        mem_ratio = np.nan
+        if 'peak_mem_mb' in res and 'peak_mem_mb' in base:
+            mem_ratio = res['peak_mem_mb']/max(base['peak_mem_mb'], 1e-12)
+            if mem_ratio > 1+threshold:
+                ls_regressions.append((key, 'peak memory {:.1f}MB -> {:.1f}MB'.format(base['peak_mem_mb'], res['peak_mem_mb'])))
+        print("{:>8d} {:>6s} {:>34s} {:>10.4f} {:>10.4f} {:>7.2f} {:>11.1f} {:>11.1f} {:>7.2f}".format(
+            res['img_size'], res['reg_model'], res['stage'], base['time_s'], res['time_s'], time_ratio,
+            base.get('peak_mem_mb', np.nan), res.get('peak_mem_mb', np.nan), mem_ratio))
+    return ls_regressions
+
+
+def main(_):
+    tf.random.set_seed(FLAGS.rand_seed)
+    work_dir = FLAGS.bench_work_dir if FLAGS.bench_work_dir else tempfile.mkdtemp(prefix='benchmark_pipeline_')
+    FLAGS.res_root_dir, FLAGS.model_file_folder = work_dir, 'bench_model'
+    FLAGS.training_res_folder = os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder)
+    if not os.path.exists(FLAGS.training_res_folder):
+        os.makedirs(FLAGS.training_res_folder)
+    FLAGS.max_steps = FLAGS.bench_max_steps
+    if not FLAGS.reg_model:
+        FLAGS.reg_model = 'lin' # The loss of both the linear and nnet models for the AR-2D images.
+
+    ls_res = []
+    for img_size in [int(size) for size in FLAGS.img_sizes.split(',')]:
+        ls_res.extend(Benchmark_Pipeline(img_size, FLAGS))
+    bench = {'meta': {'time': dt.datetime.now().isoformat(), 'host': platform.node(), 'python': platform.python_version(),
+                      'numpy': np.__version__, 'tensorflow': tf.__version__, 'img_sizes': FLAGS.img_sizes,
+                      'reg_models': FLAGS.bench_reg_models, 'num_repeats': FLAGS.num_repeats, 'max_steps': FLAGS.max_steps},
+             'results': ls_res}
+    if FLAGS.save_path:
+        with open(FLAGS.save_path, 'w') as f:
+            json.dump(bench, f, indent=2)
+        logger.info("The benchmark results have been stored at %s.", FLAGS.save_path, extra=d)
+    if not FLAGS.bench_work_dir:
+        shutil.rmtree(work_dir)
+
+    if FLAGS.baseline_path:
+        with open(FLAGS.baseline_path, 'r') as f:
+            ls_base_res = json.load(f)['results']
+        ls_regressions = Compare_With_Baseline(ls_res, ls_base_res, FLAGS.regression_threshold, FLAGS.min_time_diff)
+        for key, msg in ls_regressions:
+            print("Regression at image size {}, {}, {}: {}".format(key[0], key[1], key[2], msg))
+        if len(ls_regressions) > 0:
+            sys.exit(1)
+        print("No regression beyond {:.0%} compared with {}.".format(FLAGS.regression_threshold, FLAGS.baseline_path))
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+
+    parser.add_argument(
+        "--img_sizes",
+        type=str,
+        default="64,128,256",
+        help="The sizes of the synthetic AR-2D images, separated by comma.")
+
+    parser.add_argument(
+        "--bench_reg_models",
+        type=str,
+        default="lin,nnet",
+        help="The regression models to benchmark (lin and/or nnet), separated by comma.")
+
+    parser.add_argument(
+        "--bench_max_steps",
+        type=int,
+        default=2000,
+        help="The number of training steps of the neural network in the benchmark.")
+
+    parser.add_argument(
+        "--num_repeats",
+        type=int,
+        default=3,
+        help="The number of timed runs of the fast stages. The minimum time is reported.")
+
+    parser.add_argument(
+        "--profile_memory",
+        type=int,
+        default=1,
+        help="Whether to run the stages once more with tracemalloc to measure the peak memory.")
+
+    parser.add_argument(
+        "--save_path",
+        type=str,
+        default="",
+        help="The json file to store the results.")
+
+    parser.add_argument(
+        "--baseline_path",
+        type=str,
+        default="",
+        help="The json file of the baseline results to compare with.")
+
+    parser.add_argument(
+        "--regression_threshold",
+        type=float,
+        default=0.2,
+        help="The relative increase of time or peak memory that counts as a regression.")
+
+    parser.add_argument(
+        "--min_time_diff",
+        type=float,
+        default=0.05,
+        help="The increase of time (seconds) below which a stage never counts as a regression.")
+
+    parser.add_argument(
+        "--bench_work_dir",
+        type=str,
+        default="",
+        help="The folder to store the figures and models. If empty, a temporary folder is used and removed.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
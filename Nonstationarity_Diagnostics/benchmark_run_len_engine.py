@@ -0,0 +1,106 @@
+# Benchmark the run length engines of the alarm-level bisection in Find_Ctrl_Lmt_Same_MRL0 on the same EWMA_Sim_Store:
+# the loop over replicates, and the batch engine with one or several candidate alarm levels per pass.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python benchmark_run_len_engine.py --raw_data_size 500 --path_len 5000 --num_cands 4
+import numpy as np
+import tensorflow as tf
+import argparse
+import logging
+import shutil
+import tempfile
+import sys
+import time
+
+from control_chart.utils import Find_Ctrl_Lmt_Same_MRL0
+from control_chart.run_len_store import Convert_EWMA_CSV_Folder
+from benchmark_run_len_store import Generate_EWMA_CSV_Folder
+
+
+def main(_):
+    # The per-iteration logs of the loop engine would dominate its time.
+    logging.getLogger('utils').setLevel(logging.WARNING)
+    raw_data_folder = tempfile.mkdtemp(prefix='benchmark_run_len_engine_')
+    change_factor_ls = [1.0, 1.5, 2.0]
+    FLAGS.score_gamma_ls, FLAGS.change_factor_ls = [0.0, 0.1, 0.2], change_factor_ls
+    Generate_EWMA_CSV_Folder(raw_data_folder, FLAGS.raw_data_size, FLAGS.path_len, 'comp', change_factor_ls, FLAGS.rand_seed)
+    store = Convert_EWMA_CSV_Folder(raw_data_folder, remove_csv=True)
+    base_no_cd_stats = comp_no_cd_stats = {"rlII": [FLAGS.target_run_len]*len(FLAGS.score_gamma_ls)}
+
+    dict_res = {}
+    for name, run_len_engine, num_cands in [('loop', 'loop', 1), ('batch', 'batch', 1), ('batch_{}'.format(FLAGS.num_cands), 'batch', FLAGS.num_cands)]:
+        FLAGS.run_len_engine, FLAGS.run_len_num_cands = run_len_engine, num_cands
+        start_time = time.perf_counter()
+        df_stat = Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, FLAGS.raw_data_size, 'base', 'comp', base_no_cd_stats, comp_no_cd_stats,
+                                          FLAGS, FLAGS.tol, FLAGS.iter_max, store=store)
+        dict_res[name] = (time.perf_counter()-start_time, df_stat.astype(float))
+    shutil.rmtree(raw_data_folder)
+
+    loop_time, df_loop = dict_res['loop']
+    print("Find_Ctrl_Lmt_Same_MRL0 with {} replicates of length {} (tolerance {}, at most {} passes per gamma):".format(
+        FLAGS.raw_data_size, FLAGS.path_len, FLAGS.tol, FLAGS.iter_max))
+    print("{:>10s} {:>10s} {:>10s} {:>22s} {:>18s}".format('engine', 'time(s)', 'speedup', 'same results as loop', 'max alarm diff'))
+    for name, (run_time, df_stat) in dict_res.items():
+        print("{:>10s} {:>10.2f} {:>10.1f} {:>22s} {:>18.2e}".format(
+            name, run_time, loop_time/run_time, str(df_stat.equals(df_loop)),
+            np.max(np.abs(df_stat['target_alarm_level'].values-df_loop['target_alarm_level'].values))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--raw_data_size",
+        type=int,
+        default=500,
+        help="The number of replicates.")
+
+    parser.add_argument(
+        "--path_len",
+        type=int,
+        default=5000,
+        help="The length of each EWMA path in Phase-I and Phase-II.")
+
+    parser.add_argument(
+        "--target_run_len",
+        type=float,
+        default=200,
+        help="The targeted median in-control run length.")
+
+    parser.add_argument(
+        "--alarm_level",
+        type=float,
+        default=99.0,
+        help="The starting alarm level (100-scale).")
+
+    parser.add_argument(
+        "--eff_wind_len_factor",
+        type=float,
+        default=2.0,
+        help="The factor of the extended window of Phase-I EWMA.")
+
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-4,
+        help="The tolerance of the bisection of the alarm level.")
+
+    parser.add_argument(
+        "--iter_max",
+        type=int,
+        default=20,
+        help="The maximum number of bisection passes.")
+
+    parser.add_argument(
+        "--num_cands",
+        type=int,
+        default=4,
+        help="The number of candidate alarm levels per pass of the batch engine.")
+
+    parser.add_argument(
+        "--rand_seed",
+        type=int,
+        default=0,
+        help="The random seed.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
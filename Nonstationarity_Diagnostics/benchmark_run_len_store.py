@@ -0,0 +1,119 @@
+# Benchmark the control-limit search of Find_Ctrl_Lmt_Same_MRL0 on the per-replicate EWMA .csv files and on the
+# binary EWMA_Sim_Store converted from them, and check that both give the same alarm levels and run lengths.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python benchmark_run_len_store.py --raw_data_size 200 --path_len 2000 --iter_max 10
+import numpy as np
+import tensorflow as tf
+import argparse
+import os
+import shutil
+import tempfile
+import sys
+import time
+
+from scipy.signal import lfilter
+from control_chart.utils import Find_Ctrl_Lmt_Same_MRL0
+from control_chart.run_len_store import Convert_EWMA_CSV_Folder, EWMA_Replicate_Fname
+
+
+def Generate_EWMA_CSV_Folder(raw_data_folder, raw_data_size, path_len, tag, change_factor_ls, rand_seed):
+    """ Save AR(1) paths as the per-replicate .csv files of tag (change factor index 0 for Phase-I and Phase-II,
+        and the other change factors for Phase-II with the mean shifted by change factor minus one).
+    """
+    rand_state = np.random.RandomState(rand_seed)
+    for row_idx in range(raw_data_size):
+        for ch_idx, ch_f in enumerate(change_factor_ls):
+            for ph in (['PI', 'PII'] if ch_idx == 0 else ['PII']):
+                path = lfilter([1.0], [1.0, -0.5], rand_state.normal(size=path_len))+(ch_f-1 if ph == 'PII' else 0)
+                np.savetxt(os.path.join(raw_data_folder, EWMA_Replicate_Fname(row_idx, tag, ph, ch_idx, 0, ch_f if ch_idx else "1")), path)
+
+
+def main(_):
+    raw_data_folder = tempfile.mkdtemp(prefix='benchmark_run_len_store_')
+    change_factor_ls = [1.0, 1.5, 2.0]
+    FLAGS.score_gamma_ls, FLAGS.change_factor_ls = [0.0, 0.1, 0.2], change_factor_ls
+    Generate_EWMA_CSV_Folder(raw_data_folder, FLAGS.raw_data_size, FLAGS.path_len, 'comp', change_factor_ls, FLAGS.rand_seed)
+    # The base statistics only set the targeted in-control run length of each gamma.
+    base_no_cd_stats = comp_no_cd_stats = {"rlII": [FLAGS.target_run_len]*len(FLAGS.score_gamma_ls)}
+
+    start_time = time.perf_counter()
+    df_csv = Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, FLAGS.raw_data_size, 'base', 'comp', base_no_cd_stats, comp_no_cd_stats,
+                                     FLAGS, FLAGS.tol, FLAGS.iter_max)
+    csv_time = time.perf_counter()-start_time
+
+    start_time = time.perf_counter()
+    store = Convert_EWMA_CSV_Folder(raw_data_folder)
+    convert_time = time.perf_counter()-start_time
+    start_time = time.perf_counter()
+    df_store = Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, FLAGS.raw_data_size, 'base', 'comp', base_no_cd_stats, comp_no_cd_stats,
+                                       FLAGS, FLAGS.tol, FLAGS.iter_max, store=store)
+    store_time = time.perf_counter()-start_time
+    shutil.rmtree(raw_data_folder)
+
+    print(df_store)
+    print("Find_Ctrl_Lmt_Same_MRL0 with {} replicates of length {} (at most {} bisection iterations per gamma):".format(
+        FLAGS.raw_data_size, FLAGS.path_len, FLAGS.iter_max))
+    print("  .csv files: {:.2f}s; store: {:.2f}s (+ {:.2f}s to convert once); speedup {:.1f}x.".format(
+        csv_time, store_time, convert_time, csv_time/store_time))
+    print("  The same results: {}.".format(df_csv.astype(float).equals(df_store.astype(float))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--raw_data_size",
+        type=int,
+        default=200,
+        help="The number of replicates.")
+
+    parser.add_argument(
+        "--path_len",
+        type=int,
+        default=2000,
+        help="The length of each EWMA path in Phase-I and Phase-II.")
+
+    parser.add_argument(
+        "--target_run_len",
+        type=float,
+        default=200,
+        help="The targeted median in-control run length.")
+
+    parser.add_argument(
+        "--alarm_level",
+        type=float,
+        default=99.0,
+        help="The starting alarm level (100-scale).")
+
+    parser.add_argument(
+        "--eff_wind_len_factor",
+        type=float,
+        default=0.0,
+        help="The factor of the extended window of Phase-I EWMA.")
+
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-3,
+        help="The tolerance of the bisection of the alarm level.")
+
+    parser.add_argument(
+        "--iter_max",
+        type=int,
+        default=10,
+        help="The maximum number of bisection iterations.")
+
+    parser.add_argument(
+        "--run_len_engine",
+        type=str,
+        default="loop",
+        help="The run length engine of Find_Ctrl_Lmt_Same_MRL0 (loop reads the replicates in each iteration).")
+
+    parser.add_argument(
+        "--rand_seed",
+        type=int,
+        default=0,
+        help="The random seed.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
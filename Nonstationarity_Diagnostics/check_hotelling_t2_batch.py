@@ -0,0 +1,137 @@
+# Regression check that the batched Hotelling T2 (HotellingT2Batch) matches the per-pixel HotellingT2 loop it replaced,
+# for the spatial EWMA T2 (only the pixels away from the EWMA window margin are valid) and the blockwise T2 (the pixels
+# before the first grid point are left at 0). Both a positive definite Sinv and a singular one (eigen-decomposition) are checked.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python check_hotelling_t2_batch.py --n_hei 60 --n_wid 45 --wind_len 5
+import numpy as np
+import tensorflow as tf
+import argparse
+import sys
+import types
+from unittest import mock
+
+from control_chart.hotelling import *
+
+
+def Loop_Spatial_EWMA_T2(score_spatial_ewma_arr, n_hei, n_wid, wind_len, mu_train, Sinv_train):
+    """ The per-pixel loop of SpatialHotellingEWMAT2 before HotellingT2Batch. """
+    t2_n_hei, t2_n_wid = n_hei-2*wind_len, n_wid-2*wind_len
+    t2_scores_spatial_ewma_arr = np.zeros((t2_n_hei, t2_n_wid))
+    for ri in range(t2_n_hei):
+        for ci in range(t2_n_wid):
+            t2_scores_spatial_ewma_arr[ri, ci] = HotellingT2(score_spatial_ewma_arr[ri, ci], mu_train, Sinv_train)
+    return t2_scores_spatial_ewma_arr
+
+
+def Loop_Blockwise_T2(scores, n_hei, n_wid, ls_row_grid_pts, ls_col_grid_pts, mu_train, Sinv_train):
+    """ The per-block loop of SpatialBlockwiseT2 before HotellingT2Batch. """
+    scores = scores.reshape((n_hei, n_wid, -1))
+    t2_scores_blockwise_ave_arr = np.zeros((n_hei, n_wid))
+    ls_row_block_sizes, ls_col_block_sizes = np.diff(ls_row_grid_pts+[n_hei]), np.diff(ls_col_grid_pts+[n_wid])
+    for rs, rl in zip(ls_row_grid_pts, ls_row_block_sizes):
+        for cs, cl in zip(ls_col_grid_pts, ls_col_block_sizes):
+            block_ave_score = scores[rs:rs+rl, cs:cs+cl, :].mean(axis=(0,1))
+            t2_scores_blockwise_ave_arr[rs:rs+rl, cs:cs+cl] = HotellingT2(block_ave_score, mu_train, Sinv_train)
+    return t2_scores_blockwise_ave_arr
+
+
+def Check_Close(name, arr_batch, arr_loop):
+    assert arr_batch.shape == arr_loop.shape, "{}: shape {} != {}.".format(name, arr_batch.shape, arr_loop.shape)
+    assert np.all(np.isfinite(arr_batch)), "{}: the batch T2 is not finite.".format(name)
+    # HotellingT2 returns float32, so the two agree up to the float32 precision.
+    np.testing.assert_allclose(arr_batch, arr_loop, rtol=FLAGS.rtol, atol=FLAGS.rtol, err_msg=name)
+    print("{:<40s} shape {} max_abs_diff {:.2e}".format(name, arr_batch.shape, np.max(np.abs(arr_batch-arr_loop))))
+
+
+def main(_):
+    np.random.seed(FLAGS.rand_seed)
+    n_hei, n_wid, score_dim, wind_len = FLAGS.n_hei, FLAGS.n_wid, FLAGS.score_dim, FLAGS.wind_len
+    scores = np.random.normal(0, 1, (n_hei*n_wid, score_dim))
+    mu_train = np.mean(scores, axis=0)
+    # A singular (rank score_dim-2) Sinv, for which Whiten_Factor falls back from the Cholesky to the eigen-decomposition.
+    low_rank_factor = np.random.normal(0, 1, (score_dim, score_dim-2))
+    flags_no_plot = types.SimpleNamespace(training_res_folder='')
+
+    for case, Sinv_train in [('PD Sinv', Inv_Cov(scores, 0)), ('singular Sinv', np.dot(low_rank_factor, low_rank_factor.T))]:
+        case_ewma_arr = ScoresSpatialEWMA(scores, n_hei, n_wid, FLAGS.sigma, wind_len)
+        assert case_ewma_arr.shape == (n_hei-2*wind_len, n_wid-2*wind_len, score_dim)
+        # Spatial EWMA T2: only the (n_hei-2*wind_len, n_wid-2*wind_len) pixels with a full EWMA window.
+        t2_loop = Loop_Spatial_EWMA_T2(case_ewma_arr, n_hei, n_wid, wind_len, mu_train, Sinv_train)
+        t2_batch = SpatialHotellingEWMAT2(scores, n_hei, n_wid, FLAGS.sigma, wind_len, 0, mu_train, Sinv_train, flags_no_plot)
+        Check_Close("EWMA T2 ({})".format(case), t2_batch, t2_loop)
+        # Chunks that do not divide the number of pixels.
+        Check_Close("EWMA T2 chunked ({})".format(case),
+                    HotellingT2Batch(case_ewma_arr, mu_train, Sinv_train, chunk_size=FLAGS.chunk_size).astype(np.float64), t2_loop)
+
+        # Blockwise T2: the grid starts at wind_len, so the pixels before it are not in any block and stay 0.
+        ls_row_grid_pts = list(range(wind_len, n_hei, FLAGS.block_size))
+        ls_col_grid_pts = list(range(wind_len, n_wid, FLAGS.block_size))
+        t2_loop = Loop_Blockwise_T2(scores, n_hei, n_wid, ls_row_grid_pts, ls_col_grid_pts, mu_train, Sinv_train)
+        assert not np.any(t2_loop[:wind_len]) and not np.any(t2_loop[:, :wind_len])
+        with mock.patch('control_chart.hotelling.print', create=True), mock.patch('control_chart.hotelling.PlotSaveSpatialHeatMap'):
+            for engine in ['loop', 'sat']:
+                t2_batch = SpatialBlockwiseT2(scores, n_hei, n_wid, ls_row_grid_pts, ls_col_grid_pts, 0, mu_train, Sinv_train,
+                                              '', flags_no_plot, engine=engine)
+                Check_Close("Blockwise T2 {} ({})".format(engine, case), t2_batch, t2_loop)
+    print("HotellingT2Batch matches the per-pixel HotellingT2 loop.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--n_hei",
+        type=int,
+        default=60,
+        help="The number of pixels in height of the score map.")
+
+    parser.add_argument(
+        "--n_wid",
+        type=int,
+        default=45,
+        help="The number of pixels in width of the score map.")
+
+    parser.add_argument(
+        "--score_dim",
+        type=int,
+        default=6,
+        help="The dimension of the scores.")
+
+    parser.add_argument(
+        "--sigma",
+        type=float,
+        default=2.0,
+        help="The length scale of the spatial EWMA weight.")
+
+    parser.add_argument(
+        "--wind_len",
+        type=int,
+        default=5,
+        help="The spatial EWMA window length is 2*wind_len+1, i.e., the margin of invalid pixels.")
+
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=7,
+        help="The size of the blocks of the blockwise T2.")
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=37,
+        help="The chunk size of HotellingT2Batch for the chunked check.")
+
+    parser.add_argument(
+        "--rtol",
+        type=float,
+        default=1e-5,
+        help="The tolerance of the comparison.")
+
+    parser.add_argument(
+        "--rand_seed",
+        type=int,
+        default=0,
+        help="The random seed.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -29,6 +29,21 @@ AX_BOT = 0.05
 AX_LEFT = 0.05
 AX_RIGHT = 0.95
 UTIL_TASK_NJOBS = 20
+HOTELLING_CHUNK_SIZE = 2**16 # The number of rows whitened at a time when calculating Hotelling T2 in batch.
+DESIGN_CHUNK_ROWS = 64 # The number of image rows of neighborhood windows copied at a time into the design matrix.
+GRAD_CHUNK_SIZE = 2**14 # The number of samples whose per-sample gradients are calculated at a time.
+GRAD_POOL_NUM_WORKERS = 4 # The default number of worker processes of the persistent gradient pool (each holds TensorFlow and the model).
+GRAD_POOL_JOIN_TIMEOUT = 10 # The seconds to wait for a gradient worker to exit before terminating it.
+ARTIFACT_CACHE_FOLDER = 'artifact_cache' # The folder (under res_root_dir) of the cache of fitted models and scores.
+ARTIFACT_CACHE_MAX_BYTES = 20*2**30 # The size limit of the artifact cache. Least recently used entries are evicted beyond it.
+KM_BATCH_SIZE = 4096 # The batch size of MiniBatchKMeans in the k-means sweep.
+KM_WARM_SAMPLE_SIZE = 10000 # The number of points sampled to seed the new center in the warm-started k-means sweep.
+TILED_CHUNK_ROWS = 1024 # The number of image rows read at a time for the image mean and std in the tiled mode.
+TILED_PLOT_MAX_PIX = 2048 # The tiled T2 map is subsampled to at most this number of pixels per side for its heat map.
+EWMA_STORE_FOLDER = 'ewma_store' # The folder (under the raw data folder) of the binary store of simulated EWMA paths.
+PCA_CHUNK_ROWS = 2**16 # The number of pixels (rows of scores) centered and projected at a time by the chunked PCA.
+GP_EIG_TOL = 1e-12 # The eigenvalues of the 1D RBF kernel matrices below this fraction of the largest one are dropped by the grid GP sampler.
+MICRO_STRUCT_BATCH_SIZE = 16 # The number of GP fields sampled at a time by the microstructure dataset builder.
 YLAB_XPOS = -0.07 # -0.10 for all data sets except credit risk data sets, -0.05. 
 XLAB_YPOS = -0.26
 YR_TICK_MARGIN = 0.22 # 0.15 for all data sets except credit risk data sets, 0.22. 
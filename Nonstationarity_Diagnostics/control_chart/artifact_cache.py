@@ -0,0 +1,202 @@
+# A local content-addressed cache for the artifacts of Step 1 (fitting the regressor and calculating scores).
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python -m control_chart.artifact_cache --cache_dir /path/to/cache list
+#   python -m control_chart.artifact_cache --cache_dir /path/to/cache purge [--key KEY] [--max_gb 1]
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import logging
+import argparse
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from constants import *
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('artifact_cache')
+logging.getLogger('artifact_cache').setLevel(logging.INFO)
+
+# Increase this when the way of calculating the cached artifacts changes, so that old entries are not reused.
+ARTIFACT_CACHE_VERSION = 1
+# The FLAGS fields which affect the fitted regressor and the scores.
+CACHE_KEY_FLAGS = [
+    'materials_model', 'wind_hei', 'wind_wid', 'nnet', 'reg_model', 'activation', 'output_acti',
+    'penal_param', 'learning_rate', 'stopping_lag', 'training_batch_size', 'max_steps', 'training_rounds',
+    'decay_steps', 'rand_seed', 'nugget', 'cv_flag', 'cv_N_rep', 'cv_K_fold', 'cv_param_ls',
+    'cv_task_param_ls', 'cv_rand_search']
+ARRAYS_FNAME = 'arrays.npz'
+FLAGS_FNAME = 'flags.pkl'
+META_FNAME = 'meta.json'
+
+
+def Artifact_Cache_Key(img_arr, FLAGS, extra=None, key_flags=CACHE_KEY_FLAGS):
+    """Hash the image array and the FLAGS fields that affect the Step 1 artifacts into a cache key.
+
+        Args:
+            img_arr: The image as read from disk (before normalization).
+            extra: A dict of other settings that affect the result but are not in FLAGS (e.g., hidden layer sizes).
+
+        Returns:
+            A hex string of sha256 digest.
+    """
+    img_arr = np.ascontiguousarray(img_arr)
+    hasher = hashlib.sha256()
+    hasher.update(str((ARTIFACT_CACHE_VERSION, img_arr.shape, img_arr.dtype.str)).encode())
+    hasher.update(img_arr.tobytes())
+    settings = {name: getattr(FLAGS, name, None) for name in key_flags}
+    if extra is not None:
+        settings.update(extra)
+    hasher.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return hasher.hexdigest()
+
+
+class Artifact_Cache(object):
+    """A folder of cache entries, one sub-folder per key, evicted in least-recently-used order.
+
+        Each entry has the arrays (uncompressed .npz), the FLAGS fields derived in Step 1 (pickled) and
+        the meta data (json) which records the size and the last access time of the entry.
+    """
+    def __init__(self, cache_dir, max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def read_meta(self, key):
+        with open(os.path.join(self.entry_path(key), META_FNAME), 'r') as f:
+            return json.load(f)
+
+    def write_meta(self, key, meta):
+        meta_path = os.path.join(self.entry_path(key), META_FNAME)
+        with open(meta_path+'.tmp', 'w') as f:
+            json.dump(meta, f, indent=2, default=str)
+        os.replace(meta_path+'.tmp', meta_path)
+
+    def keys(self):
+        """All complete entries. Partially written entries (without meta data) are ignored."""
+        return [key for key in os.listdir(self.cache_dir)
+                if os.path.isfile(os.path.join(self.entry_path(key), META_FNAME))]
+
+    def get(self, key):
+        """Return (arrays, flags_dict) of the entry and update its last access time, or None if missing."""
+        if key not in self.keys():
+            logger.info("Artifact cache miss: %s.", key, extra=d)
+            return None
+        entry_path = self.entry_path(key)
+        with np.load(os.path.join(entry_path, ARRAYS_FNAME)) as npz_file:
+            arrays = {name: npz_file[name] for name in npz_file.files}
+        with open(os.path.join(entry_path, FLAGS_FNAME), 'rb') as f:
+            flags_dict = pickle.load(f)
+        meta = self.read_meta(key)
+        meta['last_access'] = time.time()
+        meta['num_hits'] = meta.get('num_hits', 0) + 1
+        self.write_meta(key, meta)
+        logger.info("Artifact cache hit: %s (%.1f MB).", key, meta['size']/2**20, extra=d)
+        return arrays, flags_dict
+
+    def put(self, key, arrays, flags_dict, info=None):
+        """Store the arrays and the FLAGS fields under key, and then evict old entries beyond the size limit.
+
+            Args:
+                arrays: A dict of np.ndarray.
+                flags_dict: A dict of FLAGS fields derived in Step 1 that are needed in later steps.
+                info: A json-serializable dict to be shown in listing (e.g., the settings in the key).
+        """
+        # Write into a temporary folder first so that an interrupted run never leaves a broken entry.
+        tmp_path = self.entry_path(key)+'.tmp{}'.format(os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.savez(os.path.join(tmp_path, ARRAYS_FNAME), **arrays)
+        with open(os.path.join(tmp_path, FLAGS_FNAME), 'wb') as f:
+            pickle.dump(flags_dict, f)
+        size = np.sum([os.path.getsize(os.path.join(tmp_path, fname)) for fname in os.listdir(tmp_path)])
+        if os.path.exists(self.entry_path(key)):
+            shutil.rmtree(self.entry_path(key))
+        os.rename(tmp_path, self.entry_path(key))
+        now = time.time()
+        self.write_meta(key, {'size': int(size), 'created': now, 'last_access': now, 'num_hits': 0, 'info': info})
+        logger.info("Artifact cache store: %s (%.1f MB).", key, size/2**20, extra=d)
+        self.evict(keep=[key])
+
+    def list(self):
+        """Meta data of all entries, sorted from the most recently used."""
+        ls_meta = []
+        for key in self.keys():
+            meta = self.read_meta(key)
+            meta['key'] = key
+            ls_meta.append(meta)
+        return sorted(ls_meta, key=lambda meta: meta['last_access'], reverse=True)
+
+    def total_size(self):
+        return int(np.sum([meta['size'] for meta in self.list()]))
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key))
+        logger.info("Artifact cache remove: %s.", key, extra=d)
+
+    def evict(self, max_bytes=None, keep=()):
+        """Remove the least recently used entries until the total size is within max_bytes."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        ls_meta = self.list()
+        total_size = np.sum([meta['size'] for meta in ls_meta])
+        for meta in ls_meta[::-1]:
+            if total_size <= max_bytes:
+                break
+            if meta['key'] in keep:
+                continue
+            self.remove(meta['key'])
+            total_size -= meta['size']
+
+    def purge(self):
+        for key in self.keys():
+            self.remove(key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect and purge the Step 1 artifact cache.")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=os.path.join(RES_ROOT_DIR, ARTIFACT_CACHE_FOLDER),
+        help="The folder of the artifact cache.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help="List the entries from the most recently used.")
+    purge_parser = subparsers.add_parser('purge', help="Remove entries.")
+    purge_parser.add_argument(
+        "--key",
+        type=str,
+        default="",
+        help="Only remove the entry with this key.")
+    purge_parser.add_argument(
+        "--max_gb",
+        type=float,
+        default=None,
+        help="Only remove least recently used entries until the cache is within this size (GB).")
+    FLAGS = parser.parse_args()
+
+    cache = Artifact_Cache(FLAGS.cache_dir)
+    if FLAGS.command == 'purge':
+        if FLAGS.key:
+            cache.remove(FLAGS.key)
+        elif FLAGS.max_gb is not None:
+            cache.evict(max_bytes=FLAGS.max_gb*2**30)
+        else:
+            cache.purge()
+    else:
+        for meta in cache.list():
+            print("{}  {:10.1f} MB  hits {:4d}  last used {}  {}".format(
+                meta['key'], meta['size']/2**20, meta['num_hits'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['last_access'])),
+                json.dumps(meta['info'], sort_keys=True)))
+        print("Total: {:.1f} MB in {}.".format(cache.total_size()/2**20, FLAGS.cache_dir))
@@ -101,13 +101,29 @@ def Image_Arr_Float_To_Int(img_arr):
 #     img_arr = Image_Arr_Float_To_Int(init_vals[wind_hei-1:, wind_wid-1:])
 #     return X, y, img_arr
 
-def Cal_AR_2D_Mean_Std_Given_Intcp(gen_func, sigma, intcp, wind_hei, wind_wid, init_vals, coeffs):
+def Cal_AR_2D_Mean_Std_Given_Intcp(gen_func, sigma, intcp, wind_hei, wind_wid, init_vals, coeffs, engine='loop'):
     """ For 2D AR model, calculate mean and std for a given intercept and coeffs value. """
-    _, y, _, _ = Generate_AR_2D_Data(gen_func, sigma, wind_hei, wind_wid, init_vals, coeffs, intcp)
+    _, y, _, _ = Generate_AR_2D_Data(gen_func, sigma, wind_hei, wind_wid, init_vals, coeffs, intcp, engine=engine)
     return np.mean(y), np.std(y)
 
 
-def Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp=0, stdv=1.0, z_scale=1.0, latent_gen_func=None):
+def Grid_Wavefronts(row_start, row_end, col_start, col_end, slope=1):
+    """ Group the pixels (ri, ci) of rows [row_start, row_end) and columns [col_start, col_end) into
+        the wavefronts ri+slope*ci, for generating pixels whose windows lie in earlier wavefronts together.
+
+        Returns:
+            A list of (row indices, column indices) of the wavefronts in order.
+    """
+    arr_ri, arr_ci = np.meshgrid(np.arange(row_start, row_end), np.arange(col_start, col_end), indexing='ij')
+    arr_ri, arr_ci = arr_ri.reshape((-1,)), arr_ci.reshape((-1,))
+    arr_wave = arr_ri+slope*arr_ci
+    sort_idx = np.argsort(arr_wave, kind='stable')
+    arr_ri, arr_ci, arr_wave = arr_ri[sort_idx], arr_ci[sort_idx], arr_wave[sort_idx]
+    split_idx = np.flatnonzero(np.diff(arr_wave))+1
+    return list(zip(np.split(arr_ri, split_idx), np.split(arr_ci, split_idx)))
+
+
+def Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp=0, stdv=1.0, z_scale=1.0, latent_gen_func=None, engine='loop'):
     """ Generate autoregressive 2D array for regression or classification.
         Args:
             gen_func: The generating function for image. If it is identity function, it is
@@ -122,6 +138,8 @@ def Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals,
             intcp: The intercept of autoregressive model.
             stdv: The standard deviation that I probably need to standardize the y-value (observations).
             z_scale: The scale of latent variables, because latent variable can be any scale.
+            engine: 'loop' generates the pixels column by column below;
+                    'wavefront' uses Generate_AR_2D_Data_Wavefront.
         
         Returns:
             X: The neighbor lag terms for autoregressive model, filled row-by-row.
@@ -130,6 +148,11 @@ def Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals,
             z_arr: The latent variable used to generated y after applying gen_func.
             gen_img: The np.uint8 image array with shape (img_hei, img_wid).
     """
+    if engine == 'wavefront':
+        return Generate_AR_2D_Data_Wavefront(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp, stdv, z_scale, latent_gen_func)
+    elif engine != 'loop':
+        raise ValueError("Unknown AR 2D engine: {}.".format(engine))
+
     ext_img_hei, ext_img_wid = init_vals.shape
     img_hei, img_wid = ext_img_hei-gen_wind_hei, ext_img_wid-gen_wind_wid # Doesn't include the margin of generating te 2D materials sample.
     x_dim = coeffs.shape[0]
@@ -170,10 +193,138 @@ def Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals,
     return X, y, z_arr, gen_img
 
 
+def Generate_AR_2D_Data_Wavefront(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp=0, stdv=1.0, z_scale=1.0, latent_gen_func=None, vectorized=False):
+    """ Generate autoregressive 2D arrays as Generate_AR_2D_Data, one anti-diagonal of pixels at a time.
+
+        The window of a pixel lies in earlier anti-diagonals (see Grid_Wavefronts), so each anti-diagonal
+        of all replicates is generated with one matrix product. The white noise is drawn with the same
+        call and used in the same order as Generate_AR_2D_Data, so for one replicate z_arr is the same
+        for a given seed up to the rounding of the matrix product, and X, y and gen_img are the same
+        for a deterministic gen_func. A random gen_func (e.g. gen_func_cla) is applied once per pixel,
+        so X holds the same draws as y instead of redrawing the pixels of each window.
+
+        Args:
+            See Generate_AR_2D_Data, except
+            init_vals: The initial values of the extended image with shape (ext_img_hei, ext_img_wid), or 
+                       (num_reps, ext_img_hei, ext_img_wid) for several replicates generated together.
+            vectorized: Whether gen_func and latent_gen_func apply elementwise to arrays (e.g. np.exp).
+                        Otherwise they are wrapped by np.vectorize.
+
+        Returns:
+            X, y, z_arr, gen_img: See Generate_AR_2D_Data, with the replicates in the first axis
+                                  if init_vals is 3D.
+    """
+    single_rep = (init_vals.ndim == 2)
+    if single_rep:
+        init_vals = init_vals[np.newaxis]
+    num_reps, ext_img_hei, ext_img_wid = init_vals.shape
+    img_hei, img_wid = ext_img_hei-gen_wind_hei, ext_img_wid-gen_wind_wid
+    # Called before drawing the white noise as in Generate_AR_2D_Data, in case gen_func draws random numbers.
+    gen_dtype = type(gen_func(1))
+    white_noise = np.random.normal(0,sigma,num_reps*img_hei*img_wid)
+    # The white noise of the pixel (ri, ci) is in [:, ci, ri] (column-by-column as Generate_AR_2D_Data).
+    white_noise = white_noise.reshape((num_reps, img_wid, img_hei))
+    if not vectorized:
+        gen_func = np.vectorize(gen_func, otypes=[gen_dtype])
+        if latent_gen_func is not None:
+            latent_gen_func = np.vectorize(latent_gen_func, otypes=[np.float64])
+
+    # The offsets of the window with the response as the bottom-right corner, without the response.
+    arr_offsets = np.array(list(itertools.product(range(-gen_wind_hei, 1), range(-gen_wind_wid, 1)))[:-1])
+    arr_rep = np.arange(num_reps)[:, np.newaxis, np.newaxis]
+    for arr_ri, arr_ci in Grid_Wavefronts(gen_wind_hei, ext_img_hei, gen_wind_wid, ext_img_wid):
+        z_wind = init_vals[arr_rep, arr_ri[:, np.newaxis]+arr_offsets[:, 0], arr_ci[:, np.newaxis]+arr_offsets[:, 1]]
+        z_new = intcp + np.matmul(z_wind, coeffs) + white_noise[:, arr_ci-gen_wind_wid, arr_ri-gen_wind_hei]
+        if latent_gen_func is not None:
+            z_new = latent_gen_func(z_new)
+        init_vals[:, arr_ri, arr_ci] = z_new
+
+    # Every pixel is observed through gen_func once, including the margin read by the windows.
+    x_arr = np.asarray(gen_func(init_vals*z_scale)).astype(gen_dtype)
+    X = np.stack([Strided_Windows(x_arr[rep], gen_wind_hei+1, gen_wind_wid+1).reshape((img_hei*img_wid, -1))[:, :-1]
+                  for rep in range(num_reps)])
+    gen_img_arr = x_arr[:, gen_wind_hei:, gen_wind_wid:]
+    y = gen_img_arr.reshape((num_reps, -1))
+    z_arr = init_vals[:, gen_wind_hei:, gen_wind_wid:] # Latent variable for generating the data y.
+    gen_img = np.stack([Image_Arr_Float_To_Int(gen_img_arr[rep]) for rep in range(num_reps)])
+    if single_rep:
+        return X[0], y[0], z_arr[0], gen_img[0]
+    return X, y, z_arr, gen_img
+
+
+def Nois_Wei_Field(img_hei, img_wid, r_nois, c_nois, nois_profile_sigma, nois_scale):
+    """ The noise weight of each pixel in Generate_AR_2D_Nois_Data, i.e. the sum of the Gaussian bumps
+        nois_scale*exp(-((ri-r)**2+(ci-c)**2)/2/nois_profile_sigma**2) over the noise centers (r, c).
+
+        The bump is separable, so the field is the product of the row and column profiles of the centers,
+        (img_hei, nois_size) x (nois_size, img_wid). With more centers than img_hei+img_wid, the centers are
+        splatted into an image of counts, which is blurred by the (img_hei, img_hei) and (img_wid, img_wid)
+        Gaussian matrices instead. Both are exact (no truncation of the bumps).
+
+        Args:
+            r_nois, c_nois: The row and column indices of the noise centers with shape (nois_size,),
+                            or (num_reps, nois_size) for a batch of replicates.
+
+        Returns:
+            The noise weights with shape (img_hei, img_wid), or (num_reps, img_hei, img_wid).
+    """
+    r_nois, c_nois = np.asarray(r_nois), np.asarray(c_nois)
+    single_rep = (r_nois.ndim == 1)
+    r_nois, c_nois = np.atleast_2d(r_nois), np.atleast_2d(c_nois)
+    num_reps, nois_size = r_nois.shape
+    arr_ri, arr_ci = np.arange(img_hei), np.arange(img_wid)
+    if nois_size <= img_hei+img_wid:
+        row_prof = np.exp(-(arr_ri[:, np.newaxis]-r_nois[:, np.newaxis, :])**2/2/nois_profile_sigma**2)
+        col_prof = np.exp(-(arr_ci[:, np.newaxis]-c_nois[:, np.newaxis, :])**2/2/nois_profile_sigma**2)
+        nois_wei_arr = np.matmul(row_prof, col_prof.transpose([0,2,1]))
+    else:
+        cnt_arr = np.zeros((num_reps, img_hei, img_wid))
+        np.add.at(cnt_arr, (np.repeat(np.arange(num_reps), nois_size), r_nois.reshape((-1,)), c_nois.reshape((-1,))), 1)
+        row_blur = np.exp(-(arr_ri[:, np.newaxis]-arr_ri[np.newaxis, :])**2/2/nois_profile_sigma**2)
+        col_blur = np.exp(-(arr_ci[:, np.newaxis]-arr_ci[np.newaxis, :])**2/2/nois_profile_sigma**2)
+        nois_wei_arr = np.matmul(np.matmul(row_blur, cnt_arr), col_blur)
+    nois_wei_arr *= nois_scale
+    return nois_wei_arr[0] if single_rep else nois_wei_arr
+
+
+def Gen_Nois_Wei_Field_Batch(img_hei, img_wid, nois_profile_sigma, nois_size, nois_scale, rand_seeds):
+    """ The noise weights of Generate_AR_2D_Nois_Data for a batch of replicates, the noise centers of each
+        replicate being drawn with its own seed in rand_seeds as np.random.randint does in Generate_AR_2D_Nois_Data.
+
+        Returns:
+            The noise weights with shape (len(rand_seeds), img_hei, img_wid).
+    """
+    ls_r_nois, ls_c_nois = [], []
+    for rand_seed in rand_seeds:
+        rand_state = np.random.RandomState(rand_seed)
+        ls_r_nois.append(rand_state.randint(1, img_hei, size=nois_size))
+        ls_c_nois.append(rand_state.randint(1, img_wid, size=nois_size))
+    return Nois_Wei_Field(img_hei, img_wid, np.array(ls_r_nois), np.array(ls_c_nois), nois_profile_sigma, nois_scale)
+
+
 def Generate_AR_2D_Nois_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, init_vals_nois, coeffs, coeffs_nois, 
-                             nois_profile_sigma, nois_size, nois_scale, intcp=0, stdv=1.0, z_scale=1.0):
-    _, _, z_arr, _ = Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp, stdv, z_scale)
-    _, _, z_arr_nois, _ = Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals_nois, coeffs_nois, intcp, stdv, z_scale)
+                             nois_profile_sigma, nois_size, nois_scale, intcp=0, stdv=1.0, z_scale=1.0, engine='loop',
+                             nois_engine='loop', rand_seeds=None):
+    """ Blend two autoregressive 2D latent images with the weights of Gaussian bumps around random noise centers.
+
+        Args:
+            See Generate_AR_2D_Data, and
+            nois_engine: 'loop' sums the bumps pixel by pixel; 'separable' uses Nois_Wei_Field and maps the
+                         whole blended image by gen_func at once (in the same pixel order as 'loop').
+            rand_seeds: Only for 'separable'. The seeds of the noise centers of each replicate
+                        (see Gen_Nois_Wei_Field_Batch). By default they are drawn by np.random.randint.
+                        With init_vals of shape (num_reps, ext_img_hei, ext_img_wid) (engine 'wavefront'),
+                        a batch of replicates is generated.
+
+        Returns:
+            nois_wei_arr, nois_y, nois_z_arr, nois_gen_img: The noise weights, the responses, the latent variables and the np.uint8 image.
+    """
+    _, _, z_arr, _ = Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp, stdv, z_scale, engine=engine)
+    _, _, z_arr_nois, _ = Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals_nois, coeffs_nois, intcp, stdv, z_scale, engine=engine)
+    if nois_engine == 'separable':
+        return Blend_AR_2D_Nois_Data_Separable(gen_func, z_arr, z_arr_nois, nois_profile_sigma, nois_size, nois_scale, z_scale, rand_seeds)
+    elif nois_engine != 'loop':
+        raise ValueError("Unknown noise engine: {}.".format(nois_engine))
     img_hei, img_wid = z_arr.shape
     r_nois, c_nois = np.random.randint(1, img_hei, size=nois_size), np.random.randint(1, img_wid, size=nois_size)
     
@@ -194,6 +345,30 @@ def Generate_AR_2D_Nois_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_v
     return nois_wei_arr, nois_y, nois_z_arr, nois_gen_img
 
 
+def Blend_AR_2D_Nois_Data_Separable(gen_func, z_arr, z_arr_nois, nois_profile_sigma, nois_size, nois_scale, z_scale=1.0, rand_seeds=None):
+    """ The blending of Generate_AR_2D_Nois_Data for whole images (or a batch of them in the first axis). """
+    img_hei, img_wid = z_arr.shape[-2:]
+    if rand_seeds is not None:
+        nois_wei_arr = Gen_Nois_Wei_Field_Batch(img_hei, img_wid, nois_profile_sigma, nois_size, nois_scale, rand_seeds)
+        nois_wei_arr = nois_wei_arr.reshape(z_arr.shape)
+    else:
+        size = z_arr.shape[:-2]+(nois_size,)
+        r_nois, c_nois = np.random.randint(1, img_hei, size=size), np.random.randint(1, img_wid, size=size)
+        nois_wei_arr = Nois_Wei_Field(img_hei, img_wid, r_nois, c_nois, nois_profile_sigma, nois_scale)
+
+    nois_z_arr = (z_arr+nois_wei_arr*z_arr_nois)/(1+nois_wei_arr)
+    # gen_func is called as many times and in the same pixel order as the loop, in case it draws random numbers.
+    nois_gen_img_arr = np.vectorize(gen_func, otypes=[type(gen_func(1))])(nois_z_arr*z_scale)
+
+    if z_arr.ndim == 2:
+        nois_y = nois_gen_img_arr.reshape((-1,)).astype(type(gen_func(1)))
+        nois_gen_img = Image_Arr_Float_To_Int(nois_gen_img_arr)
+    else:
+        nois_y = nois_gen_img_arr.reshape((z_arr.shape[0], -1)).astype(type(gen_func(1)))
+        nois_gen_img = np.stack([Image_Arr_Float_To_Int(img_arr) for img_arr in nois_gen_img_arr])
+    return nois_wei_arr, nois_y, nois_z_arr, nois_gen_img
+
+
 def Generate_AR_2D_Data_Causal(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, coeffs, intcp=0):
     """ Generate autoregressive 2D array for classification.
 
@@ -264,7 +439,7 @@ def Generate_AR_2D_Data_Causal(gen_func, sigma, gen_wind_hei, gen_wind_wid, init
     return X, y, z_arr, gen_img
 
 
-def Generate_Blockwise_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, ls_coeffs, ls_row_grid_pts, ls_col_grid_pts, intcp=0, z_scale=1.0):
+def Generate_Blockwise_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, init_vals, ls_coeffs, ls_row_grid_pts, ls_col_grid_pts, intcp=0, z_scale=1.0, engine='loop'):
     """ Generate blockwise autoregressive 2D regression image.
 
         Args:
@@ -280,6 +455,7 @@ def Generate_Blockwise_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, i
             ls_row_grid_pts: A list of starting indices of pixels of rows for different blocks (not including the northern and western margin).
             ls_col_grid_pts: A list of starting indices of pixels of columns for different blocks (not including the northern and western margin).
             intcp: The intercept of autoregressive model.
+            engine: The engine of Generate_AR_2D_Data for each block.
         
         Returns:
             X: The neighbor lag terms for autoregressive model, filled row-by-row.
@@ -305,7 +481,7 @@ def Generate_Blockwise_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, i
         for ci, (cs, cl) in enumerate(zip(ls_col_grid_pts, ls_col_block_sizes)):
             logger.info("The start col idx and block col size is (%s, %s).\n", cs, cl, extra=d)
             block_init_vals = init_vals[rs:rs+rl+gen_wind_hei, cs:cs+cl+gen_wind_wid].copy()
-            X_temp, y_temp, z_arr_temp, _ = Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, block_init_vals, ls_coeffs[ri][ci], intcp=intcp, z_scale=z_scale)
+            X_temp, y_temp, z_arr_temp, _ = Generate_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, block_init_vals, ls_coeffs[ri][ci], intcp=intcp, z_scale=z_scale, engine=engine)
             init_vals[rs+gen_wind_hei:rs+rl+gen_wind_hei, cs+gen_wind_wid:cs+cl+gen_wind_wid] = z_arr_temp
             X_row_block = np.concatenate((X_row_block, X_temp.reshape((rl,cl,x_dim))), axis=1)
             y_row_block = np.concatenate((y_row_block, y_temp.reshape((rl,cl))), axis=1)
@@ -371,7 +547,7 @@ def Generate_Blockwise_AR_2D_Data(gen_func, sigma, gen_wind_hei, gen_wind_wid, i
 #     return X, y, img_arr
 
 
-def Regenerate_Materials_Data(img_arr, model, model_pred, FLAGS):
+def Regenerate_Materials_Data(img_arr, model, model_pred, FLAGS, model_pred_batch=None):
     """ Regenerate 2D spatial data for inspection.
 
         Args:
@@ -397,11 +573,22 @@ def Regenerate_Materials_Data(img_arr, model, model_pred, FLAGS):
                                 else:
                                     return model.predict(np.array(input_arr).reshape((1,-1)))[0]
 
-            FLAGS: Some information about the model.
+            FLAGS: Some information about the model. FLAGS.regen_engine ('serial' by default) selects
+                   the pixel-by-pixel regeneration below or Regenerate_Materials_Data_Wavefront.
+            model_pred_batch: Only for the 'wavefront' engine. The function to make predictions for a batch
+                              of windows (one per row). See Regenerate_Materials_Data_Wavefront.
 
         Return:
             img_arr: The generate image.
     """
+    regen_engine = getattr(FLAGS, 'regen_engine', 'serial')
+    if regen_engine == 'wavefront':
+        if model_pred_batch is None:
+            model_pred_batch = lambda input_arr, model, FLAGS: np.array([model_pred(list(x), model, FLAGS) for x in input_arr])
+        return Regenerate_Materials_Data_Wavefront(img_arr, model, model_pred_batch, FLAGS)
+    elif regen_engine != 'serial':
+        raise ValueError("Unknown regeneration engine: {}.".format(regen_engine))
+
     # img_hei, img_wid = FLAGS.wind_hei+FLAGS.regen_grid_size-1, FLAGS.wind_wid+FLAGS.regen_grid_size-1
     img_hei, img_wid = img_arr.shape
 
@@ -439,12 +626,188 @@ def Regenerate_Materials_Data(img_arr, model, model_pred, FLAGS):
         return img_arr, img_arr[FLAGS.wind_hei:(img_hei-FLAGS.wind_hei), FLAGS.wind_wid:(img_wid-FLAGS.wind_wid)].copy()
 
 
-def Generate_Materials_Data(img_arr, FLAGS):
+def Causal_Window_Offsets(FLAGS):
+    """ The (row, column) offsets from the response of the pixels in its causal window, in the order
+        of the inputs of model_pred in Regenerate_Materials_Data.
+    """
+    wind_hei, wind_wid = FLAGS.wind_hei, FLAGS.wind_wid
+    if FLAGS.materials_model == 'causal':
+        # The rectangle with the response as the bottom-right corner, without the response.
+        ls_offsets = list(itertools.product(range(-wind_hei, 1), range(-wind_wid, 1)))[:-1]
+    elif FLAGS.materials_model == 'causal_1':
+        # The (2*wind_hei+1) x wind_wid rectangle to the left, followed by the wind_hei pixels above.
+        ls_offsets = list(itertools.product(range(-wind_hei, wind_hei+1), range(-wind_wid, 0))) + \
+                     [(ri, 0) for ri in range(-wind_hei, 0)]
+    else:
+        raise ValueError("Unknown materials model: {}.".format(FLAGS.materials_model))
+    arr_offsets = np.array(ls_offsets)
+    return arr_offsets[:, 0], arr_offsets[:, 1]
+
+
+def Causal_Wavefronts(img_hei, img_wid, FLAGS):
+    """ Group the pixels regenerated by Regenerate_Materials_Data into wavefronts.
+
+        The pixel (ri, ci) is in the wavefront ri+slope*ci, where slope is 1 for 'causal' (anti-diagonals)
+        and wind_hei+1 for 'causal_1' (whose window reaches wind_hei rows below in the previous columns).
+        Every pixel of the window of a pixel is either never regenerated or in an earlier wavefront,
+        so all pixels of a wavefront can be predicted together from the same inputs as the serial order.
+
+        Returns:
+            A list of (row indices, column indices) of the wavefronts in order.
+    """
+    slope = 1 if FLAGS.materials_model == 'causal' else FLAGS.wind_hei+1
+    return Grid_Wavefronts(FLAGS.wind_hei, img_hei-FLAGS.wind_hei, FLAGS.wind_wid, img_wid-FLAGS.wind_wid, slope)
+
+
+def Regenerate_Materials_Data_Wavefront(img_arr, model, model_pred_batch, FLAGS):
+    """ Regenerate 2D spatial data as Regenerate_Materials_Data, one wavefront of pixels at a time.
+
+        The pixels are grouped by Causal_Wavefronts, and the model is called once per wavefront
+        for all chains. The inputs of each pixel are the same as in the serial order, so a deterministic
+        model gives the same image, and a random one (classification) gives an image of the same
+        distribution, with the random numbers drawn in a different order.
+
+        Args:
+            img_arr: Initial values for regeneration with shape (img_hei, img_wid), or
+                     (num_chains, img_hei, img_wid) for several independent chains regenerated together.
+            model: The trained model used to regenerate the image.
+            model_pred_batch: The function to make predictions for the windows in the rows of input_arr.
+                              For classification model use:
+
+                                def model_pred_batch(input_arr, model, FLAGS):
+                                    if FLAGS.nnet:
+                                        logits = np.array(model(input_arr))
+                                    else:
+                                        logits = model.predict_proba(input_arr)
+                                    return 1*(np.random.random(input_arr.shape[0]) < 1/(1+np.exp(logits[:, 0]-logits[:, 1])))
+
+                              For regression model use:
+
+                                def model_pred_batch(input_arr, model, FLAGS):
+                                    if FLAGS.nnet:
+                                        return np.array(model(input_arr))[:, 0]
+                                    else:
+                                        return model.predict(input_arr)
+
+            FLAGS: Some information about the model.
+
+        Return:
+            img_arr: The generate image (or images with the chains in the first axis).
+            The cropped regenerated part of img_arr.
+    """
+    single_chain = (img_arr.ndim == 2)
+    if single_chain:
+        img_arr = img_arr[np.newaxis]
+    num_chains, img_hei, img_wid = img_arr.shape
+    arr_ri_off, arr_ci_off = Causal_Window_Offsets(FLAGS)
+    arr_chain = np.arange(num_chains)[:, np.newaxis, np.newaxis]
+
+    ls_wavefronts = Causal_Wavefronts(img_hei, img_wid, FLAGS)
+    logger.info("Regenerate {} chains of size ({}, {}) in {} wavefronts.".format(num_chains, img_hei, img_wid, len(ls_wavefronts)), extra=d)
+    for arr_ri, arr_ci in ls_wavefronts:
+        # The windows of shape (num_chains, number of pixels in the wavefront, x_dim).
+        input_arr = img_arr[arr_chain, arr_ri[:, np.newaxis]+arr_ri_off, arr_ci[:, np.newaxis]+arr_ci_off]
+        arr_pred = model_pred_batch(input_arr.reshape((num_chains*arr_ri.shape[0], -1)), model, FLAGS)
+        img_arr[:, arr_ri, arr_ci] = np.reshape(arr_pred, (num_chains, arr_ri.shape[0]))
+
+    FLAGS.cur_vf = np.sum(img_arr, axis=(1,2))/(img_hei*img_wid)
+    if single_chain:
+        FLAGS.cur_vf = FLAGS.cur_vf[0]
+    print("The portion of positive labels in the regenerated image is {}.\n".format(FLAGS.cur_vf, ))
+    arr_min, arr_max = np.min(img_arr, axis=(1,2), keepdims=True), np.max(img_arr, axis=(1,2), keepdims=True)
+    img_arr = (img_arr-arr_min)/(arr_max-arr_min)*255
+    if single_chain:
+        img_arr = img_arr[0]
+    return img_arr, img_arr[..., FLAGS.wind_hei:(img_hei-FLAGS.wind_hei), FLAGS.wind_wid:(img_wid-FLAGS.wind_wid)].copy()
+
+
+def Strided_Windows(arr, wind_hei, wind_wid):
+    """ A read-only view of all (wind_hei, wind_wid) windows of a 2D array without copying.
+
+        The element [ri, ci, :, :] of the returned view is arr[ri:ri+wind_hei, ci:ci+wind_wid].
+    """
+    arr_hei, arr_wid = arr.shape
+    return np.lib.stride_tricks.as_strided(
+        arr, shape=(arr_hei-wind_hei+1, arr_wid-wind_wid+1, wind_hei, wind_wid),
+        strides=arr.strides+arr.strides, writeable=False)
+
+
+def Generate_Materials_Data_Strided(img_arr, FLAGS, memmap_folder=None, chunk_rows=DESIGN_CHUNK_ROWS, dtype=np.float64):
+    """ Generate the same X and y as Generate_Materials_Data from windowed views of the image.
+
+        The neighborhood windows are never collected in lists; they are copied from strided views
+        of the image straight into X and y, chunk_rows image rows at a time.
+
+        Args:
+            img_arr: The image array.
+            FLAGS: All flags.
+            memmap_folder: If given, X and y are np.memmap arrays stored as 'design_X.npy' and 
+                           'design_y.npy' in this folder instead of arrays in memory.
+            chunk_rows: The number of image rows of windows copied at a time.
+            dtype: The data type of X and y.
+
+        Returns:
+            X, y, n_hei, n_wid: See Generate_Materials_Data.
+    """
+    img_arr = np.ascontiguousarray(img_arr)
+    img_hei, img_wid = img_arr.shape
+    wind_hei, wind_wid = FLAGS.wind_hei, FLAGS.wind_wid
+    n_hei, n_wid = img_hei-2*wind_hei, img_wid-2*wind_wid
+    n_sample = n_hei*n_wid
+
+    # Each entry is (windowed view, column offset of the window in the view), concatenated in order.
+    # The window of the pixel (ri, ci) (counted from the top-left pixel having a response) is 
+    # the element [ri, ci] of each view.
+    if FLAGS.materials_model == 'causal':
+        # The window is the rectangle with the response as the bottom-right corner.
+        ls_views = [(Strided_Windows(img_arr, wind_hei+1, wind_wid+1), 0)]
+        y_col = (wind_hei+1)*(wind_wid+1)-1
+    elif FLAGS.materials_model == 'causal_1':
+        # The (2*wind_hei+1) x wind_wid rectangle to the left of the response, followed by
+        # the wind_hei pixels above the response and the response itself.
+        ls_views = [(Strided_Windows(img_arr, 2*wind_hei+1, wind_wid), 0),
+                    (Strided_Windows(img_arr, wind_hei+1, 1), wind_wid)]
+        y_col = (2*wind_hei+1)*wind_wid+wind_hei
+    elif FLAGS.materials_model == 'non_causal':
+        logger.info("The shape of the data for building a model is ({}, {}).".format(n_sample, (2*wind_hei+1)*(2*wind_wid+1)), extra=d)
+        ls_views = [(Strided_Windows(img_arr, 2*wind_hei+1, 2*wind_wid+1), 0)]
+        y_col = (2*wind_hei+1)*(2*wind_wid+1)//2
+    else:
+        raise ValueError("Unknown materials model: {}.".format(FLAGS.materials_model))
+    xy_dim = sum([view.shape[2]*view.shape[3] for view, _ in ls_views])
+
+    if memmap_folder is not None:
+        if not os.path.exists(memmap_folder):
+            os.makedirs(memmap_folder)
+        X = np.lib.format.open_memmap(os.path.join(memmap_folder, 'design_X.npy'), mode='w+', dtype=dtype, shape=(n_sample, xy_dim-1))
+        y = np.lib.format.open_memmap(os.path.join(memmap_folder, 'design_y.npy'), mode='w+', dtype=dtype, shape=(n_sample,))
+    else:
+        X, y = np.zeros((n_sample, xy_dim-1), dtype=dtype), np.zeros((n_sample,), dtype=dtype)
+
+    for rs in range(0, n_hei, chunk_rows):
+        rl = min(chunk_rows, n_hei-rs)
+        Xy_chunk = np.concatenate(
+            [view[rs:rs+rl, c_off:c_off+n_wid].reshape((rl*n_wid, -1)) for view, c_off in ls_views], axis=1)
+        X[rs*n_wid:(rs+rl)*n_wid, :y_col] = Xy_chunk[:, :y_col]
+        X[rs*n_wid:(rs+rl)*n_wid, y_col:] = Xy_chunk[:, y_col+1:]
+        y[rs*n_wid:(rs+rl)*n_wid] = Xy_chunk[:, y_col]
+
+    if memmap_folder is not None:
+        X.flush()
+        y.flush()
+
+    return X, y, n_hei, n_wid
+
+
+def Generate_Materials_Data(img_arr, FLAGS, engine='strided', memmap_folder=None):
     """ Generate materials micro-structure data from image array.
 
         Args:
             img_arr: The image array.
             FLAGS: All flags.
+            engine: 'strided' builds X and y from windowed views (see Generate_Materials_Data_Strided);
+                    'loop' uses the original column-by-column construction.
+            memmap_folder: Only for the 'strided' engine. Store X and y as memmaps in this folder.
 
         Returns:
             X: The numpy array of pixels in neighborhood windows (causal or non_causal).
@@ -454,6 +817,9 @@ def Generate_Materials_Data(img_arr, FLAGS):
             n_wid: The number of pixels in width.
             
     """
+    if engine == 'strided':
+        return Generate_Materials_Data_Strided(img_arr, FLAGS, memmap_folder=memmap_folder)
+
     img_hei, img_wid = img_arr.shape
     n_hei = (img_hei-2*FLAGS.wind_hei) # The number of pixels in height direction. The FLAGS.wind_hei is the neighborhood features for training supervised learning model. 
     n_wid = (img_wid-2*FLAGS.wind_wid) # The number of pixels in horizontal direction.
@@ -0,0 +1,129 @@
+# The sampler of GP fields on regular grids (Grid_RBF_GP_Sampler), the latent functions mapping the fields to
+# microstructure images and their plots, without gpytorch, so that they can be used (e.g. by micro_struct_store)
+# where gpytorch is not installed. They are also imported by matsci_data_generation.
+import numpy as np
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+from matplotlib.ticker import LinearLocator, FormatStrFormatter
+from matplotlib import cm
+from mpl_toolkits.mplot3d import Axes3D
+from constants import *
+
+
+def ax_plot(y_labels, title, save_path):
+    f, ax = plt.subplots(1, 1, figsize=(5, 5))
+    im = ax.imshow(y_labels, cmap=cm.coolwarm)
+    ax.set_title(title)
+    f.colorbar(im, shrink=0.8, aspect=10.0)
+    plt.savefig(save_path)
+
+
+def ax_plot_3d(grid_size, z_labels, title, save_path):
+    fig = plt.figure(figsize=(6, 5))
+    ax = fig.add_subplot(projection='3d')
+
+    # Make data.
+    X = np.arange(grid_size)
+    Y = np.arange(grid_size)
+    X, Y = np.meshgrid(X, Y)
+
+    # Plot the surface.
+    surf = ax.plot_surface(X, Y, z_labels, cmap=cm.coolwarm, linewidth=0, antialiased=False)
+
+    # Customize the z axis.
+    # ax.set_zlim(-1.01, 1.01)
+    ax.zaxis.set_major_locator(LinearLocator(10))
+    ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
+    ax.set_title(title)
+
+    # Add a color bar which maps values to colors.
+    fig.colorbar(surf, shrink=0.8, aspect=10.0)
+
+    plt.savefig(save_path)
+
+
+def RBF_Kernel_Factor_1D(grid_size: int, lengthscale: float, eig_tol: float=GP_EIG_TOL):
+    """ A factor L with shape (grid_size, rank) of the RBF kernel matrix exp(-(i-j)**2/2/lengthscale**2) 
+        of the grid points 0, ..., grid_size-1, such that L L^T is the kernel matrix without the eigenvalues 
+        below eig_tol times the largest one (the smooth kernel has a fast decaying spectrum, so rank is 
+        usually much smaller than grid_size).
+    """
+    arr_idx = np.arange(grid_size)
+    kern_mat = np.exp(-(arr_idx[:, np.newaxis]-arr_idx[np.newaxis, :])**2/2/lengthscale**2)
+    eigvs, eigvects = np.linalg.eigh(kern_mat)
+    keep_idx = eigvs > eig_tol*eigvs[-1]
+    return eigvects[:, keep_idx]*np.sqrt(eigvs[keep_idx])
+
+
+class Grid_RBF_GP_Sampler(object):
+    """ Draw realizations of the GP prior of Gen_GP_Latent_Func(prior_only=True) (zero mean, RBF kernel with one 
+        lengthscale per axis times opscale) on the grid_size**dim grid, plus white noise of variance noise as in 
+        Gen_Save_GP_Micro_Struct.
+
+        The RBF kernel on a regular grid is the Kronecker product of the 1D kernel matrices of the axes, so 
+        a realization is the standard normal tensor multiplied by the 1D factors (RBF_Kernel_Factor_1D) along 
+        each axis. The cost is that of a few matrix products per realization, without the dense covariance 
+        of all grid points or a training point, so 2048**2 grids and above are fine.
+    """
+    def __init__(self, dim: int, grid_size: int, lengthscale, opscale: float=1, noise: float=0, eig_tol: float=GP_EIG_TOL):
+        """ 
+            Args:
+                dim, grid_size, lengthscale, opscale, noise: See Gen_GP_Latent_Func. lengthscale can be a torch tensor 
+                                                              or an array with one value per axis (or one for all).
+                eig_tol: The relative tolerance of the eigenvalues kept in the 1D factors.
+        """
+        self.dim, self.grid_size = dim, grid_size
+        self.opscale, self.noise = opscale, noise
+        self.lengthscale = np.broadcast_to(np.asarray(lengthscale, dtype=np.float64).reshape((-1,)), (dim,))
+        # The grid points of gpytorch.utils.grid.create_data_from_grid run fastest along the first input dimension,
+        # so the last axis of a realization of Gen_GP_Latent_Func (viewed as an array) has lengthscale[0].
+        self.ls_factors = [RBF_Kernel_Factor_1D(grid_size, ls, eig_tol) for ls in self.lengthscale[::-1]]
+
+    def covariance(self):
+        """ The covariance matrix of the grid points (in row-major order) of the realizations. Only for small grids. """
+        cov_mat = np.ones((1, 1))
+        for factor in self.ls_factors:
+            cov_mat = np.kron(cov_mat, np.matmul(factor, factor.T))
+        return self.opscale*cov_mat+self.noise*np.eye(cov_mat.shape[0])
+
+    def sample(self, num_samples: int=1, rand_state=None):
+        """ num_samples realizations with shape (num_samples,)+(grid_size,)*dim.
+
+            Args:
+                rand_state: A np.random.RandomState (by default np.random).
+        """
+        if rand_state is None:
+            rand_state = np.random
+        rfield = rand_state.standard_normal((num_samples,)+tuple(factor.shape[1] for factor in self.ls_factors))
+        for ax, factor in enumerate(self.ls_factors):
+            rfield = np.moveaxis(np.tensordot(factor, rfield, axes=([1], [ax+1])), 0, ax+1)
+        rfield *= self.opscale**0.5
+        if self.noise > 0:
+            rfield += rand_state.normal(scale=self.noise**0.5, size=rfield.shape)
+        return rfield
+
+
+def Grayscale_Latent_Func(rfield):
+    min_v, max_v = np.min(rfield), np.max(rfield)
+    rfield = (rfield-min_v)/(max_v-min_v)*255
+    return rfield.astype(dtype=np.uint8)
+
+
+def Binary_Latent_Func(rfield, thre=0.5):
+    logit_val_arr = rfield
+    # gp_scale = 1  # The multiplier for the logit_val_arr.
+    logit_val_arr += np.log(thre/(1-thre))
+    proba_val_arr = 1/(1+np.exp(-logit_val_arr))
+    binary_img_arr = (0.5 <= proba_val_arr)*255
+    return binary_img_arr.astype(dtype=np.uint8)
+
+
+def Binary_Rand_Latent_Func(rfield, thre=0.5):
+    logit_val_arr = rfield
+    # gp_scale = 1  # The multiplier for the logit_val_arr.
+    logit_val_arr += np.log(thre/(1-thre))
+    proba_val_arr = 1/(1+np.exp(-logit_val_arr))
+    grid_size = logit_val_arr.shape[0]
+    rand_binary_img_arr = (np.random.rand(grid_size, grid_size) <= proba_val_arr)*255
+    return rand_binary_img_arr.astype(dtype=np.uint8)
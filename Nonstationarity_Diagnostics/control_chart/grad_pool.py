@@ -0,0 +1,209 @@
+import numpy as np
+import logging
+import atexit
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+
+from constants import *
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('grad_pool')
+logging.getLogger('grad_pool').setLevel(logging.INFO)
+
+
+def Attach_Shared_Array(name, shape, dtype):
+    """ Attach to the shared memory block created by another process as an array.
+
+        The spawned workers share the resource tracker of the pool, so the block is only unlinked once, by the pool.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def Grad_Worker(conn, gen_model_func, gen_model_func_param, grad_func, grad_func_kwargs, trace_grad_func=True):
+    """ The loop of one worker of Grad_Worker_Pool.
+
+        TensorFlow is imported and the model is built once. Since the model stays the same object, grad_func can
+        be traced once with tf.function (trace_grad_func) and reused for all samples and calls, instead of running
+        one eager GradientTape per sample. Then the worker waits for messages on conn:
+            ('weights', name, num_param): Copy the flattened weights from the shared memory block into the model.
+            ('grads', X_info, y_info, grads_info, row_start, row_end): Calculate the gradients of rows
+                row_start to row_end of the shared X and y into the shared grads. Each *_info is (name, shape, dtype).
+            None: Exit.
+    """
+    import tensorflow as tf
+    from control_chart.utils import grad_func_batch_model
+    model, _ = gen_model_func(*gen_model_func_param)
+    if trace_grad_func:
+        grad_func = tf.function(grad_func)
+    ls_weight_shapes = [np.shape(w) for w in model.get_weights()]
+    dict_shm = {}
+
+    def get_array(info):
+        # The blocks are kept attached until the pool replaces them by larger ones.
+        name, shape, dtype = info
+        if name not in dict_shm:
+            dict_shm[name] = Attach_Shared_Array(name, shape, dtype)
+        return np.ndarray(shape, dtype=dtype, buffer=dict_shm[name][0].buf)
+
+    conn.send(('ready', None))
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        try:
+            if msg[0] == 'weights':
+                flat_weights = get_array((msg[1], (msg[2],), np.float32))
+                ls_weights, start = [], 0
+                for shape in ls_weight_shapes:
+                    size = int(np.prod(shape))
+                    ls_weights.append(flat_weights[start:start+size].reshape(shape).copy())
+                    start += size
+                model.set_weights(ls_weights)
+            elif msg[0] == 'grads':
+                X, y, grads = get_array(msg[1]), get_array(msg[2]), get_array(msg[3])
+                row_start, row_end = msg[4], msg[5]
+                if row_end > row_start:
+                    grads[row_start:row_end] = grad_func_batch_model(X[row_start:row_end], y[row_start:row_end], model,
+                                                                     gen_model_func_param[0], grad_func, **grad_func_kwargs)
+            elif msg[0] == 'release':
+                for name in msg[1]:
+                    if name in dict_shm:
+                        dict_shm.pop(name)[0].close()
+            conn.send(('done', None))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    for shm, _ in dict_shm.values():
+        shm.close()
+    conn.close()
+
+
+class Grad_Worker_Pool(object):
+    """ A persistent pool of worker processes for the per-sample gradients of a neural network.
+
+        grad_func_batch_paral starts a new loky batch and rebuilds the model from its weights in every worker for
+        every call. Here each worker imports TensorFlow and builds the model once, and stays alive between calls:
+        set_weights() only copies the new weights to shared memory, and grads() writes X and y to shared memory
+        and lets each worker fill its contiguous rows of the shared gradients. The gradients are the same as those
+        of grad_func_batch_paral (and grad_func_batch) with the same grad_func (up to float32 rounding when
+        grad_func is traced).
+
+        Use it as a context manager or call close(); it is also closed at exit.
+    """
+    def __init__(self, gen_model_func, gen_model_func_param, grad_func, num_workers=GRAD_POOL_NUM_WORKERS, trace_grad_func=True, **grad_func_kwargs):
+        """
+            Args:
+                gen_model_func, gen_model_func_param: To build the model in the workers, e.g., Build_Model and its parameters.
+                grad_func: The gradient function, e.g., obj_grad. It should be importable at module level.
+                trace_grad_func: Whether the workers run grad_func as a tf.function.
+                grad_func_kwargs: The keyword arguments of grad_func other than model, e.g., loss and penal_param.
+        """
+        self.num_workers = num_workers
+        self.dict_shm = {}
+        self.last_weights = None
+        self.closed = False
+        # Fork is unsafe once TensorFlow has started its threads in this process.
+        ctx = mp.get_context('spawn')
+        self.ls_conns, self.ls_procs = [], []
+        for _ in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=Grad_Worker, daemon=True,
+                               args=(child_conn, gen_model_func, gen_model_func_param, grad_func, grad_func_kwargs, trace_grad_func))
+            proc.start()
+            child_conn.close()
+            self.ls_conns.append(parent_conn)
+            self.ls_procs.append(proc)
+        self.collect()
+        atexit.register(self.close)
+        logger.info("The gradient worker pool has %s workers.", num_workers, extra=d)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def collect(self, ls_conns=None):
+        """ Wait for the reply of each worker and raise the error of any worker. """
+        ls_errors = []
+        for conn in (self.ls_conns if ls_conns is None else ls_conns):
+            status, info = conn.recv()
+            if status == 'error':
+                ls_errors.append(info)
+        if ls_errors:
+            raise RuntimeError("The gradient worker failed:\n{}".format(ls_errors[0]))
+
+    def shared_array(self, key, shape, dtype):
+        """ The shared array for key. Its block is reused if it is large enough and replaced otherwise. """
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape))*dtype.itemsize, 1)
+        if key not in self.dict_shm or self.dict_shm[key].size < nbytes:
+            if key in self.dict_shm:
+                old_shm = self.dict_shm.pop(key)
+                for conn in self.ls_conns:
+                    conn.send(('release', [old_shm.name]))
+                self.collect()
+                old_shm.close()
+                old_shm.unlink()
+            # Grow by half to avoid reallocating for slightly larger inputs.
+            self.dict_shm[key] = shared_memory.SharedMemory(create=True, size=nbytes+nbytes//2)
+        shm = self.dict_shm[key]
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf), (shm.name, tuple(shape), dtype.str)
+
+    def set_weights(self, model_weights):
+        """ Send the weights (model.get_weights()) to all workers. Nothing is sent if they did not change. """
+        if self.last_weights is not None and len(self.last_weights) == len(model_weights) and all(
+                np.array_equal(w_old, w_new) for w_old, w_new in zip(self.last_weights, model_weights)):
+            return
+        flat_weights = np.concatenate([np.ravel(w) for w in model_weights]).astype(np.float32)
+        arr, info = self.shared_array('weights', flat_weights.shape, np.float32)
+        arr[:] = flat_weights
+        for conn in self.ls_conns:
+            conn.send(('weights', info[0], flat_weights.size))
+        self.collect()
+        self.last_weights = [np.array(w) for w in model_weights]
+
+    def grads(self, X, y):
+        """ The per-sample gradients of X and y, in the same layout as grad_func_batch_paral. """
+        if self.closed:
+            raise RuntimeError("The gradient worker pool is closed.")
+        if self.last_weights is None:
+            raise RuntimeError("The weights should be set before calculating gradients.")
+        y = np.vstack(y)
+        X_shared, X_info = self.shared_array('X', X.shape, X.dtype)
+        y_shared, y_info = self.shared_array('y', y.shape, y.dtype)
+        X_shared[:], y_shared[:] = X, y
+        num_param = int(np.sum([np.size(w) for w in self.last_weights]))
+        grads_shared, grads_info = self.shared_array('grads', (X.shape[0], num_param), np.float64)
+        sub_size = int(np.ceil(X.shape[0]/self.num_workers))
+        for idx, conn in enumerate(self.ls_conns):
+            conn.send(('grads', X_info, y_info, grads_info, min(idx*sub_size, X.shape[0]), min((idx+1)*sub_size, X.shape[0])))
+        self.collect()
+        return np.array(grads_shared)
+
+    def close(self):
+        """ Stop the workers and free the shared memory. Safe to call more than once. """
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.ls_conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for proc in self.ls_procs:
+            proc.join(timeout=GRAD_POOL_JOIN_TIMEOUT)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        for conn in self.ls_conns:
+            conn.close()
+        for shm in self.dict_shm.values():
+            shm.close()
+            shm.unlink()
+        self.dict_shm = {}
+        atexit.unregister(self.close)
+        logger.info("The gradient worker pool is closed.", extra=d)
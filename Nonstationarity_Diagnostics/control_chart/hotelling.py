@@ -17,8 +17,10 @@ from mpl_toolkits.mplot3d import proj3d, art3d
 from constants import *
 from control_chart.utils import *
 from collections import OrderedDict
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from PIL import Image
+from scipy.ndimage import correlate1d
+from scipy.signal import fftconvolve
 
 # Follow this link to enable plotting with latex text in figures
 # https://matplotlib.org/tutorials/text/usetex.html?highlight=latex
@@ -80,7 +82,57 @@ def set_xticks_xticklabels(ax, time_stamp, time_step, label_size, rotation=ROTAT
     ax.set_xticks(ls_xtick_pos)
 
 
-def ScoresSpatialEWMA(scores, n_hei, n_wid, sigma, wind_len, n_jobs=N_JOBS):
+def Spatial_EWMA_Kernel_1D(sigma, wind_len):
+    """ The normalized 1D Gaussian weights of length 2*wind_len+1.
+
+        The 2D spatial EWMA window is the outer product of this vector with itself, 
+        because exp(-(dr**2+dc**2)/2/sigma**2) = exp(-dr**2/2/sigma**2)*exp(-dc**2/2/sigma**2).
+    """
+    exp_weight_1d = np.exp(-np.arange(-wind_len, wind_len+1)**2/2.0/sigma**2)
+    return exp_weight_1d/np.sum(exp_weight_1d)
+
+
+def ScoresSpatialEWMAConv(scores, n_hei, n_wid, sigma, wind_len, engine='separable'):
+    """ Calculate spatial EWMA of scores as a convolution over all score dimensions at once.
+
+        It gives the same result as the pixel-by-pixel loop in ScoresSpatialEWMA: only the pixels 
+        whose whole (2*wind_len+1)x(2*wind_len+1) window is inside the image are kept ('valid' mode), 
+        and the Gaussian weights are normalized over the window.
+
+        Args:
+            scores: An array of scores of 2D image at each pixel (in order of row-by-row in a raster mode).
+            n_hei: The number of pixels in height direction.
+            n_wid: The number of pixels in width direction.
+            sigma: The length scale of exponential weight (Gaussian weight).
+            wind_len: The window length is 2*wind_len+1 for spatial EWMA.
+            engine: 'separable' uses two 1D correlations (rows then columns);
+                    'fft' uses one 2D FFT convolution with the full window.
+
+        Returns:
+            score_spatial_ewma_arr: The array of spatial EWMA with shape (n_hei-2*wind_len, n_wid-2*wind_len, score_dim).
+    """
+    scores_2d = np.asarray(scores, dtype=np.float64).reshape((n_hei, n_wid, -1))
+    n_ewma_hei, n_ewma_wid = n_hei-2*wind_len, n_wid-2*wind_len
+    exp_weight_1d = Spatial_EWMA_Kernel_1D(sigma, wind_len)
+
+    if engine == 'separable':
+        # The boundary mode does not matter since the margin of size wind_len is cropped afterwards.
+        score_spatial_ewma_arr = correlate1d(scores_2d, exp_weight_1d, axis=0, mode='constant')[wind_len:n_hei-wind_len]
+        score_spatial_ewma_arr = correlate1d(score_spatial_ewma_arr, exp_weight_1d, axis=1, mode='constant')[:, wind_len:n_wid-wind_len]
+    elif engine == 'fft':
+        # The Gaussian window is symmetric, so convolution and correlation are the same.
+        exp_weight_wind = np.outer(exp_weight_1d, exp_weight_1d)[:, :, np.newaxis]
+        score_spatial_ewma_arr = fftconvolve(scores_2d, exp_weight_wind, mode='valid', axes=(0, 1))
+    else:
+        raise ValueError("Unknown spatial EWMA engine: {}.".format(engine))
+
+    logger.info("The dimension of metric is %s.", scores_2d.shape[-1], extra=d)
+    logger.info("The shape before and after ewma calculateion: (%s, %s, %s, %s).\n", n_hei, n_wid, n_ewma_hei, n_ewma_wid, extra=d)
+
+    return score_spatial_ewma_arr.reshape((n_ewma_hei, n_ewma_wid, scores_2d.shape[-1]))
+
+
+def ScoresSpatialEWMA(scores, n_hei, n_wid, sigma, wind_len, n_jobs=N_JOBS, engine='separable'):
     """ Calculate spatial EWMA of scores or some metrics at each loacation of 2D image.
     
         Args:
@@ -89,11 +141,16 @@ def ScoresSpatialEWMA(scores, n_hei, n_wid, sigma, wind_len, n_jobs=N_JOBS):
             n_wid: The number of pixels in width direction.
             sigma: The length scale of exponential weight (Gaussian weight).
             wind_len: The window length is 2*wind_len+1 for spatial EWMA.
+            engine: 'separable' or 'fft' (see ScoresSpatialEWMAConv), or 'loop' for the 
+                    original pixel-by-pixel calculation in parallel.
 
         Returns:
             score_spatial_ewma_arr: The array of spatial EWMA using window length of size wind_len.
 
     """
+    if engine != 'loop':
+        return ScoresSpatialEWMAConv(scores, n_hei, n_wid, sigma, wind_len, engine=engine)
+
     def cal_exp_weight_wind(wind_len, sigma):
         """ Calculate weights for a window of size wind_len."""
         exp_weight_wind = np.zeros((2*wind_len+1, 2*wind_len+1))
@@ -177,15 +234,10 @@ def SpatialHotellingT2Retro(scores, n_hei, n_wid, sigma, wind_len, fig_name, FLA
     Sinv = Inv_Cov(scores, FLAGS.nugget)
     # Because we need to average the neighboring window of scores, there is a margin of 
     # EWMA window size. In this margin, the scores don't have spatial EWMA.
-    t2_n_hei, t2_n_wid = n_hei-2*wind_len, n_wid-2*wind_len
-    t2_scores_spatial_ewma_arr = np.zeros((t2_n_hei, t2_n_wid))
     score_mu = np.mean(scores, axis = 0)
 
-    # The t2_scores_spatial_ewma_arr is filled row-by-row of the image.
-    for ri in range(t2_n_hei):
-        for ci in range(t2_n_wid):
-            # The score_spatial_ewma_arr is filled row-by-row of the image.
-            t2_scores_spatial_ewma_arr[ri, ci] = HotellingT2(score_spatial_ewma_arr[ri, ci], score_mu, Sinv)
+    # The t2_scores_spatial_ewma_arr has the same (row-by-row) layout as score_spatial_ewma_arr.
+    t2_scores_spatial_ewma_arr = HotellingT2Batch(score_spatial_ewma_arr, score_mu, Sinv).astype(np.float64)
 
     PlotSaveSpatialHeatMap(t2_scores_spatial_ewma_arr, FLAGS.training_res_folder, fig_name)
 
@@ -273,27 +325,22 @@ def Spatial3DScoreRetro(score_spatial_ewma_arr, mu_score, n_hei, n_wid, sigma, w
     t2_n_hei, t2_n_wid = n_hei-2*wind_len, n_wid-2*wind_len
     t2_scores_spatial_ewma_arr = np.zeros((t2_n_hei, t2_n_wid))
 
+    # The chunked PCA engine appends the location coordinates chunk by chunk in PlotSaveClusteringSpatialScore3D.
+    if loc_coord_flag and getattr(FLAGS, 'pca_engine', 'dense') != 'chunked':
+        arr_loc_coord = FLAGS.loc_coord_wei*np.array([[r, c] for r in range(t2_n_hei) for c in range(t2_n_wid)])
+        score_spatial_ewma_arr = np.hstack((score_spatial_ewma_arr, arr_loc_coord))
+        mu_score = np.hstack((FLAGS.mu_train, np.mean(arr_loc_coord, axis=0)))
+
     # Plot clustering of scores. 
     # Do clustering first and then dimension reduction. (0)
     # Do dimension reduction first and then do clustering. (1)
     for ord_dr_cl in [1, 0]:
-        if loc_coord_flag:
-            arr_loc_coord = FLAGS.loc_coord_wei*np.array([[r, c] for r in range(t2_n_hei) for c in range(t2_n_wid)])
-            score_ewma_loc_coord_arr = np.hstack((score_spatial_ewma_arr, arr_loc_coord))
-            mu_loc_coord_train = np.hstack((FLAGS.mu_train, np.mean(arr_loc_coord, axis=0)))
-            PlotSaveClusteringSpatialScore3D(score_ewma_loc_coord_arr, mu_loc_coord_train, t2_n_hei, t2_n_wid, fig_name, FLAGS, 
-                                             label_size=label_size,
-                                             title='Score clustering\n({}, {})'.format('dr-cl' if ord_dr_cl else 'cl-dr', 'loc' if loc_coord_flag else 'no-loc'),
-                                             n_comp=n_comp, plot_flag=plot_flag, 
-                                             clustering_verbose=clustering_verbose, ord_dr_cl=ord_dr_cl, rand_col_flag=rand_col_flag, 
-                                             loc_coord_flag=loc_coord_flag, save_sep=save_sep)
-        else:
-            PlotSaveClusteringSpatialScore3D(score_spatial_ewma_arr, mu_score, t2_n_hei, t2_n_wid, fig_name, FLAGS, 
-                                             label_size=label_size,
-                                             title='Score clustering\n({}, {})'.format('dr-cl' if ord_dr_cl else 'cl-dr', 'loc' if loc_coord_flag else 'no-loc'),
-                                             n_comp=n_comp, plot_flag=plot_flag, 
-                                             clustering_verbose=clustering_verbose, ord_dr_cl=ord_dr_cl, rand_col_flag=rand_col_flag, 
-                                             loc_coord_flag=loc_coord_flag, save_sep=save_sep)
+        PlotSaveClusteringSpatialScore3D(score_spatial_ewma_arr, mu_score, t2_n_hei, t2_n_wid, fig_name, FLAGS, 
+                                         label_size=label_size,
+                                         title='Score clustering\n({}, {})'.format('dr-cl' if ord_dr_cl else 'cl-dr', 'loc' if loc_coord_flag else 'no-loc'),
+                                         n_comp=n_comp, plot_flag=plot_flag, 
+                                         clustering_verbose=clustering_verbose, ord_dr_cl=ord_dr_cl, rand_col_flag=rand_col_flag, 
+                                         loc_coord_flag=loc_coord_flag, save_sep=save_sep)
 
 
 # def Spatial3DScoreRetroInspect(score_spatial_ewma_arr, mu_score, n_hei, n_wid, sigma, wind_len, ls_row_grid_pts, ls_col_grid_pts, fig_name, FLAGS, margin_coef=0.5, plot_flag=False, n_comp=4, clustering_verbose=0, loc_coord_flag=False):
@@ -344,15 +391,70 @@ def PlotEigenValues(score_spatial_ewma_arr, mu_score, fig_name, num_eigvs, FLAGS
     cov_score_ewma = np.matmul(score_ewma_centered_arr.T, score_ewma_centered_arr)
     eigvs, eigvects = np.linalg.eigh(cov_score_ewma)
     if save_fig:
-        plt.figure(num=None, figsize=(ONE_FIG_HEI, ONE_FIG_HEI), dpi=DPI, facecolor='w', edgecolor='k')
-        plt.plot(np.arange(num_eigvs), eigvs[:-(num_eigvs+1):-1])
-        plt.title('Eigenvalues')
-        plt.savefig(os.path.join(FLAGS.training_res_folder, 'eigvalues_'+fig_name), bbox_inches='tight')
-        if plot_flag:
-            plt.show()
+        PlotSaveEigenValues(eigvs, fig_name, num_eigvs, FLAGS, plot_flag=plot_flag)
     return score_ewma_centered_arr, eigvects
 
 
+def PlotSaveEigenValues(eigvs, fig_name, num_eigvs, FLAGS, plot_flag=False):
+    """ Plot and save the largest num_eigvs eigenvalues (eigvs in ascending order as from np.linalg.eigh). """
+    plt.figure(num=None, figsize=(ONE_FIG_HEI, ONE_FIG_HEI), dpi=DPI, facecolor='w', edgecolor='k')
+    plt.plot(np.arange(num_eigvs), eigvs[:-(num_eigvs+1):-1])
+    plt.title('Eigenvalues')
+    plt.savefig(os.path.join(FLAGS.training_res_folder, 'eigvalues_'+fig_name), bbox_inches='tight')
+    if plot_flag:
+        plt.show()
+
+
+def Loc_Coord_Rows(row_start, row_end, n_wid, loc_coord_wei):
+    """ The weighted (row, col) location coordinates of the pixels row_start to row_end of the flattened 
+        (row-by-row) image of width n_wid, the same as the rows of arr_loc_coord in Spatial3DScoreRetro. 
+    """
+    idx_arr = np.arange(row_start, row_end)
+    return loc_coord_wei*np.stack((idx_arr//n_wid, idx_arr%n_wid), axis=1)
+
+
+def Score_Chunk(score_arr, mu_score, row_start, row_end, n_wid=None, loc_coord_wei=None):
+    """ The rows row_start to row_end of score_arr (an array or np.memmap) minus mu_score. If loc_coord_wei is given, 
+        the location coordinates are appended to the scores first (mu_score should then include their mean). 
+    """
+    score_chunk = np.asarray(score_arr[row_start:row_end], dtype=np.float64)
+    if loc_coord_wei is not None:
+        score_chunk = np.hstack((score_chunk, Loc_Coord_Rows(row_start, row_end, n_wid, loc_coord_wei)))
+    return score_chunk-mu_score
+
+
+def PlotEigenValuesChunked(score_arr, mu_score, fig_name, num_eigvs, FLAGS, n_wid=None, loc_coord_wei=None, 
+                           plot_flag=False, save_fig=False, chunk_rows=PCA_CHUNK_ROWS):
+    """ The chunked version of PlotEigenValues. The scatter matrix of the centered scores is accumulated chunk_rows 
+        pixels at a time, so neither the centered scores nor the scores with location coordinates are stored. 
+    
+        Returns:
+            eigvs, eigvects: In ascending order as from np.linalg.eigh.
+    """
+    num_pts = score_arr.shape[0]
+    cov_score_ewma = 0
+    for row_start in range(0, num_pts, chunk_rows):
+        score_chunk = Score_Chunk(score_arr, mu_score, row_start, min(row_start+chunk_rows, num_pts), n_wid, loc_coord_wei)
+        cov_score_ewma = cov_score_ewma+np.matmul(score_chunk.T, score_chunk)
+    eigvs, eigvects = np.linalg.eigh(cov_score_ewma)
+    if save_fig:
+        PlotSaveEigenValues(eigvs, fig_name, num_eigvs, FLAGS, plot_flag=plot_flag)
+    return eigvs, eigvects
+
+
+def Score_Project_Chunked(score_arr, mu_score, out_path, proj_mat, n_wid=None, loc_coord_wei=None, chunk_rows=PCA_CHUNK_ROWS):
+    """ Write (score_arr-mu_score) @ proj_mat (with the location coordinates appended if loc_coord_wei is given) 
+        chunk by chunk into a np.memmap stored at out_path. 
+    """
+    num_pts = score_arr.shape[0]
+    out_arr = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float64, shape=(num_pts, proj_mat.shape[1]))
+    for row_start in range(0, num_pts, chunk_rows):
+        row_end = min(row_start+chunk_rows, num_pts)
+        out_arr[row_start:row_end] = np.matmul(Score_Chunk(score_arr, mu_score, row_start, row_end, n_wid, loc_coord_wei), proj_mat)
+    out_arr.flush()
+    return out_arr
+
+
 # def PlotSaveTSScore3DScatter(score_spatial_ewma_arr, mu_score, ls_grid_pts, fig_name, FLAGS, num_eigvs=10):
 #     margin = [0, int(FLAGS.spatial_ewma_sigma)] # The size of margin that will not be plotted in scattering figures.
 #     PlotSaveSpatialScore3DScatterInspect(score_spatial_ewma_arr, mu_score, 1, score_spatial_ewma_arr.shape[0], [0], ls_grid_pts, fig_name, margin, FLAGS, num_eigvs)
@@ -474,6 +576,66 @@ def PlotSaveSpatialScore3DArrowInspect(score_spatial_ewma_arr, mu_score, n_hei,
         plt.show()
 
 
+# n_jobs of KMeans was removed in scikit-learn 1.0, where the parallelism is set by the OpenMP threads instead.
+KMEANS_KWARGS = {'n_jobs': N_JOBS} if 'n_jobs' in KMeans().get_params() else {}
+
+
+def Warm_Start_Centers(data, centers, rand_state, sample_size=KM_WARM_SAMPLE_SIZE):
+    """ The centers of k+1 clusters from those of k clusters, adding one point chosen as in greedy k-means++: among
+        2+log(k) candidates drawn with probability proportional to the squared distance to the nearest center,
+        the one that reduces the sum of squared distances the most (on a subsample of data).
+    """
+    if centers is None:
+        return data[[rand_state.randint(data.shape[0])]]
+    sample = data[rand_state.choice(data.shape[0], min(sample_size, data.shape[0]), replace=False)]
+    sq_dist = np.min(np.sum((sample[:, np.newaxis, :]-centers[np.newaxis, :, :])**2, axis=-1), axis=1)
+    if np.sum(sq_dist) == 0:
+        return np.vstack((centers, sample[[rand_state.randint(sample.shape[0])]]))
+    cand_idx = rand_state.choice(sample.shape[0], 2+int(np.log(centers.shape[0]+1)), p=sq_dist/np.sum(sq_dist))
+    cand_sq_dist = np.sum((sample[np.newaxis, :, :]-sample[cand_idx][:, np.newaxis, :])**2, axis=-1)
+    best_cand = cand_idx[np.argmin(np.sum(np.minimum(sq_dist, cand_sq_dist), axis=1))]
+    return np.vstack((centers, sample[[best_cand]]))
+
+
+def KMeans_Sweep(data, max_n_clusters, n_comp, rand_seed, engine='full', clustering_verbose=0, batch_size=KM_BATCH_SIZE):
+    """ The inertia of k-means for 1 to max_n_clusters clusters, and the fitted k-means with n_comp clusters.
+
+        Args:
+            engine: 'full': KMeans with k-means++ initialization for each number of clusters.
+                    'warm': KMeans for k+1 clusters starts from the centers for k clusters plus one new center.
+                    'minibatch': As 'warm' with MiniBatchKMeans, whose inertia is still on all data.
+                The fit with n_comp clusters in the sweep is reused (for 'full', the same as fitting it again
+                with the same random_state); it is only fitted separately when n_comp > max_n_clusters.
+
+        Returns:
+            km_inertia: The list of inertia.
+            km_cluster: The fitted model with n_comp clusters.
+    """
+    if engine not in ['full', 'warm', 'minibatch']:
+        raise ValueError("Unknown clustering engine: {}.".format(engine))
+    rand_state = np.random.RandomState(rand_seed)
+    km_inertia, km_cluster, centers = [], None, None
+    for n_clusters in range(1, max(max_n_clusters, n_comp)+1):
+        if engine == 'full':
+            km = KMeans(n_clusters=n_clusters, verbose=clustering_verbose, random_state=rand_seed, **KMEANS_KWARGS)
+        else:
+            centers = Warm_Start_Centers(data, centers, rand_state)
+            if engine == 'warm':
+                km = KMeans(n_clusters=n_clusters, init=centers, n_init=1, verbose=clustering_verbose, random_state=rand_seed)
+            else:
+                km = MiniBatchKMeans(n_clusters=n_clusters, init=centers, n_init=1, batch_size=batch_size, verbose=clustering_verbose,
+                                     random_state=rand_seed)
+        if n_clusters > max_n_clusters and engine == 'full' and n_clusters != n_comp:
+            continue
+        km.fit(data)
+        centers = km.cluster_centers_
+        if n_clusters <= max_n_clusters:
+            km_inertia.append(km.inertia_)
+        if n_clusters == n_comp:
+            km_cluster = km
+    return km_inertia, km_cluster
+
+
 def PlotSaveClusteringTSScore3D(score_spatial_ewma_arr, mu_score, ls_grid_pts, fig_name, FLAGS, 
                                 title="", num_eigvs=10, n_comp=4, plot_flag=False, clustering_verbose=0, 
                                 ord_dr_cl=1, loc_coord_flag=False):
@@ -484,18 +646,10 @@ def PlotSaveClusteringTSScore3D(score_spatial_ewma_arr, mu_score, ls_grid_pts, f
     # 3D scattering
     score_ewma_3d_arr = np.matmul(score_ewma_centered_arr, eigvects[:,:-4:-1])
     
-    km_inertia = []
     start_time = time.time()
-    for n_clusters in range(1, FLAGS.km_max_n_clusters+1):
-        print(n_clusters)
-        km_cluster = KMeans(n_clusters=n_clusters, verbose=clustering_verbose, random_state=FLAGS.rand_seed, n_jobs=N_JOBS)
-        if ord_dr_cl:
-            # Do dimension reduction first, then clustering.
-            km_cluster.fit(score_ewma_3d_arr)
-        else:
-            # Do clustering first then dimension reduction.
-            km_cluster.fit(score_spatial_ewma_arr)
-        km_inertia.append(km_cluster.inertia_)
+    # Do dimension reduction first, then clustering (ord_dr_cl), or clustering first then dimension reduction.
+    km_inertia, km_cluster = KMeans_Sweep(score_ewma_3d_arr if ord_dr_cl else score_spatial_ewma_arr, FLAGS.km_max_n_clusters, n_comp,
+                                          FLAGS.rand_seed, engine=getattr(FLAGS, 'km_engine', 'full'), clustering_verbose=clustering_verbose)
     print("The time took to run clustering is {}s.".format(time.time()-start_time,))
         
     fig = plt.figure(num=None, figsize=(ONE_FIG_HEI, ONE_FIG_HEI), dpi=DPI, facecolor='w', edgecolor='k')
@@ -515,12 +669,7 @@ def PlotSaveClusteringTSScore3D(score_spatial_ewma_arr, mu_score, ls_grid_pts, f
     if plot_flag:
         plt.show()
     
-    # Plot 3D clustering of scores.
-    km_cluster = KMeans(n_clusters=n_comp, verbose=clustering_verbose, random_state=FLAGS.rand_seed, n_jobs=N_JOBS)
-    if ord_dr_cl:
-        km_cluster.fit(score_ewma_3d_arr)
-    else:
-        km_cluster.fit(score_spatial_ewma_arr)
+    # Plot 3D clustering of scores with the fit of n_comp clusters from the sweep.
     print("The inertia is {}.".format(km_cluster.inertia_,))
     fig = plt.figure(num=None, figsize=(2*ONE_FIG_HEI, ONE_FIG_HEI), dpi=300, facecolor='w', edgecolor='k')
     plt.subplots_adjust(top=AX_TOP, bottom=AX_BOT, left=AX_LEFT, right=AX_RIGHT, hspace=HSPACE, wspace = 0)
@@ -586,28 +735,53 @@ def PlotSaveClusteringSpatialScore3D(score_spatial_ewma_arr, mu_score, n_hei, n_
                                      label_size=LAB_SIZE,
                                      title="", num_eigvs=10, n_comp=4, plot_flag=False, clustering_verbose=0, 
                                      ord_dr_cl=1, loc_coord_flag=False, rand_col_flag=False, save_sep=False):
-    """ Do clustering on score with or without spatial location information. """
+    """ Do clustering on score with or without spatial location information. 
+    
+        With FLAGS.pca_engine 'chunked', score_spatial_ewma_arr can be a np.memmap and, if loc_coord_flag, it has no 
+        location coordinates (they are appended chunk by chunk). The projected scores are streamed into a temporary 
+        memory-mapped file in FLAGS.training_res_folder, which is removed after clustering.
+    """
     # Plot eigen-values
     fig_name_cluster = 'loc_info_{}_'.format(loc_coord_flag) + fig_name
-    score_ewma_centered_arr, eigvects = PlotEigenValues(score_spatial_ewma_arr, mu_score, fig_name_cluster, num_eigvs, FLAGS, plot_flag=plot_flag)
-    
-    # 3D scattering
-    score_ewma_3d_arr = np.matmul(score_ewma_centered_arr, eigvects[:,:-4:-1])
-    print("The number of element is {} (expected: {}).".format(score_ewma_3d_arr.shape[0], n_hei*n_wid))
-    
-    km_inertia = []
-    start_time = time.time()
-    for n_clusters in range(1, FLAGS.km_max_n_clusters+1):
-        print(n_clusters)
-        km_cluster = KMeans(n_clusters=n_clusters, verbose=clustering_verbose, random_state=FLAGS.rand_seed, n_jobs=N_JOBS)
-        if ord_dr_cl:
-            # Do dimension reduction first, then clustering.
-            km_cluster.fit(score_ewma_3d_arr)
+    pca_engine = getattr(FLAGS, 'pca_engine', 'dense')
+    mmap_path = None
+    try:
+        if pca_engine == 'dense':
+            score_ewma_centered_arr, eigvects = PlotEigenValues(score_spatial_ewma_arr, mu_score, fig_name_cluster, num_eigvs, FLAGS, plot_flag=plot_flag)
+        
+            # 3D scattering
+            score_ewma_3d_arr = np.matmul(score_ewma_centered_arr, eigvects[:,:-4:-1])
+        elif pca_engine == 'chunked':
+            loc_coord_wei = FLAGS.loc_coord_wei if loc_coord_flag else None
+            if loc_coord_flag:
+                # The same centering as for arr_loc_coord in Spatial3DScoreRetro.
+                mu_score = np.hstack((FLAGS.mu_train, loc_coord_wei*np.array([(n_hei-1)/2, (n_wid-1)/2])))
+            _, eigvects = PlotEigenValuesChunked(score_spatial_ewma_arr, mu_score, fig_name_cluster, num_eigvs, FLAGS, 
+                                                 n_wid=n_wid, loc_coord_wei=loc_coord_wei, plot_flag=plot_flag)
+            # Clustering first on the scores with location coordinates needs all the principal components. The k-means 
+            # on them is the same as on the scores with location coordinates, since it only depends on the distances.
+            proj_mat = eigvects[:,::-1] if loc_coord_flag and not ord_dr_cl else eigvects[:,:-4:-1]
+            mmap_path = os.path.join(FLAGS.training_res_folder, os.path.splitext(fig_name_cluster)[0]+'_pca.npy')
+            score_pca_arr = Score_Project_Chunked(score_spatial_ewma_arr, mu_score, mmap_path, proj_mat, n_wid=n_wid, loc_coord_wei=loc_coord_wei)
+            # 3D scattering
+            score_ewma_3d_arr = np.array(score_pca_arr[:, :3])
+            if loc_coord_flag and not ord_dr_cl:
+                score_spatial_ewma_arr = score_pca_arr
         else:
-            # Do clustering first then dimension reduction.
-            km_cluster.fit(score_spatial_ewma_arr)
-        km_inertia.append(km_cluster.inertia_)
-    print("The time took to run clustering is {}s.".format(time.time()-start_time,))
+            raise ValueError("Unknown PCA engine: {}.".format(pca_engine))
+        print("The number of element is {} (expected: {}).".format(score_ewma_3d_arr.shape[0], n_hei*n_wid))
+        
+        start_time = time.time()
+        # Do dimension reduction first, then clustering (ord_dr_cl), or clustering first then dimension reduction.
+        km_inertia, km_cluster = KMeans_Sweep(score_ewma_3d_arr if ord_dr_cl else score_spatial_ewma_arr, FLAGS.km_max_n_clusters, n_comp,
+                                              FLAGS.rand_seed, engine=getattr(FLAGS, 'km_engine', 'full'), clustering_verbose=clustering_verbose)
+        print("The time took to run clustering is {}s.".format(time.time()-start_time,))
+    finally:
+        if mmap_path is not None:
+            # Drop the references to the memmap before removing its file.
+            score_pca_arr = score_spatial_ewma_arr = None
+            if os.path.exists(mmap_path):
+                os.remove(mmap_path)
         
     fig = plt.figure(num=None, figsize=(ONE_FIG_HEI, ONE_FIG_HEI), dpi=DPI, facecolor='w', edgecolor='k')
     ax = plt.subplot2grid((1,1), (0,0))
@@ -626,12 +800,7 @@ def PlotSaveClusteringSpatialScore3D(score_spatial_ewma_arr, mu_score, n_hei, n_
     if plot_flag:
         plt.show()
     
-    # Plot 3D clustering of scores.
-    km_cluster = KMeans(n_clusters=n_comp, verbose=clustering_verbose, random_state=FLAGS.rand_seed, n_jobs=N_JOBS)
-    if ord_dr_cl:
-        km_cluster.fit(score_ewma_3d_arr)
-    else:
-        km_cluster.fit(score_spatial_ewma_arr)
+    # Plot 3D clustering of scores with the fit of n_comp clusters from the sweep.
     print("The inertia is {}.".format(km_cluster.inertia_,))
     fig = plt.figure(num=None, figsize=(2*ONE_FIG_HEI, 2*ONE_FIG_HEI), dpi=300, facecolor='w', edgecolor='k')
     plt.subplots_adjust(top=AX_TOP, bottom=AX_BOT, left=AX_LEFT, right=AX_RIGHT, hspace=HSPACE, wspace = HSPACE)
@@ -909,6 +1078,73 @@ def SpatialBlockwise(
     return comp_stat_blockwise_ave_arr
 
 
+def Score_Summed_Area_Table(scores, n_hei, n_wid):
+    """ The summed-area table (integral image) of the scores.
+
+        sat[r, c] is the sum of the scores in rows [0, r) and columns [0, c), so the sum over any block
+        [rs, rs+rl) x [cs, cs+cl) is sat[rs+rl, cs+cl]-sat[rs, cs+cl]-sat[rs+rl, cs]+sat[rs, cs], whatever
+        the size of the block. It is built once and shared by all grids and block sizes.
+
+        Returns:
+            sat: An array of shape (n_hei+1, n_wid+1, score_dim) in float64.
+    """
+    scores = np.asarray(scores, dtype=np.float64).reshape((n_hei, n_wid, -1))
+    sat = np.zeros((n_hei+1, n_wid+1, scores.shape[-1]))
+    np.cumsum(scores, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def Block_Ave_Scores_SAT(sat, rs, rl, cs, cl):
+    """ The average scores of blocks [rs, rs+rl) x [cs, cs+cl) from the summed-area table.
+
+        rs, rl, cs and cl are integers or broadcastable integer arrays, so all blocks are answered at once.
+
+        Returns:
+            An array of shape np.broadcast(rs, rl, cs, cl).shape+(score_dim,).
+    """
+    rs, rl, cs, cl = np.broadcast_arrays(*[np.asarray(v, dtype=np.int64) for v in (rs, rl, cs, cl)])
+    re, ce = rs+rl, cs+cl
+    block_sum = sat[re, ce]-sat[rs, ce]-sat[re, cs]+sat[rs, cs]
+    return block_sum/(rl*cl)[..., np.newaxis]
+
+
+def SpatialSlidingBlockT2(scores, n_hei, n_wid, block_hei, block_wid, mu_train, Sinv_train, stride=1, sat=None):
+    """ Hotelling T2 of the average scores of all (block_hei x block_wid) blocks sliding with stride.
+
+        Args:
+            sat: The summed-area table from Score_Summed_Area_Table. Pass it in to reuse it across block sizes,
+                 then scores can be None.
+
+        Returns:
+            An array of shape ((n_hei-block_hei)//stride+1, (n_wid-block_wid)//stride+1). The element [i, j]
+            is the T2 of the block starting at (i*stride, j*stride).
+    """
+    if sat is None:
+        sat = Score_Summed_Area_Table(scores, n_hei, n_wid)
+    rs = np.arange(0, n_hei-block_hei+1, stride)[:, np.newaxis]
+    cs = np.arange(0, n_wid-block_wid+1, stride)[np.newaxis, :]
+    block_ave_scores = Block_Ave_Scores_SAT(sat, rs, block_hei, cs, block_wid)
+    return HotellingT2Batch(block_ave_scores, mu_train, Sinv_train).astype(np.float64)
+
+
+def SpatialMultiScaleBlockT2(scores, n_hei, n_wid, ls_block_sizes, mu_train, Sinv_train, stride=1):
+    """ SpatialSlidingBlockT2 for several block sizes sharing one summed-area table.
+
+        Args:
+            ls_block_sizes: A list of block sizes, either int (square) or (block_hei, block_wid).
+
+        Returns:
+            An OrderedDict from (block_hei, block_wid) to the sliding block T2 array.
+    """
+    sat = Score_Summed_Area_Table(scores, n_hei, n_wid)
+    dict_t2 = OrderedDict()
+    for block_size in ls_block_sizes:
+        block_hei, block_wid = (block_size, block_size) if np.isscalar(block_size) else tuple(block_size)
+        dict_t2[(block_hei, block_wid)] = SpatialSlidingBlockT2(None, n_hei, n_wid, block_hei, block_wid, mu_train, Sinv_train, stride=stride, sat=sat)
+    return dict_t2
+
+
 def SpatialBlockwiseT2(
         scores, 
         n_hei, 
@@ -918,21 +1154,43 @@ def SpatialBlockwiseT2(
         nugget,
         mu_train, Sinv_train,
         fig_name,
-        FLAGS):
+        FLAGS,
+        engine='sat',
+        sat=None):
+    """ Hotelling T2 of the average scores in each block of the grid, painted over the pixels of the block.
+
+        Args:
+            engine: 'sat' answers all blocks at once from the summed-area table (see Score_Summed_Area_Table);
+                    'loop' averages the blocks one by one.
+            sat: Only for the 'sat' engine. The summed-area table to reuse across grids.
+    """
     # Calculate spatial blockwise average of score.
-    score_dim = scores[0].shape[0]
-    scores = scores.reshape((n_hei, n_wid, score_dim))
-    t2_scores_blockwise_ave_arr = np.zeros((n_hei, n_wid))
+    score_dim = scores[0].shape[0] if sat is None else sat.shape[-1]
     ls_row_block_sizes, ls_col_block_sizes = np.diff(ls_row_grid_pts+[n_hei]), np.diff(ls_col_grid_pts+[n_wid])
-    arr_block_ave_scores = np.zeros((0, score_dim))
-    arr_t2_block_ave_scores = np.zeros(0)
-    for rs, rl in zip(ls_row_grid_pts, ls_row_block_sizes):
-        for cs, cl in zip(ls_col_grid_pts, ls_col_block_sizes):
+    if engine == 'sat':
+        if sat is None:
+            sat = Score_Summed_Area_Table(scores, n_hei, n_wid)
+        rs, cs = np.array(ls_row_grid_pts)[:, np.newaxis], np.array(ls_col_grid_pts)[np.newaxis, :]
+        arr_block_ave_scores = Block_Ave_Scores_SAT(sat, rs, ls_row_block_sizes[:, np.newaxis], cs, ls_col_block_sizes[np.newaxis, :])
+        arr_t2_block_ave_scores = HotellingT2Batch(arr_block_ave_scores, mu_train, Sinv_train).astype(np.float64)
+        # Paint each block with its T2 by repeating the grid of T2 by the block sizes.
+        t2_scores_blockwise_ave_arr = np.zeros((n_hei, n_wid))
+        t2_scores_blockwise_ave_arr[ls_row_grid_pts[0]:, ls_col_grid_pts[0]:] = np.repeat(
+            np.repeat(arr_t2_block_ave_scores, ls_row_block_sizes, axis=0), ls_col_block_sizes, axis=1)
+        arr_block_ave_scores, arr_t2_block_ave_scores = arr_block_ave_scores.reshape((-1, score_dim)), arr_t2_block_ave_scores.reshape((-1,))
+    elif engine == 'loop':
+        scores = scores.reshape((n_hei, n_wid, score_dim))
+        t2_scores_blockwise_ave_arr = np.zeros((n_hei, n_wid))
+        ls_blocks = [(rs, rl, cs, cl) for rs, rl in zip(ls_row_grid_pts, ls_row_block_sizes) for cs, cl in zip(ls_col_grid_pts, ls_col_block_sizes)]
+        arr_block_ave_scores = np.zeros((len(ls_blocks), score_dim))
+        for bi, (rs, rl, cs, cl) in enumerate(ls_blocks):
             print((rs, rl, cs, cl))
-            block_ave_score = scores[rs:rs+rl, cs:cs+cl, :].mean(axis=(0,1))
-            t2_scores_blockwise_ave_arr[rs:rs+rl, cs:cs+cl] = HotellingT2(block_ave_score, mu_train, Sinv_train)
-            arr_block_ave_scores = np.vstack((arr_block_ave_scores, block_ave_score))
-            arr_t2_block_ave_scores = np.hstack((arr_t2_block_ave_scores, t2_scores_blockwise_ave_arr[rs, cs]))
+            arr_block_ave_scores[bi] = scores[rs:rs+rl, cs:cs+cl, :].mean(axis=(0,1))
+        arr_t2_block_ave_scores = HotellingT2Batch(arr_block_ave_scores, mu_train, Sinv_train).astype(np.float64)
+        for (rs, rl, cs, cl), t2_block_ave_score in zip(ls_blocks, arr_t2_block_ave_scores):
+            t2_scores_blockwise_ave_arr[rs:rs+rl, cs:cs+cl] = t2_block_ave_score
+    else:
+        raise ValueError("Unknown spatial blockwise T2 engine: {}.".format(engine))
     print(("The block average scores are: {}.\n".format(arr_block_ave_scores,)))
     print(("The block average scores t2 are: {}.\n".format(arr_t2_block_ave_scores,)))
     
@@ -961,14 +1219,9 @@ def SpatialHotellingEWMAT2(
     # print("The first 10 scores: {}.".format(scores))
     # print("The first 10 ewma scores: {}.".format(score_spatial_ewma_arr))
     # Calculate spatial Hotelling T2
-    t2_n_hei, t2_n_wid = n_hei-2*wind_len, n_wid-2*wind_len
-    t2_scores_spatial_ewma_arr = np.zeros((t2_n_hei, t2_n_wid))
-    
     # The t2_scores_spatial_ewma is filled row-by-row.
     start_time = time.time()
-    for ri in range(t2_n_hei):
-        for ci in range(t2_n_wid):
-            t2_scores_spatial_ewma_arr[ri, ci] = HotellingT2(score_spatial_ewma_arr[ri,ci], mu_train, Sinv_train)
+    t2_scores_spatial_ewma_arr = HotellingT2Batch(score_spatial_ewma_arr, mu_train, Sinv_train).astype(np.float64)
     logger.info("The time for calculating %s T2 is %s s.", scores.shape, time.time()-start_time, extra=d)
 
     if fplot:
@@ -14,6 +14,7 @@ from matplotlib.ticker import LinearLocator, FormatStrFormatter
 from matplotlib import cm
 from mpl_toolkits.mplot3d import Axes3D
 from control_chart.data_generation import *
+from control_chart.gp_sampler import *
 
 
 # %% [markdown]
@@ -54,42 +55,10 @@ class GridGPPriorGenerator(gpytorch.models.ExactGP):
         return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
 
 
-def ax_plot(y_labels, title, save_path):
-    f, ax = plt.subplots(1, 1, figsize=(5, 5))
-    im = ax.imshow(y_labels, cmap=cm.coolwarm)
-    ax.set_title(title)
-    f.colorbar(im, shrink=0.8, aspect=10.0)
-    plt.savefig(save_path)
-
-
-def ax_plot_3d(grid_size, z_labels, title, save_path):
-    fig = plt.figure(figsize=(6, 5))
-    ax = fig.gca(projection='3d')
-
-    # Make data.
-    X = np.arange(grid_size)
-    Y = np.arange(grid_size)
-    X, Y = np.meshgrid(X, Y)
-
-    # Plot the surface.
-    surf = ax.plot_surface(X, Y, z_labels, cmap=cm.coolwarm, linewidth=0, antialiased=False)
-
-    # Customize the z axis.
-    # ax.set_zlim(-1.01, 1.01)
-    ax.zaxis.set_major_locator(LinearLocator(10))
-    ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
-    ax.set_title(title)
-
-    # Add a color bar which maps values to colors.
-    fig.colorbar(surf, shrink=0.8, aspect=10.0)
-
-    plt.savefig(save_path)
-
-
 # %% [markdown]
 # ## Function to generate and save plots of realization of GP.
 def Gen_GP_Latent_Func(dim: int, train_x: torch.tensor, train_y: torch.tensor,
-                       grid_size: int, lengthscale: torch.tensor, opscale: float=1, noise: float=0):
+                       grid_size: int, lengthscale: torch.tensor, opscale: float=1, noise: float=0, prior_only: bool=False):
     """
         dim: The dimension of input space.
         train_x: One example of training x.
@@ -98,7 +67,9 @@ def Gen_GP_Latent_Func(dim: int, train_x: torch.tensor, train_y: torch.tensor,
         lengthscale: The diagonal parameters of theta for specifying length-scale along each axis: https://gpytorch.readthedocs.io/en/latest/kernels.html#gpytorch.kernels.RBFKernel.
         noise: The variance of noise: https://github.com/cornellius-gp/gpytorch/blob/92e07cf4dae26083fe0aed926e1dfd483443924e/gpytorch/likelihoods/gaussian_likelihood.py#L106.
         opscale: The outputscale for the kernel.
-
+        prior_only: Whether return the GP prior of the grid points (model.forward), with zero mean and covariance opscale 
+                    times the RBF kernel, which is the distribution of Grid_RBF_GP_Sampler without noise. By default, the 
+                    predictive distribution of the model given the training example, through the GaussianLikelihood, is returned.
     """
     grid = torch.zeros(grid_size, dim, dtype=torch.float)
     for ci in range(dim):
@@ -123,46 +94,65 @@ def Gen_GP_Latent_Func(dim: int, train_x: torch.tensor, train_y: torch.tensor,
 
     with torch.no_grad(), gpytorch.settings.fast_pred_var():
         # observed_pred = likelihood(model(test_x), noise=noise*torch.ones(test_x.size(0)))
-        observed_pred = likelihood(model(test_x))
+        if prior_only:
+            observed_pred = model.forward(test_x)
+        else:
+            observed_pred = likelihood(model(test_x))
 
     return observed_pred
 
-def Grayscale_Latent_Func(rfield):
-    min_v, max_v = np.min(rfield), np.max(rfield)
-    rfield = (rfield-min_v)/(max_v-min_v)*255
-    return rfield.astype(dtype=np.uint8)
-
-def Binary_Latent_Func(rfield, thre=0.5):
-    logit_val_arr = rfield
-    # gp_scale = 1  # The multiplier for the logit_val_arr.
-    logit_val_arr += np.log(thre/(1-thre))
-    proba_val_arr = 1/(1+np.exp(-logit_val_arr))
-    binary_img_arr = (0.5 <= proba_val_arr)*255
-    return binary_img_arr.astype(dtype=np.uint8)
-
-def Binary_Rand_Latent_Func(rfield, thre=0.5):
-    logit_val_arr = rfield
-    # gp_scale = 1  # The multiplier for the logit_val_arr.
-    logit_val_arr += np.log(thre/(1-thre))
-    proba_val_arr = 1/(1+np.exp(-logit_val_arr))
-    grid_size = logit_val_arr.shape[0]
-    rand_binary_img_arr = (np.random.rand(grid_size, grid_size) <= proba_val_arr)*255
-    return rand_binary_img_arr.astype(dtype=np.uint8)
+
+def Check_GP_Sampler_Cov(dim: int, train_x: torch.tensor, train_y: torch.tensor, grid_size: int, lengthscale: torch.tensor, 
+                         opscale: float=1, noise: float=0, num_samples: int=20000, rand_seed: int=0):
+    """ Compare the distribution of Grid_RBF_GP_Sampler with that of the GP prior of gpytorch on a small grid, 
+        i.e. the covariance of Gen_GP_Latent_Func(prior_only=True) plus noise on the diagonal (the white noise 
+        added by Gen_Save_GP_Micro_Struct).
+
+        Returns:
+            The largest absolute differences from the covariance of the gpytorch path of the sampler's covariance,
+            and of the empirical covariances of num_samples realizations of the sampler and of the gpytorch path.
+    """
+    gp_proc = Gen_GP_Latent_Func(dim, train_x, train_y, grid_size, lengthscale, opscale, noise, prior_only=True)
+    with torch.no_grad():
+        gpy_cov = gp_proc.covariance_matrix.double().numpy()+noise*np.eye(grid_size**dim)
+        torch.manual_seed(rand_seed)
+        gpy_rfield = gp_proc.rsample(torch.Size((num_samples,))).double().numpy()
+    gpy_rfield += np.random.RandomState(rand_seed).normal(scale=noise**0.5, size=gpy_rfield.shape)
+
+    sampler = Grid_RBF_GP_Sampler(dim, grid_size, lengthscale, opscale, noise)
+    rfield = sampler.sample(num_samples, np.random.RandomState(rand_seed)).reshape((num_samples, -1))
+    cov_diff = np.max(np.abs(sampler.covariance()-gpy_cov))
+    emp_cov_diff = np.max(np.abs(np.matmul(rfield.T, rfield)/num_samples-gpy_cov))
+    gpy_emp_cov_diff = np.max(np.abs(np.matmul(gpy_rfield.T, gpy_rfield)/num_samples-gpy_cov))
+    print(("The covariance differences from gpytorch on the {} grid points: {:.2e} (sampler), {:.2e} (sampler empirical), "
+           "{:.2e} (gpytorch empirical), with {} realizations.").format(grid_size**dim, cov_diff, emp_cov_diff, gpy_emp_cov_diff, num_samples))
+    return cov_diff, emp_cov_diff, gpy_emp_cov_diff
+
 
 def Gen_Save_GP_Micro_Struct(dim: int, train_x: torch.tensor, train_y: torch.tensor, 
                              grid_size: int, lengthscale: torch.tensor, opscale: float, noise: float,
-                             lat_func: object, save_path: str, postfix: str = "", lat_func_kwargs: dict = {}):
-    gp_proc = Gen_GP_Latent_Func(dim, train_x, train_y, grid_size, lengthscale, opscale, noise)
-
-    start_time = time.time()
-    # rfield_tensor = gp_proc.rsample(sample_shape=torch.Size((grid_size, grid_size)))
-    rfield_tensor = gp_proc.rsample().view(grid_size, grid_size)
-    print(rfield_tensor.size())
-    print("The prediction for the 40000 grid points takes time: {}s.\n".format(
-        time.time()-start_time,))
-    print("The random realization is:\n {}.\n".format(rfield_tensor,))
-    rfield = rfield_tensor.detach().numpy()
-    rfield += np.random.normal(scale=noise**0.5, size=(grid_size, grid_size))
+                             lat_func: object, save_path: str, postfix: str = "", lat_func_kwargs: dict = {}, gp_engine: str = 'gpytorch'):
+    if gp_engine == 'kron':
+        # The GP prior of Gen_GP_Latent_Func(prior_only=True), with the white noise included in the realization of 
+        # Grid_RBF_GP_Sampler. Unlike the default gpytorch engine, it is not conditioned on the training example 
+        # and has no noise of the GaussianLikelihood.
+        start_time = time.time()
+        rfield = Grid_RBF_GP_Sampler(dim, grid_size, lengthscale, opscale, noise).sample(1)[0]
+        print("The realization for the {} grid points takes time: {}s.\n".format(grid_size**dim, time.time()-start_time,))
+    elif gp_engine == 'gpytorch':
+        gp_proc = Gen_GP_Latent_Func(dim, train_x, train_y, grid_size, lengthscale, opscale, noise)
+
+        start_time = time.time()
+        # rfield_tensor = gp_proc.rsample(sample_shape=torch.Size((grid_size, grid_size)))
+        rfield_tensor = gp_proc.rsample().view(grid_size, grid_size)
+        print(rfield_tensor.size())
+        print("The prediction for the 40000 grid points takes time: {}s.\n".format(
+            time.time()-start_time,))
+        print("The random realization is:\n {}.\n".format(rfield_tensor,))
+        rfield = rfield_tensor.detach().numpy()
+        rfield += np.random.normal(scale=noise**0.5, size=(grid_size, grid_size))
+    else:
+        raise ValueError("Unknown GP engine: {}.".format(gp_engine))
     print(rfield.shape, np.mean(rfield), np.std(rfield))
 
     # Postfix for plots.
@@ -248,13 +238,14 @@ def Gen_AR_2D_Noisy_Reg_Data(gen_func, latent_gen_func, sigma, intcp, ext_img_he
     else:
         print("The eigenvalues of this 2D AR model are {}({}).".format(eigvs, max_abs_eigv))
 
+    ar_2d_engine = getattr(FLAGS, 'ar_2d_engine', 'loop')
     init_vals = np.random.normal(0, sigma, (ext_img_hei, ext_img_wid))
     nois_mean, _ = Cal_AR_2D_Mean_Std_Given_Intcp(
-        gen_func_cla, sigma, intcp, FLAGS.gen_wind_hei, FLAGS.gen_wind_wid, init_vals, coeffs) # Specifically, use gen_func_cla here, not gen_func_reg
+        gen_func_cla, sigma, intcp, FLAGS.gen_wind_hei, FLAGS.gen_wind_wid, init_vals, coeffs, engine=ar_2d_engine) # Specifically, use gen_func_cla here, not gen_func_reg
     print(nois_mean, intcp, sigma)
     init_vals = np.random.normal(nois_mean, sigma, (ext_img_hei, ext_img_wid))
     _, y_temp, z_arr, img_arr = Generate_AR_2D_Data(
-        gen_func, sigma, FLAGS.gen_wind_hei, FLAGS.gen_wind_wid, init_vals, coeffs, intcp=intcp, latent_gen_func=latent_gen_func)
+        gen_func, sigma, FLAGS.gen_wind_hei, FLAGS.gen_wind_wid, init_vals, coeffs, intcp=intcp, latent_gen_func=latent_gen_func, engine=ar_2d_engine)
     noise_arr = np.random.normal(size=img_arr.shape)*255
     img_arr = img_arr.astype(np.float32) # img_arr is [0, 255] with saturated gray-scale.
     img_arr += noise_arr.astype(np.float32)*noise_level
@@ -0,0 +1,303 @@
+# Build datasets of synthetic GP microstructures (the latent GP field of Grid_RBF_GP_Sampler mapped by
+# Grayscale_Latent_Func, Binary_Latent_Func or Binary_Rand_Latent_Func, as in Gen_Save_GP_Micro_Struct) over a grid of
+# lengthscales and thresholds, in parallel processes. Each (lengthscale, threshold) is one np.uint8 .npy array
+# of shape (number of images, grid_size, grid_size) with a .json index entry next to it, and only a sampled
+# fraction of the images is plotted.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python -m control_chart.micro_struct_store --store_dir /path/to/store build --grid_size 512 --num_per_param 200 \
+#       --lengthscales 5,10,20 --thresholds 0.3,0.5 --lat_func binary --n_jobs 4 --plot_frac 0.01
+#   python -m control_chart.micro_struct_store --store_dir /path/to/store list
+import numpy as np
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+
+from PIL import Image
+from joblib import Parallel, delayed, parallel_backend
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from control_chart.gp_sampler import Grid_RBF_GP_Sampler, Grayscale_Latent_Func, Binary_Latent_Func, \
+    Binary_Rand_Latent_Func, ax_plot, ax_plot_3d
+from constants import *
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('micro_struct_store')
+logging.getLogger('micro_struct_store').setLevel(logging.INFO)
+
+DICT_LAT_FUNCS = {'grayscale': Grayscale_Latent_Func, 'binary': Binary_Latent_Func, 'binary_rand': Binary_Rand_Latent_Func}
+
+# The samplers of the process by their parameters, since the factorization of the kernel is shared by
+# all thresholds of a lengthscale.
+_dict_samplers = {}
+
+
+class Micro_Struct_Store(object):
+    """A folder of microstructure images, one np.uint8 .npy array of shape (number of images, grid_size, grid_size)
+        per (lengthscale index, threshold index), with a .json index entry of its parameters next to it.
+
+        Each entry is written to a temporary file and renamed, and has its own index file, so that parallel
+        workers can fill different entries of the same store. It is pickled by its folder only.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def __getstate__(self):
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.store_dir = state['store_dir']
+
+    @staticmethod
+    def key(ls_idx, thre_idx):
+        return '_'.join(['gp', str(ls_idx), str(thre_idx)])
+
+    def keys(self):
+        """All complete entries. Partially written entries (without index file) are ignored."""
+        return sorted(fname[:-len('.json')] for fname in os.listdir(self.store_dir) if fname.endswith('.json'))
+
+    def index(self):
+        """The index entries (parameters, shape and volume fractions) of all entries by key."""
+        dict_index = {}
+        for key in self.keys():
+            with open(os.path.join(self.store_dir, key+'.json'), 'r') as f:
+                dict_index[key] = json.load(f)
+        return dict_index
+
+    def has(self, ls_idx, thre_idx):
+        return os.path.isfile(os.path.join(self.store_dir, self.key(ls_idx, thre_idx)+'.json'))
+
+    def meta(self, ls_idx, thre_idx):
+        """The index entry (parameters, shape and volume fractions) of the entry."""
+        with open(os.path.join(self.store_dir, self.key(ls_idx, thre_idx)+'.json'), 'r') as f:
+            return json.load(f)
+
+    def get(self, ls_idx, thre_idx):
+        """The memory-mapped images of the entry."""
+        if not self.has(ls_idx, thre_idx):
+            raise KeyError("No microstructure entry {} in {}.".format(self.key(ls_idx, thre_idx), self.store_dir))
+        return np.load(os.path.join(self.store_dir, self.key(ls_idx, thre_idx)+'.npy'), mmap_mode='r')
+
+    def open_entry(self, ls_idx, thre_idx, shape):
+        """A temporary memory-mapped np.uint8 array to fill, made the entry by commit_entry."""
+        tmp_path = os.path.join(self.store_dir, self.key(ls_idx, thre_idx)+'.tmp{}.npy'.format(os.getpid()))
+        return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+
+    def commit_entry(self, ls_idx, thre_idx, img_arrs, dict_meta):
+        key = self.key(ls_idx, thre_idx)
+        img_arrs.flush()
+        os.replace(img_arrs.filename, os.path.join(self.store_dir, key+'.npy'))
+        index_path = os.path.join(self.store_dir, key+'.json')
+        with open(index_path+'.tmp{}'.format(os.getpid()), 'w') as f:
+            json.dump(dict(dict_meta, shape=list(img_arrs.shape)), f, indent=2)
+        os.replace(index_path+'.tmp{}'.format(os.getpid()), index_path)
+
+
+def Get_GP_Sampler(dim, grid_size, lengthscale, opscale, noise):
+    """ The Grid_RBF_GP_Sampler of the parameters, made once per process. """
+    sampler_key = (dim, grid_size, tuple(np.broadcast_to(lengthscale, (dim,)).tolist()), opscale, noise)
+    if sampler_key not in _dict_samplers:
+        _dict_samplers[sampler_key] = Grid_RBF_GP_Sampler(dim, grid_size, lengthscale, opscale, noise)
+    return _dict_samplers[sampler_key]
+
+
+def GP_Micro_Struct_Params(lengthscale, thre, lat_func_name, grid_size, opscale, noise, rand_seed):
+    """ The parameters of an entry as stored in its index file. """
+    return {'lengthscale': np.broadcast_to(lengthscale, (2,)).tolist(), 'thre': thre, 'lat_func': lat_func_name,
+            'opscale': opscale, 'noise': noise, 'grid_size': grid_size, 'rand_seed': rand_seed}
+
+
+def Gen_Save_GP_Micro_Struct_Entry(store, ls_idx, thre_idx, lengthscale, thre, lat_func_name, num_images, grid_size,
+                                   opscale, noise, rand_seed, plot_frac=0.0, plot_3d=False, batch_size=MICRO_STRUCT_BATCH_SIZE):
+    """ Generate num_images microstructures of one (lengthscale, threshold) into the store entry (ls_idx, thre_idx).
+
+        The GP fields are sampled batch_size at a time. The random state of the entry is seeded by
+        (rand_seed, ls_idx, thre_idx), so the entries are independent and reproducible in any process.
+        Each image is plotted (the GP field and the PNG of the microstructure, and the 3D surface if plot_3d)
+        with probability plot_frac, under the folder 'plots' of the store.
+
+        Returns:
+            The key of the entry and the time taken.
+    """
+    start_time = time.time()
+    rand_state = np.random.RandomState([rand_seed, ls_idx, thre_idx])
+    # Binary_Rand_Latent_Func draws from np.random.
+    np.random.seed(rand_state.randint(2**31))
+    sampler = Get_GP_Sampler(2, grid_size, lengthscale, opscale, noise)
+    lat_func = DICT_LAT_FUNCS[lat_func_name]
+    lat_func_kwargs = {} if thre is None else {'thre': thre}
+    plot_idx = set(np.flatnonzero(rand_state.random_sample(num_images) < plot_frac).tolist())
+    plot_folder = os.path.join(store.store_dir, 'plots')
+    if plot_idx and not os.path.exists(plot_folder):
+        os.makedirs(plot_folder, exist_ok=True)
+
+    img_arrs = store.open_entry(ls_idx, thre_idx, (num_images, grid_size, grid_size))
+    for bs in range(0, num_images, batch_size):
+        rfields = sampler.sample(min(batch_size, num_images-bs), rand_state)
+        for img_idx, rfield in enumerate(rfields, bs):
+            img_arrs[img_idx] = lat_func(rfield.copy(), **lat_func_kwargs)
+            if img_idx in plot_idx:
+                postfix = '_'.join([store.key(ls_idx, thre_idx), str(img_idx)])
+                ax_plot(rfield, "One realization of GP param_"+postfix, os.path.join(plot_folder, "one_gp_obse_{}.png".format(postfix,)))
+                if plot_3d:
+                    ax_plot_3d(grid_size, rfield, "One realization of GP (3D) param_"+postfix,
+                               os.path.join(plot_folder, "one_gp_obse_3d_{}.png".format(postfix,)))
+                plt.close('all')
+                Image.fromarray(np.array(img_arrs[img_idx])).save(os.path.join(plot_folder, "one_gp_obse_micro_struct_{}.png".format(postfix,)))
+
+    vol_fracs = np.mean(img_arrs.reshape((num_images, -1)) == 255, axis=1)
+    dict_meta = dict(GP_Micro_Struct_Params(lengthscale, thre, lat_func_name, grid_size, opscale, noise, rand_seed),
+                     vol_frac=vol_fracs.tolist())
+    store.commit_entry(ls_idx, thre_idx, img_arrs, dict_meta)
+    return store.key(ls_idx, thre_idx), time.time()-start_time
+
+
+def Build_GP_Micro_Struct_Dataset(store_dir, num_per_param, grid_size, ls_lengthscales, ls_thres, lat_func_name='binary',
+                                  opscale=1.0, noise=0.0, rand_seed=0, n_jobs=N_JOBS, plot_frac=0.0, plot_3d=False, overwrite=False):
+    """ Generate num_per_param microstructures for each pair of lengthscale and threshold in parallel processes.
+
+        Args:
+            store_dir: The folder of the Micro_Struct_Store.
+            num_per_param: The number of images of each (lengthscale, threshold).
+            grid_size: The number of pixels along each axis.
+            ls_lengthscales: The lengthscales, each a number or one value per axis.
+            ls_thres: The thresholds of the binary latent functions (ignored by 'grayscale').
+            lat_func_name: 'grayscale', 'binary' or 'binary_rand'.
+            opscale, noise: See Gen_GP_Latent_Func.
+            rand_seed: The seed of the dataset.
+            n_jobs: The number of processes.
+            plot_frac: The fraction of the images plotted.
+            plot_3d: Whether the 3D surfaces of the plotted images are also plotted.
+            overwrite: Whether regenerate the entries already in the store.
+
+        Returns:
+            The Micro_Struct_Store.
+
+        Raises:
+            ValueError: An entry already in the store was generated with other parameters and overwrite is False.
+    """
+    if lat_func_name not in DICT_LAT_FUNCS:
+        raise ValueError("Unknown latent function: {}.".format(lat_func_name))
+    if lat_func_name == 'grayscale':
+        ls_thres = [None]
+    store = Micro_Struct_Store(store_dir)
+    all_tasks = []
+    for (ls_idx, lengthscale), (thre_idx, thre) in itertools.product(enumerate(ls_lengthscales), enumerate(ls_thres)):
+        if not overwrite and store.has(ls_idx, thre_idx):
+            # The entries are keyed by their indices, so an entry of other parameters is stale and is not reused.
+            dict_meta = store.meta(ls_idx, thre_idx)
+            dict_params = dict(GP_Micro_Struct_Params(lengthscale, thre, lat_func_name, grid_size, opscale, noise, rand_seed),
+                               num_per_param=num_per_param)
+            dict_stored = dict({name: dict_meta.get(name) for name in dict_params}, num_per_param=dict_meta['shape'][0])
+            ls_diff = [name for name in dict_params if dict_params[name] != dict_stored[name]]
+            if ls_diff:
+                raise ValueError("The entry {} in {} was generated with other parameters ({}), set overwrite or use another store.".format(
+                    store.key(ls_idx, thre_idx), store_dir, ', '.join("{} {} != {}".format(name, dict_stored[name], dict_params[name]) for name in ls_diff)))
+            continue
+        all_tasks.append((store, ls_idx, thre_idx, lengthscale, thre, lat_func_name, num_per_param, grid_size, opscale, noise,
+                          rand_seed, plot_frac, plot_3d))
+    logger.info("Generate %s entries of %s images of size %s in %s.", len(all_tasks), num_per_param, grid_size, store_dir, extra=d)
+
+    start_time = time.time()
+    # The tasks of one lengthscale are next to each other, so a process mostly reuses its sampler.
+    with parallel_backend('loky', n_jobs=n_jobs):
+        res = Parallel(verbose=10)(delayed(Gen_Save_GP_Micro_Struct_Entry)(*task) for task in all_tasks)
+    for key, run_time in res:
+        logger.info("Entry %s takes time %s.", key, run_time, extra=d)
+    logger.info("The %s images take time %s.", len(all_tasks)*num_per_param, time.time()-start_time, extra=d)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build and inspect datasets of synthetic GP microstructures.")
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        required=True,
+        help="The folder of the store.")
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help="Generate the microstructures into the store.")
+    build_parser.add_argument(
+        "--num_per_param",
+        type=int,
+        default=100,
+        help="The number of images of each pair of lengthscale and threshold.")
+    build_parser.add_argument(
+        "--grid_size",
+        type=int,
+        default=256,
+        help="The number of pixels along each axis.")
+    build_parser.add_argument(
+        "--lengthscales",
+        type=str,
+        default="5,10,20",
+        help="The lengthscales separated by comma.")
+    build_parser.add_argument(
+        "--thresholds",
+        type=str,
+        default="0.5",
+        help="The thresholds of the binary latent functions separated by comma.")
+    build_parser.add_argument(
+        "--lat_func",
+        type=str,
+        default="binary",
+        help="The latent function: grayscale, binary or binary_rand.")
+    build_parser.add_argument(
+        "--opscale",
+        type=float,
+        default=1.0,
+        help="The outputscale of the kernel.")
+    build_parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.0,
+        help="The variance of the white noise added to the GP field.")
+    build_parser.add_argument(
+        "--rand_seed",
+        type=int,
+        default=0,
+        help="The random seed.")
+    build_parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=N_JOBS,
+        help="The number of processes.")
+    build_parser.add_argument(
+        "--plot_frac",
+        type=float,
+        default=0.0,
+        help="The fraction of images plotted.")
+    build_parser.add_argument(
+        "--plot_3d",
+        type=int,
+        default=0,
+        help="Whether also plot the 3D surface of the plotted images.")
+    build_parser.add_argument(
+        "--overwrite",
+        type=int,
+        default=0,
+        help="Whether regenerate the entries already in the store (needed when the parameters changed).")
+    subparsers.add_parser('list', help="List the entries.")
+    FLAGS = parser.parse_args()
+
+    if FLAGS.command == 'build':
+        store = Build_GP_Micro_Struct_Dataset(
+            FLAGS.store_dir, FLAGS.num_per_param, FLAGS.grid_size, [float(ls) for ls in FLAGS.lengthscales.split(',')],
+            [float(thre) for thre in FLAGS.thresholds.split(',')], FLAGS.lat_func, FLAGS.opscale, FLAGS.noise,
+            FLAGS.rand_seed, FLAGS.n_jobs, FLAGS.plot_frac, bool(FLAGS.plot_3d), bool(FLAGS.overwrite))
+    else:
+        store = Micro_Struct_Store(FLAGS.store_dir)
+    for key, entry in store.index().items():
+        print("{:12s}  lengthscale {}  threshold {}  shape {}  mean volume fraction {:.4f}".format(
+            key, entry['lengthscale'], entry['thre'], tuple(entry['shape']), np.mean(entry['vol_frac'])))
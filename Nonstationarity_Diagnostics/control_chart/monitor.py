@@ -0,0 +1,113 @@
+import numpy as np
+import logging
+import time
+
+from constants import *
+from control_chart.utils import *
+from control_chart.data_generation import Generate_Materials_Data
+from control_chart.hotelling import ScoresSpatialEWMA
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('monitor')
+logging.getLogger('monitor').setLevel(logging.INFO)
+
+
+class Spatial_EWMA_T2_Monitor(object):
+    """ A long-lived prospective control chart of spatial EWMA-T2 of scores and spatial EWMA of deviance.
+
+        It is fitted once on Phase-I images: the image scaler, the score mean and inverse covariance (from the
+        fitted regressor, FLAGS.mu_train and FLAGS.Sinv_train), the whitening factor and the control limits.
+        After that, Phase-II images are monitored one at a time with monitor(), which only does the work for the new
+        image, so the latency per image is bounded by the image size, not by the number of images seen so far.
+        The control limits are the same as in PlotSaveSpatial2D3DHeatMap_Other_Score_Multi_Img_Prosp: the
+        alarm_level percentile of the Phase-I spatial EWMA-T2, and the two-sided percentiles of the Phase-I
+        spatial EWMA of deviance.
+    """
+    def __init__(self, reg_model, FLAGS, ewma_sigma, ewma_wind_len, alarm_level=99, img_norm='PI'):
+        """
+            Args:
+                reg_model: A fitted Linear_Reg or Nnet_Reg. Its FLAGS.mu_train and FLAGS.Sinv_train are used.
+                img_norm: 'PI' standardizes all images with the mean and std of the Phase-I images, so that
+                          changes of brightness are monitored as well; 'self' standardizes each image by itself
+                          as in simulation_real_img_reg_retro.
+        """
+        self.reg_model = reg_model
+        self.FLAGS = FLAGS
+        self.ewma_sigma = ewma_sigma
+        self.ewma_wind_len = ewma_wind_len
+        self.alarm_level = alarm_level
+        self.img_norm = img_norm
+        self.mu_train = np.asarray(reg_model.FLAGS.mu_train, dtype=np.float64)
+        self.Sinv_train = reg_model.FLAGS.Sinv_train
+        self.whiten_factor = Whiten_Factor(self.Sinv_train)
+        self.fitted = False
+        self.num_img_PII = 0
+        self.num_alarm_img_PII = 0
+
+    def standardize(self, img_arr):
+        img_arr = np.asarray(img_arr, dtype=np.float32)
+        if self.img_norm == 'PI':
+            return (img_arr-self.img_mean)/self.img_std
+        return (img_arr-np.mean(img_arr))/np.std(img_arr)
+
+    def spatial_ewma_stats(self, img_arr):
+        """ The spatial EWMA-T2 of scores and the spatial EWMA of deviance of one standardized image.
+
+            Only the scores and deviances of the image are calculated (cal_grads_dev); the T2 uses the whitening
+            factor of the training score covariance computed once in __init__.
+        """
+        X, y, n_hei, n_wid = Generate_Materials_Data(img_arr, self.FLAGS)
+        grads, dev = self.reg_model.cal_grads_dev(X, y)
+        score_spatial_ewma_arr = ScoresSpatialEWMA(-grads, n_hei, n_wid, self.ewma_sigma, self.ewma_wind_len)
+        t2_arr = HotellingT2Batch(score_spatial_ewma_arr, self.mu_train, self.Sinv_train, dtype=np.float64, whiten_factor=self.whiten_factor)
+        dev_spatial_ewma_arr = ScoresSpatialEWMA(dev[:, np.newaxis], n_hei, n_wid, self.ewma_sigma, self.ewma_wind_len).squeeze(axis=-1)
+        return t2_arr, dev_spatial_ewma_arr
+
+    def alarm_maps(self, t2_arr, dev_arr):
+        t2_alarm_arr = t2_arr > self.ucl_t2
+        dev_alarm_arr = np.logical_or(dev_arr > self.ucl_dev, dev_arr < self.lcl_dev)
+        return t2_alarm_arr, dev_alarm_arr, np.logical_or(t2_alarm_arr, dev_alarm_arr)
+
+    def fit(self, ls_img_arr_PI):
+        """ Set the image scaler and the control limits from the Phase-I images. """
+        ls_img_arr_PI = [np.asarray(img_arr, dtype=np.float32) for img_arr in ls_img_arr_PI]
+        self.img_mean = np.mean([np.mean(img_arr) for img_arr in ls_img_arr_PI])
+        self.img_std = np.sqrt(np.mean([np.mean((img_arr-self.img_mean)**2) for img_arr in ls_img_arr_PI]))
+        ls_stats_PI = [self.spatial_ewma_stats(self.standardize(img_arr)) for img_arr in ls_img_arr_PI]
+        arr_t2_PI = np.concatenate([t2_arr.reshape(-1) for t2_arr, _ in ls_stats_PI])
+        arr_dev_PI = np.concatenate([dev_arr.reshape(-1) for _, dev_arr in ls_stats_PI])
+        self.ucl_t2 = np.percentile(arr_t2_PI, self.alarm_level)
+        self.lcl_dev, self.ucl_dev = np.percentile(arr_dev_PI, [(100-self.alarm_level)/2, (100+self.alarm_level)/2])
+        # An image is alarmed if its ratio of alarmed pixels is more than that of any Phase-I image.
+        self.max_alarm_ratio_PI = max([np.mean(self.alarm_maps(t2_arr, dev_arr)[-1]) for t2_arr, dev_arr in ls_stats_PI])
+        self.fitted = True
+        logger.info("The monitor is fitted on %s Phase-I images: T2 UCL %s, deviance control limits (%s, %s).",
+                    len(ls_img_arr_PI), self.ucl_t2, self.lcl_dev, self.ucl_dev, extra=d)
+        return self
+
+    def monitor(self, img_arr):
+        """ Monitor one Phase-II image.
+
+            Returns:
+                A dict with the spatial EWMA-T2 map ('t2'), the spatial EWMA of deviance ('dev'), their alarm maps
+                ('t2_alarm', 'dev_alarm' and 'alarm' for either), the ratio of alarmed pixels, whether the image is
+                alarmed and the latency in seconds.
+        """
+        if not self.fitted:
+            raise RuntimeError("The monitor should be fitted on Phase-I images first.")
+        start_time = time.time()
+        t2_arr, dev_arr = self.spatial_ewma_stats(self.standardize(img_arr))
+        t2_alarm_arr, dev_alarm_arr, alarm_arr = self.alarm_maps(t2_arr, dev_arr)
+        res = {'t2': t2_arr, 'dev': dev_arr, 't2_alarm': t2_alarm_arr, 'dev_alarm': dev_alarm_arr, 'alarm': alarm_arr,
+               'alarm_ratio': float(np.mean(alarm_arr)), 'latency': time.time()-start_time}
+        self.num_img_PII += 1
+        res['img_alarm'] = bool(res['alarm_ratio'] > self.max_alarm_ratio_PI)
+        self.num_alarm_img_PII += int(res['img_alarm'])
+        return res
+
+    def stats(self):
+        return {'num_img_PII': self.num_img_PII, 'num_alarm_img_PII': self.num_alarm_img_PII, 'ucl_t2': float(self.ucl_t2),
+                'lcl_dev': float(self.lcl_dev), 'ucl_dev': float(self.ucl_dev), 'max_alarm_ratio_PI': float(self.max_alarm_ratio_PI),
+                'alarm_level': self.alarm_level}
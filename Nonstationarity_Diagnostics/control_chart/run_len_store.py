@@ -0,0 +1,200 @@
+# A binary store of the simulated EWMA paths used to search control limits (Find_Ctrl_Lmt_Same_MRL0,
+# Find_Ctrl_Lmt_Same_RL0 and Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0), in place of the per-replicate and
+# aggregated .csv files. Each (tag, phase, change factor index, gamma index) is one .npy array with one row per
+# replicate, which is memory-mapped, so the bisection of the alarm level never parses text.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python -m control_chart.run_len_store --store_dir /path/to/store convert --raw_data_folder /path/to/csv [--remove_csv 1]
+#   python -m control_chart.run_len_store --store_dir /path/to/store list
+import numpy as np
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from constants import *
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('run_len_store')
+logging.getLogger('run_len_store').setLevel(logging.INFO)
+
+# {row_idx}_{ch_idx}_{ga_idx}_{ch_f}_ewma_{tag}_{ph}.csv, one replicate (see Save_EWMA_Data).
+REPLICATE_FNAME_PATTERN = re.compile(r'^(\d+)_(\d+)_(\d+)_(.+?)_ewma_(.+)_(PI|PII)\.csv$')
+# {tag}_{ph}_ewma_{ch_idx}_{ga_idx}_{ch_f}.csv, all replicates (see Agg_Save_EWMA_Sim_One_File).
+AGG_FNAME_PATTERN = re.compile(r'^(.+)_(PI|PII)_ewma_(\d+)_(\d+)_(.+)\.csv$')
+
+
+def EWMA_Replicate_Fname(row_idx, tag, ph, ch_idx, ga_idx, ch_f):
+    return '_'.join([str(row_idx), str(ch_idx), str(ga_idx), str(ch_f).replace(".", "_"), 'ewma', tag, ph]) + '.csv'
+
+
+def EWMA_Agg_Fname(tag, ph, ch_idx, ga_idx, ch_f):
+    return '_'.join([tag, ph, 'ewma', str(ch_idx), str(ga_idx), str(ch_f).replace(".", "_")]) + '.csv'
+
+
+class EWMA_Sim_Store(object):
+    """A folder of simulated EWMA paths, one .npy array of shape (number of replicates, path length) per
+        (tag, ph, ch_idx, ga_idx), with a .json index entry next to it.
+
+        Each entry is written to a temporary file and renamed, and has its own index file, so that parallel
+        workers can fill different entries of the same store. The store is pickled by its folder only, so it
+        can be passed to loky workers, which map the arrays again.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.dict_arrays = {}
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def __getstate__(self):
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.store_dir = state['store_dir']
+        self.dict_arrays = {}
+
+    @staticmethod
+    def key(tag, ph, ch_idx, ga_idx):
+        return '_'.join([tag, ph, str(ch_idx), str(ga_idx)])
+
+    def keys(self):
+        """All complete entries. Partially written entries (without index file) are ignored."""
+        return sorted(fname[:-len('.json')] for fname in os.listdir(self.store_dir) if fname.endswith('.json'))
+
+    def index(self):
+        """The index entries (tag, ph, ch_idx, ga_idx, ch_f, shape) of all entries by key."""
+        dict_index = {}
+        for key in self.keys():
+            with open(os.path.join(self.store_dir, key+'.json'), 'r') as f:
+                dict_index[key] = json.load(f)
+        return dict_index
+
+    def has(self, tag, ph, ch_idx, ga_idx):
+        return os.path.isfile(os.path.join(self.store_dir, self.key(tag, ph, ch_idx, ga_idx)+'.json'))
+
+    def get(self, tag, ph, ch_idx, ga_idx):
+        """The memory-mapped array of all replicates of the entry (opened once per process)."""
+        key = self.key(tag, ph, ch_idx, ga_idx)
+        if key not in self.dict_arrays:
+            if not self.has(tag, ph, ch_idx, ga_idx):
+                raise KeyError("No EWMA entry {} in {}.".format(key, self.store_dir))
+            self.dict_arrays[key] = np.load(os.path.join(self.store_dir, key+'.npy'), mmap_mode='r')
+        return self.dict_arrays[key]
+
+    def put(self, tag, ph, ch_idx, ga_idx, ch_f, arr):
+        """Store arr (one row per replicate) as the entry, replacing any previous one."""
+        key = self.key(tag, ph, ch_idx, ga_idx)
+        arr = np.atleast_2d(np.asarray(arr, dtype=np.float64))
+        self.dict_arrays.pop(key, None)
+        tmp_path = os.path.join(self.store_dir, key+'.tmp{}.npy'.format(os.getpid()))
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, os.path.join(self.store_dir, key+'.npy'))
+        index_path = os.path.join(self.store_dir, key+'.json')
+        with open(index_path+'.tmp{}'.format(os.getpid()), 'w') as f:
+            json.dump({'tag': tag, 'ph': ph, 'ch_idx': int(ch_idx), 'ga_idx': int(ga_idx),
+                       'ch_f': str(ch_f).replace(".", "_"), 'shape': list(arr.shape)}, f, indent=2)
+        os.replace(index_path+'.tmp{}'.format(os.getpid()), index_path)
+        logger.info("EWMA store: %s with shape %s.", key, arr.shape, extra=d)
+
+
+def Read_EWMA_Replicate(raw_data_folder, tag, ph, ch_idx, ga_idx, ch_f, row_idx, store=None):
+    """One replicate of the EWMA path, from the store if given and otherwise from its .csv file."""
+    if store is not None:
+        return np.asarray(store.get(tag, ph, ch_idx, ga_idx)[row_idx])
+    return np.genfromtxt(os.path.join(raw_data_folder, EWMA_Replicate_Fname(row_idx, tag, ph, ch_idx, ga_idx, ch_f)))
+
+
+def Read_EWMA_Replicates(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, ch_f, store=None):
+    """The first raw_data_size replicates of the EWMA path as a 2D array (one per row), from the store if given and
+        otherwise from the per-replicate .csv files, each read once.
+    """
+    if store is not None:
+        return np.asarray(store.get(tag, ph, ch_idx, ga_idx)[:raw_data_size], dtype=np.float64)
+    return np.vstack([np.reshape(Read_EWMA_Replicate(raw_data_folder, tag, ph, ch_idx, ga_idx, ch_f, row_idx), (1,-1))
+                      for row_idx in range(raw_data_size)])
+
+
+def Read_EWMA_Agg(raw_data_folder, tag, ph, ch_idx, ga_idx, ch_f, store=None):
+    """All replicates of the EWMA path (one per row), from the store if given and otherwise from the aggregated .csv file."""
+    if store is not None:
+        return store.get(tag, ph, ch_idx, ga_idx)
+    return np.genfromtxt(os.path.join(raw_data_folder, EWMA_Agg_Fname(tag, ph, ch_idx, ga_idx, ch_f)), delimiter=',')
+
+
+def Convert_EWMA_CSV_Folder(raw_data_folder, store_dir=None, remove_csv=False):
+    """Pack the per-replicate and aggregated EWMA .csv files of raw_data_folder into an EWMA_Sim_Store.
+
+        Each .csv file is parsed once. The replicates of one entry should be numbered from 0 without gaps, as the
+        search routines index them by row. If both kinds of files exist for an entry, the aggregated one is used.
+
+        Returns:
+            The EWMA_Sim_Store (in raw_data_folder/EWMA_STORE_FOLDER by default).
+    """
+    store = EWMA_Sim_Store(os.path.join(raw_data_folder, EWMA_STORE_FOLDER) if store_dir is None else store_dir)
+    dict_replicates, dict_aggs = {}, {}
+    for fname in sorted(os.listdir(raw_data_folder)):
+        match = REPLICATE_FNAME_PATTERN.match(fname)
+        if match:
+            row_idx, ch_idx, ga_idx, ch_f, tag, ph = match.groups()
+            dict_replicates.setdefault((tag, ph, int(ch_idx), int(ga_idx), ch_f), {})[int(row_idx)] = fname
+            continue
+        match = AGG_FNAME_PATTERN.match(fname)
+        if match:
+            tag, ph, ch_idx, ga_idx, ch_f = match.groups()
+            dict_aggs[(tag, ph, int(ch_idx), int(ga_idx), ch_f)] = fname
+
+    ls_read_fnames = []
+    for (tag, ph, ch_idx, ga_idx, ch_f), fname in dict_aggs.items():
+        store.put(tag, ph, ch_idx, ga_idx, ch_f, np.genfromtxt(os.path.join(raw_data_folder, fname), delimiter=','))
+        ls_read_fnames.append(fname)
+    for (tag, ph, ch_idx, ga_idx, ch_f), dict_fnames in dict_replicates.items():
+        if (tag, ph, ch_idx, ga_idx, ch_f) in dict_aggs:
+            continue
+        if sorted(dict_fnames) != list(range(len(dict_fnames))):
+            raise ValueError("The replicates of {} are not numbered from 0 without gaps.".format(store.key(tag, ph, ch_idx, ga_idx)))
+        ls_rows = [np.reshape(np.genfromtxt(os.path.join(raw_data_folder, dict_fnames[row_idx])), (-1,)) for row_idx in range(len(dict_fnames))]
+        if len(set(row.shape[0] for row in ls_rows)) > 1:
+            raise ValueError("The replicates of {} have different lengths.".format(store.key(tag, ph, ch_idx, ga_idx)))
+        store.put(tag, ph, ch_idx, ga_idx, ch_f, np.vstack(ls_rows))
+        ls_read_fnames.extend(dict_fnames.values())
+    logger.info("Converted %s .csv files into %s entries of %s.", len(ls_read_fnames), len(store.keys()), store.store_dir, extra=d)
+
+    if remove_csv:
+        for fname in ls_read_fnames:
+            os.remove(os.path.join(raw_data_folder, fname))
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert and inspect the binary store of simulated EWMA paths.")
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default="",
+        help="The folder of the store. Empty means raw_data_folder/{} when converting.".format(EWMA_STORE_FOLDER))
+    subparsers = parser.add_subparsers(dest='command')
+    convert_parser = subparsers.add_parser('convert', help="Pack the EWMA .csv files of a folder into the store.")
+    convert_parser.add_argument(
+        "--raw_data_folder",
+        type=str,
+        required=True,
+        help="The folder of the per-replicate or aggregated EWMA .csv files.")
+    convert_parser.add_argument(
+        "--remove_csv",
+        type=int,
+        default=0,
+        help="Whether remove the .csv files after conversion.")
+    subparsers.add_parser('list', help="List the entries.")
+    FLAGS = parser.parse_args()
+
+    if FLAGS.command == 'convert':
+        store = Convert_EWMA_CSV_Folder(FLAGS.raw_data_folder, store_dir=FLAGS.store_dir or None, remove_csv=bool(FLAGS.remove_csv))
+    else:
+        store = EWMA_Sim_Store(FLAGS.store_dir)
+    for key, entry in store.index().items():
+        print("{:40s}  change factor {:>6s}  shape {}".format(key, entry['ch_f'], tuple(entry['shape'])))
@@ -0,0 +1,176 @@
+import numpy as np
+import os
+import logging
+import time
+import resource
+
+from constants import *
+from control_chart.utils import *
+from control_chart.data_generation import Generate_Materials_Data
+from control_chart.hotelling import ScoresSpatialEWMAConv, PlotSaveSpatialHeatMap
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('tiled_retro')
+logging.getLogger('tiled_retro').setLevel(logging.INFO)
+
+
+def Peak_RSS_MB():
+    """ The peak resident set size of this process in MB (ru_maxrss is in KB on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+
+def Current_RSS_MB():
+    """ The current resident set size of this process in MB (from /proc/self/statm, else the peak RSS). """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()/2**20
+    except (OSError, IndexError, ValueError):
+        return Peak_RSS_MB()
+
+
+def Image_Mean_Std_Chunked(img_arr, chunk_rows=TILED_CHUNK_ROWS):
+    """ The mean and std of a (memory-mapped) image, reading chunk_rows rows at a time. """
+    num, sum_val, sum_sq = 0, 0.0, 0.0
+    for rs in range(0, img_arr.shape[0], chunk_rows):
+        chunk = np.asarray(img_arr[rs:rs+chunk_rows], dtype=np.float64)
+        num, sum_val, sum_sq = num+chunk.size, sum_val+np.sum(chunk), sum_sq+np.sum(chunk**2)
+    mean = sum_val/num
+    return mean, np.sqrt(max(sum_sq/num-mean**2, 0))
+
+
+def Tile_Ranges(n_pix, tile_size):
+    """ The (start, end) of the tiles along one axis. The tiles do not overlap; the halos are added by the callers. """
+    return [(start, min(start+tile_size, n_pix)) for start in range(0, n_pix, tile_size)]
+
+
+def Tile_Size_For_Mem_Budget(max_mem_mb, x_dim, score_dim, halo):
+    """ The side of square tiles whose working arrays fit in max_mem_mb.
+
+        A score tile of side t needs the design matrix X (x_dim), y, the gradients and the scores (score_dim each)
+        for (t+halo)^2 pixels in float64, and the EWMA of a T2 tile needs a few score_dim arrays of the same size.
+    A budget too small for any tile (with its halo) is clamped to tiles of 1 pixel, with a warning.
+    """
+    if max_mem_mb <= 0:
+        raise ValueError("The memory budget for the tiles is {:.1f} MB. Raise --tile_max_rss_mb above the memory already "
+                         "in use, or set --tile_size.".format(max_mem_mb))
+    bytes_per_pix = 8*(x_dim+1+3*score_dim)
+    tile_side = int(np.sqrt(max_mem_mb*2**20/bytes_per_pix))-halo
+    if tile_side < 1:
+        logger.warning("The memory budget %.1f MB is too small for the halo of %s pixels. The tiles are clamped to 1 pixel.",
+                       max_mem_mb, halo, extra=d)
+        tile_side = 1
+    return tile_side
+
+
+def Tiled_Scores(img_arr, img_mean, img_std, reg_model, FLAGS, scores_path, tile_size, dtype=np.float64):
+    """ The scores of all pixels of a (memory-mapped) image, computed tile by tile into a memory-mapped array.
+
+        The score tile [r0:r1, c0:c1] (in the coordinates of the pixels having full neighborhood windows) only
+        depends on the image rows r0 to r1+2*wind_hei and columns c0 to c1+2*wind_wid, so each tile reads its
+        image with this halo, builds its own design matrix and streams it through the fitted regressor.
+        Each score is computed once and is the same as from the whole image.
+
+        Returns:
+            scores: np.memmap of shape (n_hei, n_wid, score_dim) stored at scores_path.
+    """
+    img_hei, img_wid = img_arr.shape
+    halo_hei, halo_wid = 2*FLAGS.wind_hei, 2*FLAGS.wind_wid
+    n_hei, n_wid = img_hei-halo_hei, img_wid-halo_wid
+    scores = None
+    start_time = time.time()
+    ls_row_ranges, ls_col_ranges = Tile_Ranges(n_hei, tile_size), Tile_Ranges(n_wid, tile_size)
+    for r0, r1 in ls_row_ranges:
+        for c0, c1 in ls_col_ranges:
+            img_tile = (np.asarray(img_arr[r0:r1+halo_hei, c0:c1+halo_wid], dtype=np.float32)-img_mean)/img_std
+            X, y, _, _ = Generate_Materials_Data(img_tile, FLAGS)
+            score_tile = -reg_model.cal_grads(X, y)
+            if scores is None:
+                scores = np.lib.format.open_memmap(scores_path, mode='w+', dtype=dtype, shape=(n_hei, n_wid, score_tile.shape[-1]))
+            scores[r0:r1, c0:c1] = score_tile.reshape((r1-r0, c1-c0, -1))
+        logger.info("The scores of rows %s to %s of %s are done in %.1fs. The peak RSS is %.1f MB.",
+                    r0, r1, n_hei, time.time()-start_time, Peak_RSS_MB(), extra=d)
+    scores.flush()
+    return scores
+
+
+def Score_Mean_Cov_Chunked(scores, chunk_rows=TILED_CHUNK_ROWS):
+    """ The mean and covariance (normalized by N, as in Inv_Cov) of (memory-mapped) scores of shape (n_hei, n_wid, score_dim),
+        in one pass reading chunk_rows rows at a time. The sums are of the scores shifted by the mean of the first chunk,
+        which keeps the covariance from cancelling out.
+    """
+    score_dim = scores.shape[-1]
+    num, shift, sum_val, sum_sq = 0, None, np.zeros(score_dim), np.zeros((score_dim, score_dim))
+    for rs in range(0, scores.shape[0], chunk_rows):
+        chunk = np.asarray(scores[rs:rs+chunk_rows], dtype=np.float64).reshape((-1, score_dim))
+        if shift is None:
+            shift = chunk.mean(axis=0)
+        chunk = chunk-shift
+        num, sum_val, sum_sq = num+chunk.shape[0], sum_val+chunk.sum(axis=0), sum_sq+np.dot(chunk.T, chunk)
+    mean = sum_val/num
+    return shift+mean, sum_sq/num-np.outer(mean, mean)
+
+
+def Tiled_Spatial_EWMA_T2(scores, sigma, wind_len, mu_train, Sinv_train, t2_path, tile_size):
+    """ The spatial EWMA-T2 map of (memory-mapped) scores, computed tile by tile into a memory-mapped array.
+
+        The T2 tile [r0:r1, c0:c1] reads the scores with a halo of 2*wind_len, so that the EWMA windows of all its
+        pixels are complete, and gives the same values as ScoresSpatialEWMA and HotellingT2Batch on the whole map.
+
+        Returns:
+            t2: np.memmap of shape (n_hei-2*wind_len, n_wid-2*wind_len) stored at t2_path.
+    """
+    n_hei, n_wid, score_dim = scores.shape
+    t2_n_hei, t2_n_wid = n_hei-2*wind_len, n_wid-2*wind_len
+    t2 = np.lib.format.open_memmap(t2_path, mode='w+', dtype=np.float32, shape=(t2_n_hei, t2_n_wid))
+    whiten_factor = Whiten_Factor(Sinv_train)
+    for r0, r1 in Tile_Ranges(t2_n_hei, tile_size):
+        for c0, c1 in Tile_Ranges(t2_n_wid, tile_size):
+            score_tile = np.asarray(scores[r0:r1+2*wind_len, c0:c1+2*wind_len])
+            ewma_tile = ScoresSpatialEWMAConv(score_tile, score_tile.shape[0], score_tile.shape[1], sigma, wind_len)
+            t2[r0:r1, c0:c1] = HotellingT2Batch(ewma_tile, mu_train, Sinv_train, whiten_factor=whiten_factor)
+    t2.flush()
+    return t2
+
+
+def Tiled_Real_Img_Reg_Retro(img_arr, reg_model, FLAGS, img_mean=None, img_std=None, fig_name=''):
+    """ The out-of-core version of the scores and spatial EWMA-T2 map in simulation_real_img_reg_retro.
+
+        The image can be a np.memmap. Only one tile (with its halo) of the image, the design matrix and the scores
+        is in memory at a time; the scores and the T2 map are memory-mapped .npy files in FLAGS.training_res_folder.
+        The tile size is chosen from FLAGS.tile_max_rss_mb minus the memory in use when it is called, unless
+        FLAGS.tile_size is given. As in SpatialHotellingT2Retro, the T2 uses the mean and the inverse covariance
+        (with FLAGS.nugget) of the scores of the whole image, accumulated in one chunked pass over the scores.
+
+        Args:
+            reg_model: The fitted Linear_Reg or Nnet_Reg. FLAGS.mu_train should be set.
+            img_mean, img_std: The standardization of the image. If None, they are computed in chunks.
+
+        Returns:
+            scores, t2: The memory-mapped scores and T2 map.
+    """
+    if img_mean is None or img_std is None:
+        img_mean, img_std = Image_Mean_Std_Chunked(img_arr)
+    score_dim = np.size(FLAGS.mu_train)
+    x_dim = Generate_Materials_Data(np.zeros((2*FLAGS.wind_hei+1, 2*FLAGS.wind_wid+1), dtype=np.float32), FLAGS)[0].shape[1]
+    halo = max(2*FLAGS.wind_hei, 2*FLAGS.wind_wid, 2*FLAGS.spatial_ewma_wind_len)
+    if getattr(FLAGS, 'tile_size', 0) > 0:
+        tile_size = FLAGS.tile_size
+    else:
+        tile_size = Tile_Size_For_Mem_Budget(FLAGS.tile_max_rss_mb-Current_RSS_MB(), x_dim, score_dim, halo)
+    logger.info("Tiled retrospective analysis of an image of shape %s with tiles of %s pixels and halo %s.",
+                img_arr.shape, tile_size, halo, extra=d)
+
+    scores = Tiled_Scores(img_arr, img_mean, img_std, reg_model, FLAGS, os.path.join(FLAGS.training_res_folder, 'tiled_scores.npy'), tile_size)
+    score_mu, score_cov = Score_Mean_Cov_Chunked(scores)
+    Sinv = Inv_Mat_Rcond(score_cov, FLAGS.nugget)
+    t2 = Tiled_Spatial_EWMA_T2(scores, FLAGS.spatial_ewma_sigma, FLAGS.spatial_ewma_wind_len, score_mu, Sinv,
+                               os.path.join(FLAGS.training_res_folder, 'tiled_t2.npy'), tile_size)
+    logger.info("The tiled scores and T2 map are stored in %s. The peak RSS is %.1f MB.", FLAGS.training_res_folder, Peak_RSS_MB(), extra=d)
+
+    if fig_name:
+        # The heat map of a subsampled T2 map, since plotting gigapixels is neither possible nor useful.
+        step = max(1, int(np.ceil(max(t2.shape)/TILED_PLOT_MAX_PIX)))
+        PlotSaveSpatialHeatMap(np.asarray(t2[::step, ::step]), FLAGS.training_res_folder, fig_name)
+    return scores, t2
@@ -15,6 +15,7 @@ import math
 from datetime import datetime
 
 from scipy.sparse.linalg import eigsh, eigs
+from scipy.signal import lfilter
 from tensorflow.keras.constraints import max_norm
 from joblib import Parallel, delayed, parallel_backend
 
@@ -22,6 +23,7 @@ from sklearn.decomposition import PCA
 from sklearn.model_selection import KFold, StratifiedKFold
 # from control_chart.hotelling import EwmaT2PI, calEwmaT2StatisticsPI, calEwmaT2StatisticsPII, EwmaPI, calEwmaStatisticsPI, calEwmaStatisticsPII, calEwmaStatisticsHelper
 from constants import *
+from control_chart.run_len_store import EWMA_Sim_Store, EWMA_Replicate_Fname, Read_EWMA_Replicate, Read_EWMA_Replicates, Read_EWMA_Agg
 
 # Without putting this, the loss_val_ls[-1] is a tf.Tensor and cannot be evaluated at that place.
 # # tf.enable_eager_execution()
@@ -374,6 +376,15 @@ def Inv_Mat_Rcond(sym_mat, nugget=0, rcond=RCOND_NUM):
     return np.linalg.inv(sym_mat)
 
 
+def Inv_Mat_Rcond_Eigh(sym_mat, nugget=0, rcond=RCOND_NUM):
+    """ The same inverse as Inv_Mat_Rcond from a single eigen-decomposition, which also gives the condition number. """
+    eig_vals, eig_vecs = np.linalg.eigh(sym_mat)
+    nugget = max(nugget, np.max(np.abs(eig_vals))*rcond)
+    logger.info("The condition number is %s before and %s after adding the nugget %s.",
+                np.max(np.abs(eig_vals))/np.min(np.abs(eig_vals)), (np.max(eig_vals)+nugget)/(np.min(eig_vals)+nugget), nugget, extra=d)
+    return np.matmul(eig_vecs/(eig_vals+nugget), eig_vecs.T)
+
+
 def Inv_Cov(score_vecs, nugget=0, rcond=RCOND_NUM, wei=None):
     """ Invert covariance matrix of the score vectors. """
     if wei is None:
@@ -631,13 +642,19 @@ def grad_func_batch(
     """Calculate gradient vectors for a batch of dataset."""
     model, _ = gen_model_func(*gen_model_func_param)
     model.set_weights(kwargs['model_weights'])
-    hidden_layer_sizes = gen_model_func_param[0]
-    grad_func_kwargs = {}
-    for key, val in kwargs.items():
-        if key=='model_weights':
-            grad_func_kwargs['model'] = model
-        else:
-            grad_func_kwargs[key] = val
+    grad_func_kwargs = {key: val for key, val in kwargs.items() if key != 'model_weights'}
+    return grad_func_batch_model(X_batch, y_batch, model, gen_model_func_param[0], grad_func, wei_batch=wei_batch, **grad_func_kwargs)
+
+def grad_func_batch_model(
+        X_batch,
+        y_batch,
+        model,
+        hidden_layer_sizes,
+        grad_func,
+        wei_batch=None,
+        **grad_func_kwargs):
+    """Calculate gradient vectors for a batch of dataset with a model already built (e.g., resident in a worker)."""
+    grad_func_kwargs['model'] = model
     grads = []
     y_batch = np.vstack(y_batch)
     for i in range(X_batch.shape[0]):
@@ -784,18 +801,104 @@ def grad_func_batch_paral(
     _, ls_grads = zip(*res)
     return np.concatenate(ls_grads, axis=0)
 
+# The activation functions of Build_Model (as functions of the pre-activation z) and their derivatives.
+ACTI_FUNC = {
+    'sigmoid': lambda z: 1/(1+np.exp(-z)),
+    'tanh': np.tanh,
+    'relu': lambda z: np.maximum(z, 0),
+    'linear': lambda z: z,
+}
+ACTI_FUNC_GRAD = {
+    'sigmoid': lambda z, a: a*(1-a),
+    'tanh': lambda z, a: 1-a**2,
+    'relu': lambda z, a: (z>0).astype(z.dtype),
+    'linear': lambda z, a: np.ones_like(z),
+}
+
+
+def grad_func_batch_vec(
+        X_batch,
+        y_batch,
+        model_weights,
+        activation,
+        loss_name,
+        penal_param,
+        chunk_size=GRAD_CHUNK_SIZE):
+    """Calculate per-sample gradient vectors of obj_func for a model from Build_Model in batch.
+
+        This is the closed-form backpropagation of the dense network (hidden layers with activation
+        and a linear output layer) for all samples of a chunk at once. It gives the same gradient 
+        vectors (including the l2 penalization part) in the same order as grad_func_batch_paral 
+        with obj_grad: the weights and then biases of each layer, weights flattened row-by-row.
+
+        Args:
+            model_weights: model.get_weights(), i.e., [kernel_0, bias_0, kernel_1, bias_1, ...].
+            activation: The activation of hidden layers. One of the keys of ACTI_FUNC.
+            loss_name: 'reg' for loss_reg (squared error) or 'pois' for loss_pois (Poisson).
+            penal_param: The l2 penalization parameter on the kernels.
+            chunk_size: The number of samples whose gradients are calculated at a time.
+    """
+    kernels, biases = model_weights[0::2], model_weights[1::2]
+    num_param = np.sum([np.size(w) for w in model_weights])
+    # The gradient of 0.5*penal_param*sum(tf.nn.l2_loss(kernel)) is the same for all samples.
+    penal_grad = [0.5*penal_param*w for w in kernels]
+    y_batch = np.reshape(y_batch, (-1,))
+    grads = np.zeros((X_batch.shape[0], num_param))
+    for start in range(0, X_batch.shape[0], chunk_size):
+        X = np.asarray(X_batch[start:start+chunk_size], dtype=np.float64)
+        y = y_batch[start:start+chunk_size].astype(np.float64)
+        # Forward pass
+        ls_acti, ls_pre_acti = [X], []
+        for li, (w, b) in enumerate(zip(kernels, biases)):
+            z = np.matmul(ls_acti[-1], w)+b
+            ls_pre_acti.append(z)
+            if li < len(kernels)-1:
+                ls_acti.append(ACTI_FUNC[activation](z))
+        f = ls_pre_acti[-1]
+        # Derivative of the loss of each sample with respect to the output.
+        if loss_name == 'reg':
+            delta = 2*(f-y[:, np.newaxis])
+        elif loss_name == 'pois':
+            delta = np.exp(f)-y[:, np.newaxis]
+        else:
+            raise ValueError("Unknown loss: {}.".format(loss_name))
+        # Backward pass
+        ls_layer_grads = []
+        for li in range(len(kernels)-1, -1, -1):
+            acti_prev = ls_acti[li]
+            kernel_grad = acti_prev[:, :, np.newaxis]*delta[:, np.newaxis, :]+penal_grad[li]
+            ls_layer_grads.append((kernel_grad.reshape((X.shape[0], -1)), delta))
+            if li > 0:
+                delta = np.matmul(delta, kernels[li].T)*ACTI_FUNC_GRAD[activation](ls_pre_acti[li-1], ls_acti[li])
+        grads[start:start+X.shape[0]] = np.concatenate([g for layer_grads in ls_layer_grads[::-1] for g in layer_grads], axis=1)
+    return grads
+
+
 # Calculate ewma Hotelling T2 statistics
-def Scores_ewma(score, gamma, start):
+def Scores_ewma(score, gamma, start, engine='lfilter'):
+    """ The EWMA of the scores along time: out[t] = (1-gamma)*out[t-1]+gamma*score[t] with out[-1] = start.
+
+        Args:
+            engine: 'lfilter' runs the recursion as an IIR filter over all score dimensions at once;
+                    'loop' runs it one time step at a time.
+    """
     if gamma > 0:
         N = score.shape[0]
         npar = score.shape[1]
-        out = np.zeros((N, npar))
-        last_ewma = start
         start_time = time.time()
-        for t in range(N):
-        #   new ewma                  history             current score
-            out[t, :] = (1 - gamma) * last_ewma + gamma * score[t, :]
-            last_ewma = out[t, :]
+        if engine == 'lfilter':
+            # The initial condition zi of the filter [gamma]/[1, gamma-1] is (1-gamma)*start.
+            zi = (1-gamma)*np.broadcast_to(np.asarray(start, dtype=np.float64), (npar,))[np.newaxis, :]
+            out, _ = lfilter([gamma], [1, gamma-1], np.asarray(score, dtype=np.float64), axis=0, zi=zi)
+        elif engine == 'loop':
+            out = np.zeros((N, npar))
+            last_ewma = start
+            for t in range(N):
+            #   new ewma                  history             current score
+                out[t, :] = (1 - gamma) * last_ewma + gamma * score[t, :]
+                last_ewma = out[t, :]
+        else:
+            raise ValueError("Unknown ewma engine: {}.".format(engine))
         print("Calculate ewma score with shape {} takes {}s.".format(score.shape, time.time()-start_time))
         return out
     else:
@@ -921,6 +1024,49 @@ def HotellingT2(x, mu, Sinv, dtype=np.float32):
     tmp = x - mu
     return np.sqrt(np.dot(np.dot(tmp, Sinv), np.transpose(tmp)), dtype=dtype)
 
+def Whiten_Factor(Sinv):
+    """ Find L such that Sinv = L L^T, so that (x-mu) Sinv (x-mu)^T = ||(x-mu) L||^2.
+
+        The Cholesky factor is used if Sinv is positive definite; otherwise, fall back to
+        the eigen-decomposition with negative eigen-values (numerical noise) truncated at 0.
+    """
+    Sinv = (np.asarray(Sinv, dtype=np.float64)+np.transpose(Sinv))/2
+    try:
+        return np.linalg.cholesky(Sinv)
+    except np.linalg.LinAlgError:
+        eigvs, eigvects = np.linalg.eigh(Sinv)
+        logger.info("Sinv is not positive definite (smallest eigen-value %s); use eigen-decomposition.", eigvs[0], extra=d)
+        return eigvects*np.sqrt(np.maximum(eigvs, 0))
+
+
+def HotellingT2Batch(x, mu, Sinv, dtype=np.float32, chunk_size=HOTELLING_CHUNK_SIZE, whiten_factor=None):
+    """ Calculate HotellingT2 for every row of x at once.
+
+        The rows are whitened chunk by chunk, so the extra memory is bounded by chunk_size rows.
+
+        Args:
+            x: An array of shape (..., dim). The leading dimensions are kept in the output.
+            mu: The mean vector of shape (dim,).
+            Sinv: The inverse covariance matrix of shape (dim, dim).
+            whiten_factor: The factor returned by Whiten_Factor(Sinv). Pass it in to reuse it
+                           across calls with the same Sinv.
+
+        Returns:
+            t2: An array of shape x.shape[:-1], the same as calling HotellingT2 on each row.
+    """
+    if whiten_factor is None:
+        whiten_factor = Whiten_Factor(Sinv)
+    x = np.asarray(x)
+    out_shape = x.shape[:-1]
+    x = x.reshape((-1, x.shape[-1]))
+    mu = np.asarray(mu, dtype=np.float64)
+    t2 = np.zeros((x.shape[0],), dtype=dtype)
+    for start in range(0, x.shape[0], chunk_size):
+        white = np.matmul(x[start:start+chunk_size]-mu, whiten_factor)
+        t2[start:start+chunk_size] = np.sqrt(np.einsum('ij,ij->i', white, white))
+    return t2.reshape(out_shape)
+
+
 def HotellingT2Helper(t, x, mu, Sinv, dtype=np.float32):
     tmp = x - mu
     return t, np.sqrt(np.dot(np.dot(tmp, Sinv), np.transpose(tmp)), dtype=dtype)
@@ -1025,11 +1171,9 @@ def EwmaT2PI(score_PI, mu_train, Sinv_train, gamma,
     Sinv2 = Sinv_train * (2 - gamma) / gamma
     start_time = time.time()
     # t2ewmaI = HotellingT2Paral(score_ewma, mu_train, Sinv2, gamma, dtype=dtype, flag_PI=True)
-    t2ewmaI = np.zeros((N_PI_ext, ))
-    for t in range(N_PI_ext):
-        # Statistical quality control-(11.32)
-        t2ewmaI[t] = HotellingT2(
-            score_ewma[t, :], mu_train, Sinv2 / (1 - (1 - gamma)**(2 * (1 + t))))
+    # Statistical quality control-(11.32): the covariance at time t is scaled by 1-(1-gamma)**(2*(1+t)),
+    # so the T2 with Sinv2 is divided by its square root.
+    t2ewmaI = HotellingT2Batch(score_ewma, mu_train, Sinv2, dtype=np.float64)/np.sqrt(1 - (1 - gamma)**(2 * (1 + np.arange(N_PI_ext))))
     print("Calculate Hotelling T2 of score with shape {} takes {}s.".format(score_PI.shape, time.time()-start_time))
     
     start_PII = score_ewma[-1, :]
@@ -1046,14 +1190,56 @@ def EwmaT2PII(score_PII, mu_train, Sinv_train, gamma, start_PII, dtype=np.float3
     Sinv2 = Sinv_train * (2 - gamma) / gamma
     start_time = time.time()
     # t2ewmaII = HotellingT2Paral(score_ewmaII, mu_train, Sinv2, gamma, dtype=dtype, flag_PI=False)
-    t2ewmaII = np.zeros((N_PII,))
-    for t in range(N_PII):
-        t2ewmaII[t] = HotellingT2(score_ewmaII[t, :], mu_train, Sinv2)
+    t2ewmaII = HotellingT2Batch(score_ewmaII, mu_train, Sinv2, dtype=np.float64)
     print("Calculate Hotelling T2 of score with shape {} takes {}s.".format(score_PII.shape, time.time()-start_time))
 
     return score_ewmaII, t2ewmaII
 
 
+def Whiten_Scores_PI_PII(score_PI, score_PII, mu_train, Sinv_train, start_PI):
+    """ The whitened scores (score-mu_train) L, with Sinv_train = L L^T, of Phase I and Phase II and of start_PI,
+        so that their T2 is a norm. They only depend on the scores, so compute them once for all gamma values.
+    """
+    whiten_factor = Whiten_Factor(Sinv_train)
+    mu_train = np.asarray(mu_train, dtype=np.float64)
+    white_PI = np.matmul(np.asarray(score_PI, dtype=np.float64)-mu_train, whiten_factor)
+    white_PII = np.matmul(np.asarray(score_PII, dtype=np.float64)-mu_train, whiten_factor)
+    white_start_PI = np.matmul(np.broadcast_to(np.asarray(start_PI, dtype=np.float64), mu_train.shape)-mu_train, whiten_factor)
+    return white_PI, white_PII, white_start_PI
+
+
+def EwmaT2_Multi_Gamma_White(white_PI, white_PII, white_start_PI, arr_gamma, eff_wind_len_factor):
+    """ EwmaT2PI followed by EwmaT2PII for several gamma values, from the scores whitened by Whiten_Scores_PI_PII.
+
+        The EWMA is linear, so the EWMA of the whitened scores is the whitened EWMA of the scores,
+        and its T2 is a norm scaled by a function of gamma.
+
+        Returns:
+            A list with (ext_len, t2ewmaI, t2ewmaII) for each gamma, the same as EwmaT2PI and EwmaT2PII.
+    """
+    ls_res = []
+    for gamma in arr_gamma:
+        ext_len = int(eff_wind_len_factor/gamma)
+        white_PI_ext = np.vstack((white_PI[-ext_len:], white_PI)) if ext_len>0 else white_PI
+        white_ewma_PI = Scores_ewma(white_PI_ext, gamma, white_start_PI)
+        white_ewma_PII = Scores_ewma(white_PII, gamma, white_ewma_PI[-1])
+        scale = np.sqrt((2 - gamma) / gamma)
+        t2ewmaI = scale*np.linalg.norm(white_ewma_PI, axis=1)/np.sqrt(1 - (1 - gamma)**(2 * (1 + np.arange(white_PI_ext.shape[0]))))
+        t2ewmaII = scale*np.linalg.norm(white_ewma_PII, axis=1)
+        ls_res.append((ext_len, t2ewmaI, t2ewmaII))
+    return ls_res
+
+
+def EwmaT2_Multi_Gamma_PI_PII(score_PI, score_PII, mu_train, Sinv_train, arr_gamma, eff_wind_len_factor, start_PI):
+    """ EwmaT2PI followed by EwmaT2PII for several gamma values, whitening the scores only once.
+
+        Returns:
+            A list with (ext_len, t2ewmaI, t2ewmaII) for each gamma, the same as EwmaT2PI and EwmaT2PII.
+    """
+    white_PI, white_PII, white_start_PI = Whiten_Scores_PI_PII(score_PI, score_PII, mu_train, Sinv_train, start_PI)
+    return EwmaT2_Multi_Gamma_White(white_PI, white_PII, white_start_PI, arr_gamma, eff_wind_len_factor)
+
+
 def EwmaPI(comp_PI, gamma, eff_wind_len_factor, start_PI):
     ext_len = int(eff_wind_len_factor/gamma)
     if ext_len>0:
@@ -1141,6 +1327,100 @@ def calEwmaStatisticsPII(comp_PII, gamma, start_PII, lcl_comp, ucl_comp):
 
 
 
+def calEwmaStatisticsHelperBatch(fp_mark):
+    """ calEwmaStatisticsHelper for each series along the last axis of fp_mark at once.
+
+        Since there is no mark before the first detection, the marks after it are all the marks.
+
+        Returns:
+            fp, rl, len_after_detect, signal_ratio, flag_rl: Arrays of the shape of fp_mark without the last axis.
+    """
+    len_mark = fp_mark.shape[-1]
+    num_marks = np.sum(fp_mark, axis=-1)
+    flag_rl = num_marks > 0
+    rl = np.where(flag_rl, np.argmax(fp_mark, axis=-1), len_mark)
+    len_after_detect = np.where(flag_rl, len_mark-rl, 0)
+    signal_ratio = np.where(flag_rl, 1.0*num_marks/np.maximum(len_after_detect, 1), 0)
+    return 1.0*num_marks/len_mark, rl, len_after_detect, signal_ratio, flag_rl
+
+
+class Run_Len_Batch(object):
+    """ The run lengths of all replicates of one chart at many alarm levels at once, for the bisection of the alarm level.
+
+        The replicates are the rows of 2D arrays. With gamma, it is the two-sided EWMA chart of calEwmaStatisticsPI and
+        calEwmaStatisticsPII, whose EWMA starts from the mean of each Phase-I replicate. The EWMA does not depend on the
+        alarm level, so it is calculated once, and only the percentiles and the first crossings are calculated per level.
+        Without gamma, it is the one-sided chart of the statistics themselves, as the T2 of scores in Parallel_Cal_Run_Len0.
+    """
+    def __init__(self, arr_PI, gamma=None, offset=0, eff_wind_len_factor=0):
+        self.gamma = gamma
+        arr_PI = np.asarray(arr_PI, dtype=np.float64)
+        if gamma is None:
+            self.arr_ref_PI = arr_PI
+            self.arr_start_PII = None
+        else:
+            ext_len = int(eff_wind_len_factor/gamma)
+            arr_PI_ext = np.hstack((arr_PI[:, -ext_len:], arr_PI)) if ext_len>0 else arr_PI
+            arr_ewma_PI = np.transpose(Scores_ewma(np.transpose(arr_PI_ext), gamma, np.mean(arr_PI, axis=1)))
+            self.arr_ref_PI = arr_ewma_PI[:, offset+ext_len:]
+            self.arr_start_PII = arr_ewma_PI[:, -1]
+
+    def limits(self, arr_alarm_level):
+        """ The control limits (lcls, ucls) of each alarm level (rows) and each replicate (columns). """
+        arr_alarm_level = np.atleast_1d(arr_alarm_level)
+        if self.gamma is None:
+            ucls = np.percentile(self.arr_ref_PI, arr_alarm_level, axis=1)
+            return np.full_like(ucls, -np.inf), ucls
+        return (np.percentile(self.arr_ref_PI, (100.0 - arr_alarm_level) / 2, axis=1),
+                np.percentile(self.arr_ref_PI, (100.0 + arr_alarm_level) / 2, axis=1))
+
+    def phase2(self, arr_PII):
+        """ The charted Phase-II statistics of the replicates (rows) of arr_PII. """
+        arr_PII = np.asarray(arr_PII, dtype=np.float64)
+        if self.gamma is None:
+            return arr_PII
+        return np.transpose(Scores_ewma(np.transpose(arr_PII), self.gamma, self.arr_start_PII))
+
+    def run_len(self, arr_stat_PII, lcls, ucls):
+        """ The run lengths and signal ratios of arr_stat_PII (from phase2) for each row of limits. """
+        fp_mark = np.logical_or(arr_stat_PII[np.newaxis,:,:] > ucls[:,:,np.newaxis], arr_stat_PII[np.newaxis,:,:] < lcls[:,:,np.newaxis])
+        _, rl, _, signal_ratio, _ = calEwmaStatisticsHelperBatch(fp_mark)
+        return rl.astype(np.float64), signal_ratio
+
+
+def Bisect_Alarm_Level_Batch(eval_func, target, al_lo, al_hi, tol, iter_max, num_cands=1, log_info=""):
+    """ The bisection of the alarm level to match the in-control run length statistic with target, with num_cands
+        equally spaced candidate levels in (al_lo, al_hi) per pass. With num_cands=1, it is the bisection of the loops
+        in Find_Ctrl_Lmt_Same_MRL0 and Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0.
+
+        Args:
+            eval_func: eval_func(arr_al) returns the statistic for each candidate (increasing with the alarm level)
+                and a list with the other results of each candidate.
+
+        Returns:
+            targ_al, the results of the last candidate next to targ_al (the last one tried for num_cands=1), and the
+            number of passes and the final al_lo and al_hi.
+    """
+    iter_cnt = 0
+    time_start_process = time.time()
+    while True:
+        arr_cand_idx = np.arange(1, num_cands+1)
+        arr_al = ((num_cands+1-arr_cand_idx)*al_lo + arr_cand_idx*al_hi)/(num_cands+1)
+        arr_stat, ls_res = eval_func(arr_al)
+        logger.info("Binary search %s with alarm rates %s (cur: %s, targ: %s) at iteration %s takes %s seconds.",
+            log_info, arr_al, arr_stat, target, iter_cnt, time.time() - time_start_process, extra=d)
+        iter_cnt += 1
+        # The first candidate whose statistic reaches the target is the new upper bound.
+        hi_idx = int(np.argmax(arr_stat >= target)) if np.any(arr_stat >= target) else num_cands
+        if hi_idx < num_cands:
+            al_hi = arr_al[hi_idx]
+        if hi_idx > 0:
+            al_lo = arr_al[hi_idx-1]
+        res = ls_res[min(hi_idx, num_cands-1)]
+        if np.abs(al_hi-al_lo) < tol or iter_cnt >= iter_max:
+            return (al_lo + al_hi)/2, res, iter_cnt, al_lo, al_hi
+
+
 # Determine parameter of EWMA by setting some positive-signal-ratio.
 def Find_EWMA_Gamma_Vec(
         metric_PI,
@@ -1163,6 +1443,8 @@ def Find_EWMA_Gamma_Vec(
 
     N_PI = metric_PI.shape[0]
     N_PII = metric_PII.shape[0]
+    # The whitened scores do not depend on gamma, so they are computed once for all iterations.
+    white_PI, white_PII, white_start_PI = Whiten_Scores_PI_PII(metric_PI, metric_PII, mu_train, Sinv_train, start_PI)
 
     iter_cnt = 0
     while True:
@@ -1170,17 +1452,16 @@ def Find_EWMA_Gamma_Vec(
         # gamma = max(1.0*eff_wind_len_factor/N_PI, 10.0**((np.log10(gamma_ll) + np.log10(gamma_ul)) / 2))
         gamma = max(1.0*eff_wind_len_factor/N_PI, ((gamma_ll + gamma_ul) / 2))
         # print gamma, eff_wind_len_factor, N_PI, ((gamma_ll + gamma_ul) / 2)
-        # Phase I data:
-        ext_len, start_PII, _, metric_t2_ewma = EwmaT2PI(metric_PI, mu_train,
-                Sinv_train, gamma, eff_wind_len_factor, nugget, start_PI)
+        # Phase I and Phase II data:
+        ((ext_len, metric_t2_ewma, metric_t2_ewma_PII),) = EwmaT2_Multi_Gamma_White(
+                white_PI, white_PII, white_start_PI, [gamma], eff_wind_len_factor)
 
-        # print t2ewmaI.shape, offset_PI, ext_len, gamma, eff_wind_len_factor/N_PI # debug
         # Control Chart
         # alarm_level = 99.99
         ucl = np.percentile(metric_t2_ewma[offset_PI+ext_len:], alarm_level)
 
         # Phase II data:
-        (_, _, _, _, sig_ratio, _) = calEwmaT2StatisticsPII(metric_PII, mu_train, Sinv_train, gamma, start_PII, ucl)
+        (_, _, _, sig_ratio, _) = calEwmaStatisticsHelper(metric_t2_ewma_PII > ucl)
 
         if sig_ratio <= positive_rate_cd:
             gamma_ul = gamma
@@ -1255,6 +1536,9 @@ def Find_EWMA_Gamma_Sca(
     # No need to calculate covariance matrix
     N_PI = metric_PI.shape[0]
     N_PII = metric_PII.shape[0]
+    # The columns of the metrics for Scores_ewma do not depend on gamma, so they are made once for all iterations.
+    col_PI = np.asarray(metric_PI, dtype=np.float64).reshape((-1, 1))
+    col_PII = np.asarray(metric_PII, dtype=np.float64).reshape((-1, 1))
 
     iter_cnt = 0
     while True:
@@ -1264,8 +1548,11 @@ def Find_EWMA_Gamma_Sca(
         gamma = max(1.0*eff_wind_len_factor/N_PI, ((gamma_ll + gamma_ul) / 2))
         # print gamma, eff_wind_len_factor, N_PI, ((gamma_ll + gamma_ul) / 2)
 
-        # Phase I data:
-        ext_len, start_PII, metric_ewma = EwmaPI(metric_PI, gamma, eff_wind_len_factor, start_PI)
+        # Phase I data (EwmaPI):
+        ext_len = int(eff_wind_len_factor/gamma)
+        col_PI_ext = np.vstack((col_PI[-ext_len:], col_PI)) if ext_len>0 else col_PI
+        metric_ewma = Scores_ewma(col_PI_ext, gamma, start_PI).reshape((-1,))
+        start_PII = metric_ewma[-1]
 
         # print metric_ewma.shape, offset_PI, ext_len, gamma, 1.0*eff_wind_len_factor/N_PI # debug
         # Control Chart
@@ -1275,8 +1562,9 @@ def Find_EWMA_Gamma_Sca(
         ucl = np.percentile(
             metric_ewma[offset_PI+ext_len:], (100.0 + alarm_level) / 2)
 
-        # Phase-II:
-        (_, _, _, _, _, _, sig_ratio, _) = calEwmaStatisticsPII(metric_PII, gamma, start_PII, lcl, ucl)
+        # Phase-II (calEwmaStatisticsPII, without the one-sided rates that are not used here):
+        metric_ewma_PII = Scores_ewma(col_PII, gamma, start_PII).reshape((-1,))
+        (_, _, _, sig_ratio, _) = calEwmaStatisticsHelper((metric_ewma_PII > ucl) | (metric_ewma_PII < lcl))
 
         if sig_ratio <= positive_rate_cd:
             gamma_ul = gamma
@@ -1359,15 +1647,23 @@ def Agg_Data(FLAGS):
 
 def Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, raw_data_size, base_tag, comp_tag,
                             base_no_cd_stats, comp_no_cd_stats,
-                            FLAGS, tol, iter_max):
+                            FLAGS, tol, iter_max, store=None):
     """ For each gamma, match the median in-control run-length of the comparing tag with
         that of the base tag, and determine the corresponding alarm level. Then, use
         that alarm level to go over the raw data and calculate the median
         out-of-control run-length and store the alarm level and run-length.
+
+        If store (an EWMA_Sim_Store) is given, the EWMA paths are read from it instead of the .csv files.
+        FLAGS.run_len_engine 'batch' runs Find_Ctrl_Lmt_Same_MRL0_Batch and 'loop' goes over the replicates one by one.
     """
+    run_len_engine = getattr(FLAGS, 'run_len_engine', 'batch')
+    if run_len_engine == 'batch':
+        return Find_Ctrl_Lmt_Same_MRL0_Batch(raw_data_folder, raw_data_size, comp_tag, base_no_cd_stats, comp_no_cd_stats,
+                                             FLAGS, tol, iter_max, store=store, num_cands=getattr(FLAGS, 'run_len_num_cands', 1))
+    elif run_len_engine != 'loop':
+        raise ValueError("Unknown run length engine: {}.".format(run_len_engine))
     offset = OFFSET
     eff_wind_len_factor = FLAGS.eff_wind_len_factor
-    sub_str = "0_0_1_ewma_" + comp_tag
     num_gammas = len(FLAGS.score_gamma_ls)
     num_change_factors = len(FLAGS.change_factor_ls)
     df_stat_same_mrl0 = pd.DataFrame(columns=[
@@ -1400,14 +1696,12 @@ def Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, raw_data_size, base_tag, comp_tag,
                 logger.info("Read file %s at iteration %s",
                     row_idx, iter_cnt, extra=d)
                 # Obtain Phase-I EWMA and statistics
-                PI_fname = "_".join([str(row_idx), sub_str, "PI.csv"])
-                comp_PI = np.genfromtxt(os.path.join(raw_data_folder, PI_fname))
+                comp_PI = Read_EWMA_Replicate(raw_data_folder, comp_tag, "PI", 0, 0, "1", row_idx, store)
                 (_, start_comp_PIIs[row_idx], lcl_comps[row_idx], ucl_comps[row_idx],
                  _, _, _, _, _, _, _) = calEwmaStatisticsPI(
                     offset, al_try, comp_PI, gamma, eff_wind_len_factor, np.mean(comp_PI))
                 # Obtain Phase-II EWMA and statistics
-                PII_fname = "_".join([str(row_idx), sub_str, "PII.csv"])
-                comp_PII = np.genfromtxt(os.path.join(raw_data_folder, PII_fname))
+                comp_PII = Read_EWMA_Replicate(raw_data_folder, comp_tag, "PII", 0, 0, "1", row_idx, store)
                 (_, _, _, _, runlen0_comp_PIIs[row_idx],
                  _, sigratio0_comp_PIIs[row_idx], _) = calEwmaStatisticsPII(
                     comp_PII, gamma, start_comp_PIIs[row_idx],
@@ -1422,7 +1716,7 @@ def Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, raw_data_size, base_tag, comp_tag,
             al_try = (al_lo + al_hi)/2
             if np.abs(al_hi-al_lo) < tol or iter_cnt >= iter_max:
                 targ_al = al_try # Targeted alarm level
-                df_stat_same_mrl0.at[df_stat_same_mrl0.shape[0]] = [
+                df_stat_same_mrl0.loc[df_stat_same_mrl0.shape[0]] = [
                     gamma, 1, targ_al,
                     runlen0_comp_PII_median, sigratio0_comp_PII_median,
                     np.mean(runlen0_comp_PIIs), np.mean(sigratio0_comp_PIIs)]
@@ -1435,8 +1729,6 @@ def Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, raw_data_size, base_tag, comp_tag,
         # Obtain run length in out-of-control cases
         for ch_idx in range(num_change_factors - 1):
             ch_f = FLAGS.change_factor_ls[ch_idx + 1]
-            ch_sub_str = "_".join([str(ch_idx+1), str(0),
-                str(ch_f).replace(".", "_"), "ewma", comp_tag])
             runlen1_comp_PIIs = np.zeros(raw_data_size)
             sigratio1_comp_PIIs = np.zeros(raw_data_size)
             for row_idx in range(raw_data_size):
@@ -1448,14 +1740,13 @@ def Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, raw_data_size, base_tag, comp_tag,
                 #  _, _, _, _, _, _, _) = calEwmaStatisticsPI(
                 #     offset, targ_al, comp_PI, gamma, np.mean(comp_PI))
                 # Obtain Phase-II EWMA and statistics
-                PII_fname = "_".join([str(row_idx), ch_sub_str, "PII.csv"])
-                comp_PII = np.genfromtxt(os.path.join(raw_data_folder, PII_fname))
+                comp_PII = Read_EWMA_Replicate(raw_data_folder, comp_tag, "PII", ch_idx+1, 0, ch_f, row_idx, store)
                 (_, _, _, _, runlen1_comp_PIIs[row_idx],
                  _, sigratio1_comp_PIIs[row_idx], _) = calEwmaStatisticsPII(
                     comp_PII, gamma, start_comp_PIIs[row_idx],
                     lcl_comps[row_idx], ucl_comps[row_idx])
             # Integrate those results from the out-of-control cases into the df_stat_same_mrl0
-            df_stat_same_mrl0.at[df_stat_same_mrl0.shape[0]] = [
+            df_stat_same_mrl0.loc[df_stat_same_mrl0.shape[0]] = [
                 gamma, FLAGS.change_factor_ls[ch_idx+1], targ_al,
                 np.median(runlen1_comp_PIIs),
                 np.median(sigratio1_comp_PIIs),
@@ -1465,8 +1756,67 @@ def Find_Ctrl_Lmt_Same_MRL0(raw_data_folder, raw_data_size, base_tag, comp_tag,
     return df_stat_same_mrl0
 
 
-def Agg_Save_EWMA_Sim_One_File(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, ch_f, FLAGS):
-    """Aggregate simulation files into one file."""
+def Find_Ctrl_Lmt_Same_MRL0_Batch(raw_data_folder, raw_data_size, comp_tag, base_no_cd_stats, comp_no_cd_stats,
+                                  FLAGS, tol, iter_max, store=None, num_cands=1):
+    """ Find_Ctrl_Lmt_Same_MRL0 with all replicates as 2D arrays (Run_Len_Batch). The EWMA paths are read once, and
+        each pass of the bisection (Bisect_Alarm_Level_Batch) tries num_cands alarm levels at once. With num_cands=1,
+        the results are the same as those of the loops.
+    """
+    num_gammas = len(FLAGS.score_gamma_ls)
+    num_change_factors = len(FLAGS.change_factor_ls)
+    df_stat_same_mrl0 = pd.DataFrame(columns=[
+        "gamma", "change_factor", "target_alarm_level",
+        "median_run_len_PII", "median_signal_ratio_PII",
+        "mean_run_len_PII", "mean_signal_ratio_PII"])
+    arr_comp_PI = Read_EWMA_Replicates(raw_data_folder, raw_data_size, comp_tag, "PI", 0, 0, "1", store)
+    arr_comp_PII = Read_EWMA_Replicates(raw_data_folder, raw_data_size, comp_tag, "PII", 0, 0, "1", store)
+    ls_arr_comp_PII1 = [Read_EWMA_Replicates(raw_data_folder, raw_data_size, comp_tag, "PII", ch_idx+1, 0,
+                                             FLAGS.change_factor_ls[ch_idx+1], store) for ch_idx in range(num_change_factors-1)]
+    for ga_idx in range(num_gammas-1):
+        gamma = FLAGS.score_gamma_ls[ga_idx+1]
+        al_lo, al_hi = 95.0, 100.0 # Alarm level is in 100-scale
+        print((base_no_cd_stats["rlII"][ga_idx], comp_no_cd_stats["rlII"][ga_idx]))
+        if base_no_cd_stats["rlII"][ga_idx] < comp_no_cd_stats["rlII"][ga_idx]:
+            al_hi = FLAGS.alarm_level
+        else:
+            al_lo = FLAGS.alarm_level
+        time_start_process = time.time()
+        run_len_batch = Run_Len_Batch(arr_comp_PI, gamma, OFFSET, FLAGS.eff_wind_len_factor)
+        arr_ewma_comp_PII = run_len_batch.phase2(arr_comp_PII)
+
+        def eval_func(arr_al):
+            lcls, ucls = run_len_batch.limits(arr_al)
+            runlens, sigratios = run_len_batch.run_len(arr_ewma_comp_PII, lcls, ucls)
+            return np.median(runlens, axis=1), list(zip(runlens, sigratios, lcls, ucls))
+
+        targ_al, (runlen0_comp_PIIs, sigratio0_comp_PIIs, lcl_comps, ucl_comps), iter_cnt, al_lo, al_hi = Bisect_Alarm_Level_Batch(
+            eval_func, base_no_cd_stats["rlII"][ga_idx], al_lo, al_hi, tol, iter_max, num_cands=num_cands,
+            log_info="for gamma {}".format(gamma))
+        df_stat_same_mrl0.loc[df_stat_same_mrl0.shape[0]] = [
+            gamma, 1, targ_al,
+            np.median(runlen0_comp_PIIs), np.median(sigratio0_comp_PIIs),
+            np.mean(runlen0_comp_PIIs), np.mean(sigratio0_comp_PIIs)]
+        logger.info(
+            'Time spent in %s iteration with actual tolerance %s binary search is: %s.',
+            iter_cnt, np.abs(al_hi-al_lo), time.time() - time_start_process,
+            extra=d)
+
+        # Obtain run length in out-of-control cases with the control limits of the last alarm level tried.
+        for ch_idx in range(num_change_factors - 1):
+            runlen1_comp_PIIs, sigratio1_comp_PIIs = run_len_batch.run_len(
+                run_len_batch.phase2(ls_arr_comp_PII1[ch_idx]), lcl_comps[np.newaxis,:], ucl_comps[np.newaxis,:])
+            df_stat_same_mrl0.loc[df_stat_same_mrl0.shape[0]] = [
+                gamma, FLAGS.change_factor_ls[ch_idx+1], targ_al,
+                np.median(runlen1_comp_PIIs[0]),
+                np.median(sigratio1_comp_PIIs[0]),
+                np.mean(runlen1_comp_PIIs[0]),
+                np.mean(sigratio1_comp_PIIs[0])]
+
+    return df_stat_same_mrl0
+
+
+def Agg_Save_EWMA_Sim_One_File(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, ch_f, FLAGS, store=None):
+    """Aggregate simulation files into one file, or into one entry of store (an EWMA_Sim_Store) if given."""
     logger.info("File processing for tag %s gamma index %s and change factor index %s.",
         tag, ga_idx, ch_idx, extra=d)
     agg_fname = '_'.join([tag, ph, 'ewma', str(ch_idx), str(ga_idx),
@@ -1479,7 +1829,7 @@ def Agg_Save_EWMA_Sim_One_File(raw_data_folder, raw_data_size, tag, ph, ch_idx,
             fname, tag, ga_idx, ch_idx, extra=d)
         return
     read_file_ls = []
-    if os.path.isfile(os.path.join(raw_data_folder, agg_fname)):
+    if os.path.isfile(os.path.join(raw_data_folder, agg_fname)) or (store is not None and store.has(tag, ph, ch_idx, ga_idx)):
         logger.info("File processing for tag %s with gamma index %s and change factor index %s already existed.",
             fname, ga_idx, ch_idx, extra=d)
         return
@@ -1489,25 +1839,33 @@ def Agg_Save_EWMA_Sim_One_File(raw_data_folder, raw_data_size, tag, ph, ch_idx,
     #         tag, ga_idx, ch_idx, extra=d)
     #     return
     time_start = time.time()
-    with open(os.path.join(raw_data_folder, agg_fname), 'a') as out_f:
-        for id_num in range(raw_data_size):
-            ch_f = FLAGS.change_factor_ls[ch_idx]
-            fname = '_'.join([str(id_num), str(ch_idx), str(ga_idx),
-                str(ch_f).replace(".", "_"), 'ewma', tag, ph]) + '.csv'
-            read_file_ls.append(fname)
-            fpath = os.path.join(raw_data_folder, fname)
-            fdata = np.reshape(np.genfromtxt(fpath, delimiter=','), (1,-1))
-            df_data = pd.DataFrame(data=fdata, )
-            df_data.to_csv(out_f, header=False, index=False)
+    if store is not None:
+        ch_f = FLAGS.change_factor_ls[ch_idx]
+        read_file_ls = ['_'.join([str(id_num), str(ch_idx), str(ga_idx),
+            str(ch_f).replace(".", "_"), 'ewma', tag, ph]) + '.csv' for id_num in range(raw_data_size)]
+        store.put(tag, ph, ch_idx, ga_idx, ch_f, np.vstack([
+            np.reshape(np.genfromtxt(os.path.join(raw_data_folder, fname), delimiter=','), (1,-1)) for fname in read_file_ls]))
+    else:
+        with open(os.path.join(raw_data_folder, agg_fname), 'a') as out_f:
+            for id_num in range(raw_data_size):
+                ch_f = FLAGS.change_factor_ls[ch_idx]
+                fname = '_'.join([str(id_num), str(ch_idx), str(ga_idx),
+                    str(ch_f).replace(".", "_"), 'ewma', tag, ph]) + '.csv'
+                read_file_ls.append(fname)
+                fpath = os.path.join(raw_data_folder, fname)
+                fdata = np.reshape(np.genfromtxt(fpath, delimiter=','), (1,-1))
+                df_data = pd.DataFrame(data=fdata, )
+                df_data.to_csv(out_f, header=False, index=False)
     for fname in read_file_ls:
         os.remove(os.path.join(raw_data_folder, fname))
     logger.info("File processing for %s with gamma index %s and change factor index %s in Phase %s takes time %s.",
         tag, ga_idx, ch_idx, ph, time.time()-time_start, extra=d)
 
 
-def Agg_Save_EWMA_Sim(raw_data_folder, raw_data_size, tag, FLAGS):
+def Agg_Save_EWMA_Sim(raw_data_folder, raw_data_size, tag, FLAGS, store=None):
     """ Go over all .csv files and aggregate them in terms of change_idx,
-        gamma_idx, and Phase (Phase-I and Phase-II).
+        gamma_idx, and Phase (Phase-I and Phase-II). If store (an EWMA_Sim_Store) is
+        given, they are aggregated into its binary entries instead of .csv files.
     """
     num_gammas = len(FLAGS.score_gamma_ls)
     num_change_factors = len(FLAGS.change_factor_ls)
@@ -1516,18 +1874,19 @@ def Agg_Save_EWMA_Sim(raw_data_folder, raw_data_size, tag, FLAGS):
         for ch_idx in range(num_change_factors):
             ch_f = FLAGS.change_factor_ls[ch_idx]
             for ph in Phase_ls:
-                Agg_Save_EWMA_Sim_One_File(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, ch_f, FLAGS)
+                Agg_Save_EWMA_Sim_One_File(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, ch_f, FLAGS, store=store)
 
 
-def Parallel_Agg_Save_EWMA_Sim(raw_data_folder, raw_data_size, tag_ls, n_jobs, FLAGS):
+def Parallel_Agg_Save_EWMA_Sim(raw_data_folder, raw_data_size, tag_ls, n_jobs, FLAGS, store=None):
     """ Go over all .csv files and aggregate them in terms of change_idx,
-        gamma_idx, and Phase (Phase-I and Phase-II).
+        gamma_idx, and Phase (Phase-I and Phase-II). If store (an EWMA_Sim_Store) is
+        given, they are aggregated into its binary entries instead of .csv files.
     """
     num_gammas = len(FLAGS.score_gamma_ls)
     num_change_factors = len(FLAGS.change_factor_ls)
     Phase_ls = ["PI", "PII"]
 
-    tasks = [(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, FLAGS.change_factor_ls[ch_idx], FLAGS) for
+    tasks = [(raw_data_folder, raw_data_size, tag, ph, ch_idx, ga_idx, FLAGS.change_factor_ls[ch_idx], FLAGS, store) for
         (tag, ph, ch_idx, ga_idx) in itertools.product(
             tag_ls, Phase_ls, list(range(num_change_factors)),
             list(range(num_gammas)))]
@@ -1540,13 +1899,13 @@ def Parallel_Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, ta
         func_ls, func_param_ls, func_name_ls,
         base_no_cd_stats, al_lo, al_hi, n_jobs,
         no_cd_stats_folder, output_file,
-        FLAGS, tol, iter_max):
+        FLAGS, tol, iter_max, store=None):
     """Parallelize the process of finding the control limits."""
     tasks = [(raw_data_folder, raw_data_size, base_tag, tag,
             func_ls, func_param_ls, func_name_ls,
             base_no_cd_stats, al_lo, al_hi,
             no_cd_stats_folder, output_file,
-            FLAGS, tol, iter_max) for tag in tag_ls]
+            FLAGS, tol, iter_max, store) for tag in tag_ls]
     with parallel_backend('loky', n_jobs=n_jobs):
         res = Parallel(verbose=100, pre_dispatch='2*n_jobs')(
             delayed(Find_Ctrl_Lmt_Same_RL0)(*task) for task in tasks)
@@ -1556,8 +1915,10 @@ def Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, tag,
                 func_ls, func_param_ls, func_name_ls,
                 base_no_cd_stats, al_lo, al_hi,
                 no_cd_stats_folder, output_file,
-                FLAGS, tol, iter_max):
+                FLAGS, tol, iter_max, store=None):
     """ Find control limit to match the in control run length.
+
+        If store (an EWMA_Sim_Store) is given, the aggregated EWMA paths are read from it instead of the .csv files.
     """
     offset = OFFSET
     eff_wind_len_factor = FLAGS.eff_wind_len_factor
@@ -1598,14 +1959,8 @@ def Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, tag,
         if tag == base_tag:
             # If the ewma is from score.
             ch_f0 = FLAGS.change_factor_ls[0]
-            agg_fname_PI = '_'.join([tag, "PI", 'ewma', str(0),
-                str(ga_idx), str(ch_f0).replace(".", "_")]) + '.csv'
-            agg_fname_PII = '_'.join([tag, "PII", 'ewma', str(0),
-                str(ga_idx), str(ch_f0).replace(".", "_")]) + '.csv'
-            ewma_no_cd_PI = np.genfromtxt(
-                os.path.join(raw_data_folder, agg_fname_PI), delimiter=',')
-            ewma_no_cd_PII = np.genfromtxt(
-                os.path.join(raw_data_folder, agg_fname_PII), delimiter=',')
+            ewma_no_cd_PI = Read_EWMA_Agg(raw_data_folder, tag, "PI", 0, ga_idx, ch_f0, store)
+            ewma_no_cd_PII = Read_EWMA_Agg(raw_data_folder, tag, "PII", 0, ga_idx, ch_f0, store)
             param = {"al_try":al_try, "offset":offset}
             time_start_process = time.time()
             while True:
@@ -1628,7 +1983,7 @@ def Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, tag,
                 al_try = (al_lo + al_hi)/2
                 if np.abs(al_hi-al_lo) < tol or iter_cnt >= iter_max:
                     targ_al = al_try # Targeted alarm level
-                    df_stat_same_rl0.at[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
+                    df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
                     break
                 iter_cnt += 1
             logger.info(
@@ -1638,28 +1993,19 @@ def Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, tag,
 
             for ch_idx in range(1,num_change_factors):
                 ch_f = FLAGS.change_factor_ls[ch_idx]
-                agg_fname_PII = '_'.join([tag, "PII", 'ewma', str(ch_idx),
-                    str(ga_idx), str(ch_f).replace(".", "_")]) + '.csv'
-                ewma_PII = np.genfromtxt(
-                    os.path.join(raw_data_folder, agg_fname_PII), delimiter=',')
+                ewma_PII = Read_EWMA_Agg(raw_data_folder, tag, "PII", ch_idx, ga_idx, ch_f, store)
                 runlen1_T2_base_PII = np.zeros(ewma_PII.shape[0])
                 for row_idx in range(ewma_PII.shape[0]):
                     fp_score_mark = ewma_PII[row_idx,:] > ucl_base[row_idx]
                     (_, runlen1_T2_base_PII[row_idx], _, sigratio1_T2_base_PII, _) = calEwmaStatisticsHelper(
                         fp_score_mark)
                 func_res_ls = [np.apply_along_axis(func, 0, runlen1_T2_base_PII, **func_param) for func, func_param in zip(func_ls, func_param_ls)]
-                df_stat_same_rl0.at[df_stat_same_rl0.shape[0]] = [gamma, FLAGS.change_factor_ls[ch_idx], targ_al] + func_res_ls
+                df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, FLAGS.change_factor_ls[ch_idx], targ_al] + func_res_ls
         else:
             # If ewma comes is from other metrics.
             ch_f0 = FLAGS.change_factor_ls[0]
-            agg_fname_PI = '_'.join([tag, "PI", 'ewma', str(0),
-                str(0), str(ch_f0).replace(".", "_")]) + '.csv'
-            agg_fname_PII = '_'.join([tag, "PII", 'ewma', str(0),
-                str(0), str(ch_f0).replace(".", "_")]) + '.csv'
-            raw_no_cd_PI = np.genfromtxt(
-                os.path.join(raw_data_folder, agg_fname_PI), delimiter=',')
-            raw_no_cd_PII = np.genfromtxt(
-                os.path.join(raw_data_folder, agg_fname_PII), delimiter=',')
+            raw_no_cd_PI = Read_EWMA_Agg(raw_data_folder, tag, "PI", 0, 0, ch_f0, store)
+            raw_no_cd_PII = Read_EWMA_Agg(raw_data_folder, tag, "PII", 0, 0, ch_f0, store)
             param = {"al_try":al_try, "gamma":gamma,
                      "eff_wind_len_factor":eff_wind_len_factor,
                      "offset":offset}
@@ -1686,7 +2032,7 @@ def Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, tag,
                 al_try = (al_lo + al_hi)/2
                 if np.abs(al_hi-al_lo) < tol or iter_cnt >= iter_max:
                     targ_al = al_try # Targeted alarm level
-                    df_stat_same_rl0.at[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
+                    df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
                     break
                 iter_cnt += 1
             logger.info(
@@ -1696,17 +2042,14 @@ def Find_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, base_tag, tag,
 
             for ch_idx in range(1,num_change_factors):
                 ch_f = FLAGS.change_factor_ls[ch_idx]
-                agg_fname_PII = '_'.join([tag, "PII", 'ewma', str(ch_idx),
-                    str(0), str(ch_f).replace(".", "_")]) + '.csv'
-                raw_PII = np.genfromtxt(
-                    os.path.join(raw_data_folder, agg_fname_PII), delimiter=',')
+                raw_PII = Read_EWMA_Agg(raw_data_folder, tag, "PII", ch_idx, 0, ch_f, store)
                 runlen1_comp_PII = np.zeros(raw_PII.shape[0])
                 for row_idx in range(raw_PII.shape[0]):
                     _, runlen1_comp_PII[row_idx], _ = Cal_Clmt_Run_Len1(
                         raw_PII[row_idx,:], start_comp_PII[row_idx],
                         lcl_comp[row_idx], ucl_comp[row_idx], gamma)
                 func_res_ls = [np.apply_along_axis(func, 0, runlen1_comp_PII, **func_param) for func, func_param in zip(func_ls, func_param_ls)]
-                df_stat_same_rl0.at[df_stat_same_rl0.shape[0]] = [gamma, ch_f, targ_al] + func_res_ls
+                df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, ch_f, targ_al] + func_res_ls
     print(df_stat_same_rl0)
     out_file_path = os.path.join(no_cd_stats_folder, "_".join([tag, output_file]))
     # if not os.path.isfile(out_file_path):
@@ -1718,16 +2061,24 @@ def Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, ba
                                     func_ls, func_param_ls, func_name_ls,
                                     base_no_cd_stats, al_lo_0, al_hi_0, n_jobs,
                                     no_cd_stats_folder, output_file,
-                                    FLAGS, tol, iter_max):
+                                    FLAGS, tol, iter_max, store=None):
     """ For each gamma, match the median in-control run-length of the base and comparing tag with
         a given value, and determine the corresponding alarm level. Then, use
         that alarm level to go over the raw data and calculate the median
         out-of-control run-length and store the alarm level and run-length.
+
+        If store (an EWMA_Sim_Store) is given, the EWMA paths are read from it instead of the .csv files,
+        and a combination of tag and gamma is skipped if the store does not have it.
+        FLAGS.run_len_engine 'batch' reads all replicates once as 2D arrays (Run_Len_Batch) and tries
+        FLAGS.run_len_num_cands alarm levels per pass; 'loop' goes over the replicates in parallel in each pass.
     """
     offset = OFFSET
     eff_wind_len_factor = FLAGS.eff_wind_len_factor
     num_gammas = len(FLAGS.score_gamma_ls)
     num_change_factors = len(FLAGS.change_factor_ls)
+    run_len_engine = getattr(FLAGS, 'run_len_engine', 'batch')
+    if run_len_engine not in ['batch', 'loop']:
+        raise ValueError("Unknown run length engine: {}.".format(run_len_engine))
 
     for tag in tag_ls:
         df_stat_same_rl0 = pd.DataFrame(columns=[
@@ -1745,13 +2096,60 @@ def Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, ba
             else:
                 PI_fname = "_".join([str(row_idx0), str(0), str(0),
                     str(ch_f).replace(".", "_"), "ewma", tag, "PI.csv"])
-            if not os.path.isfile(os.path.join(raw_data_folder, PI_fname)):
+            if store is not None:
+                comb_exists = store.has(tag, "PI", 0, ga_idx if tag == base_tag else 0)
+            else:
+                comb_exists = os.path.isfile(os.path.join(raw_data_folder, PI_fname))
+            if not comb_exists:
                 logger.info("The combination (%s, %s) has been processed (%s)", tag, ga_idx, PI_fname, extra=d)
                 continue
             # If this combination of tag, gamma exisits, go on processing.
             gamma = FLAGS.score_gamma_ls[ga_idx]
             # al_lo, al_hi = 95, 100 # Alarm level is in 100-scale
             al_lo, al_hi = al_lo_0, al_hi_0
+            if run_len_engine == 'batch':
+                time_start_process = time.time()
+                # The base tag is the T2 of scores for each gamma. The other tags are charted with EWMA of gamma.
+                chart_ga_idx = ga_idx if tag == base_tag else 0
+                run_len_batch = Run_Len_Batch(
+                    Read_EWMA_Replicates(raw_data_folder, raw_data_size, tag, "PI", 0, chart_ga_idx, ch_f, store),
+                    None if tag == base_tag else gamma, offset, eff_wind_len_factor)
+                arr_stat_PII = run_len_batch.phase2(Read_EWMA_Replicates(raw_data_folder, raw_data_size, tag, "PII", 0, chart_ga_idx, ch_f, store))
+
+                def eval_func(arr_al):
+                    lcls, ucls = run_len_batch.limits(arr_al)
+                    runlens, _ = run_len_batch.run_len(arr_stat_PII, lcls, ucls)
+                    ls_func_res = [[np.apply_along_axis(func, 0, runlen0_PIIs, **func_param) for func, func_param in zip(func_ls, func_param_ls)]
+                                   for runlen0_PIIs in runlens]
+                    return np.array([func_res[0] for func_res in ls_func_res]), list(zip(runlens, ls_func_res, lcls, ucls))
+
+                targ_al, (runlen0_PIIs, func_res_ls, lcls, ucls), iter_cnt, al_lo, al_hi = Bisect_Alarm_Level_Batch(
+                    eval_func, base_no_cd_stats["rlII"][ga_idx], al_lo, al_hi, tol, iter_max,
+                    num_cands=getattr(FLAGS, 'run_len_num_cands', 1), log_info="for tag {} with gamma {}".format(tag, gamma))
+                df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
+                np.savetxt(os.path.join(no_cd_stats_folder, '_'.join([tag, str(0), str(ga_idx), "run_len"])+'.csv'),
+                           runlen0_PIIs, delimiter=',')
+                logger.info(
+                    'Time spent in %s iteration with actual tolerance %s binary search for tag %s is: %s.',
+                    iter_cnt, np.abs(al_hi-al_lo), tag, time.time() - time_start_process,
+                    extra=d)
+                tag_fnames.extend([EWMA_Replicate_Fname(row_idx, tag, "PI", 0, chart_ga_idx, ch_f) for row_idx in range(raw_data_size)])
+
+                # Obtain run length in out-of-control cases with the control limits of the last alarm level tried.
+                for ch_idx in range(num_change_factors):
+                    ch_f_idx = FLAGS.change_factor_ls[ch_idx]
+                    tag_fnames.extend([EWMA_Replicate_Fname(row_idx, tag, "PII", ch_idx, chart_ga_idx, ch_f_idx) for row_idx in range(raw_data_size)])
+                    if ch_idx == 0:
+                        continue
+                    runlen1_PIIs = run_len_batch.run_len(run_len_batch.phase2(Read_EWMA_Replicates(
+                        raw_data_folder, raw_data_size, tag, "PII", ch_idx, chart_ga_idx, ch_f_idx, store)), lcls[np.newaxis,:], ucls[np.newaxis,:])[0][0]
+                    func_res_ls = [np.apply_along_axis(func, 0, runlen1_PIIs, **func_param) for func, func_param in zip(func_ls, func_param_ls)]
+                    df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, ch_f_idx, targ_al] + func_res_ls
+                    np.savetxt(os.path.join(no_cd_stats_folder,
+                                    '_'.join([tag, str(ch_idx), str(ga_idx), "run_len"])+'.csv'),
+                               runlen1_PIIs, delimiter=',')
+                continue
+
             al_try = (al_lo + al_hi)/2
             # Calculate the Median Run Length until it matches that of
             # base statistics, like score
@@ -1763,7 +2161,7 @@ def Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, ba
                 (start_PIIs, lcls, ucls,
                  runlen0_PIIs, sigratio0_PIIs, PI_fnames, PII_fnames) = Parallel_Cal_Run_Len0(
                     raw_data_size, raw_data_folder, base_tag, tag, offset, al_try, ga_idx,
-                    eff_wind_len_factor, n_jobs, FLAGS)
+                    eff_wind_len_factor, n_jobs, FLAGS, store=store)
                 logger.info("The return results of run length of tag %s is %s.", tag, runlen0_PIIs, extra=d)
 
                 # sigratio0_PII_median = np.median(sigratio0_PIIs)
@@ -1784,7 +2182,7 @@ def Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, ba
                     targ_al = al_try # Targeted alarm level
                     tag_fnames.extend(PI_fnames)
                     tag_fnames.extend(PII_fnames)
-                    df_stat_same_rl0.at[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
+                    df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, 1, targ_al] + func_res_ls
                     np.savetxt(os.path.join(no_cd_stats_folder, '_'.join([tag, str(0), str(ga_idx), "run_len"])+'.csv'),
                                runlen0_PIIs, delimiter=',')
                     break
@@ -1796,11 +2194,11 @@ def Parallel_Read_Find_Save_Ctrl_Lmt_Same_RL0(raw_data_folder, raw_data_size, ba
             # Obtain run length in out-of-control cases
             for ch_idx in range(1, num_change_factors):
                 runlen1_PIIs, sigratio1_PIIs, PII_fnames = Parallel_Cal_Run_Len1(raw_data_size, raw_data_folder,
-                                base_tag, tag, start_PIIs, lcls, ucls, ch_idx, ga_idx, n_jobs, FLAGS)
+                                base_tag, tag, start_PIIs, lcls, ucls, ch_idx, ga_idx, n_jobs, FLAGS, store=store)
                 tag_fnames.extend(PII_fnames)
                 func_res_ls = [np.apply_along_axis(func, 0, runlen1_PIIs, **func_param) for func, func_param in zip(func_ls, func_param_ls)]
                 # Integrate those results from the out-of-control cases into the df_stat_same_mrl0
-                df_stat_same_rl0.at[df_stat_same_rl0.shape[0]] = [gamma, FLAGS.change_factor_ls[ch_idx], targ_al] + func_res_ls
+                df_stat_same_rl0.loc[df_stat_same_rl0.shape[0]] = [gamma, FLAGS.change_factor_ls[ch_idx], targ_al] + func_res_ls
                 np.savetxt(os.path.join(no_cd_stats_folder,
                                 '_'.join([tag, str(ch_idx), str(ga_idx), "run_len"])+'.csv'),
                            runlen1_PIIs, delimiter=',')
@@ -1921,7 +2319,7 @@ def Check_Monotonic(np_arr):
 
 
 def Parallel_Cal_Run_Len0(raw_data_size, raw_data_folder, base_tag, tag,
-                          offset, al_try, ga_idx, eff_wind_len_factor, n_jobs, FLAGS):
+                          offset, al_try, ga_idx, eff_wind_len_factor, n_jobs, FLAGS, store=None):
     temp_folder_name = os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), 'temp_folder')
 
     def Cal_T2_Run_Len(row_idx, raw_data_folder, tag, offset, al_try, ga_idx, eff_wind_len_factor):
@@ -1931,11 +2329,11 @@ def Parallel_Cal_Run_Len0(raw_data_size, raw_data_folder, base_tag, tag,
         logger.info("Read file %s", row_idx, extra=d)
         # Obtain Phase-I EWMA and statistics
         PI_fname = "_".join([str(row_idx), sub_str, "PI.csv"])
-        base_PI = np.genfromtxt(os.path.join(raw_data_folder, PI_fname))
+        base_PI = Read_EWMA_Replicate(raw_data_folder, tag, "PI", 0, ga_idx, ch_f, row_idx, store)
         ucl_base = np.percentile(base_PI, al_try)
         # Obtain Phase-II EWMA and statistics
         PII_fname = "_".join([str(row_idx), sub_str, "PII.csv"])
-        base_PII = np.genfromtxt(os.path.join(raw_data_folder, PII_fname))
+        base_PII = Read_EWMA_Replicate(raw_data_folder, tag, "PII", 0, ga_idx, ch_f, row_idx, store)
         fp_score_mark = base_PII > ucl_base
         (_, runlen0_base_PII, _,
          sigratio0_base_PII, _) = calEwmaStatisticsHelper(fp_score_mark)
@@ -1949,13 +2347,13 @@ def Parallel_Cal_Run_Len0(raw_data_size, raw_data_folder, base_tag, tag,
         logger.info("Read file %s", row_idx, extra=d)
         # Obtain Phase-I EWMA and statistics
         PI_fname = "_".join([str(row_idx), sub_str, "PI.csv"])
-        comp_PI = np.genfromtxt(os.path.join(raw_data_folder, PI_fname))
+        comp_PI = Read_EWMA_Replicate(raw_data_folder, tag, "PI", 0, 0, ch_f, row_idx, store)
         (_, start_comp_PII, lcl_comp, ucl_comp,
          _, _, _, _, _, _, _) = calEwmaStatisticsPI(
             offset, al_try, comp_PI, gamma, eff_wind_len_factor, np.mean(comp_PI))
         # Obtain Phase-II EWMA and statistics
         PII_fname = "_".join([str(row_idx), sub_str, "PII.csv"])
-        comp_PII = np.genfromtxt(os.path.join(raw_data_folder, PII_fname))
+        comp_PII = Read_EWMA_Replicate(raw_data_folder, tag, "PII", 0, 0, ch_f, row_idx, store)
         (_, _, _, _, runlen0_comp_PII,
          _, sigratio0_comp_PII, _) = calEwmaStatisticsPII(
             comp_PII, gamma, start_comp_PII,
@@ -1995,7 +2393,7 @@ def Parallel_Cal_Run_Len0(raw_data_size, raw_data_folder, base_tag, tag,
 
 
 def Parallel_Cal_Run_Len1(raw_data_size, raw_data_folder, base_tag, tag,
-                          start_PIIs, lcls, ucls, ch_idx, ga_idx, n_jobs, FLAGS):
+                          start_PIIs, lcls, ucls, ch_idx, ga_idx, n_jobs, FLAGS, store=None):
     temp_folder_name = os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), 'temp_folder')
 
     def Cal_T2_Run_Len(row_idx, raw_data_folder, tag, ch_idx, ga_idx, ucl_base):
@@ -2005,7 +2403,7 @@ def Parallel_Cal_Run_Len1(raw_data_size, raw_data_folder, base_tag, tag,
             str(ch_f).replace(".", "_"), "ewma", tag])
         logger.info("Read file %s", row_idx, extra=d)
         PII_fname = "_".join([str(row_idx), ch_sub_str, "PII.csv"])
-        base_PII = np.genfromtxt(os.path.join(raw_data_folder, PII_fname))
+        base_PII = Read_EWMA_Replicate(raw_data_folder, tag, "PII", ch_idx, ga_idx, ch_f, row_idx, store)
         fp_score_mark = base_PII > ucl_base
         (_, runlen1_base_PII, _,
          sigratio1_base_PII, _) = calEwmaStatisticsHelper(fp_score_mark)
@@ -2018,7 +2416,7 @@ def Parallel_Cal_Run_Len1(raw_data_size, raw_data_folder, base_tag, tag,
             str(ch_f).replace(".", "_"), "ewma", tag])
         logger.info("Read file %s", row_idx, extra=d)
         PII_fname = "_".join([str(row_idx), ch_sub_str, "PII.csv"])
-        comp_PII = np.genfromtxt(os.path.join(raw_data_folder, PII_fname))
+        comp_PII = Read_EWMA_Replicate(raw_data_folder, tag, "PII", ch_idx, 0, ch_f, row_idx, store)
         (_, _, _, _, runlen1_comp_PII,
          _, sigratio1_comp_PII, _) = calEwmaStatisticsPII(
             comp_PII, gamma, start_comp_PII, lcl_comp, ucl_comp)
@@ -0,0 +1,195 @@
+# Serve the prospective control chart (control_chart/monitor.py) as a local HTTP process.
+# The regressor is fitted on the first Phase-I image and the control limits on all Phase-I images, once at start.
+# Usage (from the folder Nonstationarity_Diagnostics):
+#   python monitor_service.py --PI_img_paths img1.png,img2.png --port 8765
+#   curl --data-binary @img.npy http://127.0.0.1:8765/monitor          # Summary of one Phase-II image (json).
+#   curl --data-binary @img.npy "http://127.0.0.1:8765/monitor?maps=1" # The maps as .npz.
+#   curl http://127.0.0.1:8765/stats
+# Load test with synthetic AR-2D images (the server runs in the same process):
+#   python monitor_service.py --load_test_num_imgs 50
+import numpy as np
+import tensorflow as tf
+import logging
+import sys
+import os
+import io
+import json
+import time
+import threading
+import tempfile
+import datetime as dt
+import http.client
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+from control_chart.utils import *
+from control_chart.data_generation import *
+from regression.regressors import *
+from control_chart.monitor import Spatial_EWMA_T2_Monitor
+from single_sim_call import build_parser
+from benchmark_pipeline import Generate_Bench_Img
+
+FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
+logging.basicConfig(format=FORMAT)
+d = {'clientip': '192.168.0.1', 'user': 'zkg'}
+logger = logging.getLogger('monitor_service')
+logging.getLogger('monitor_service').setLevel(logging.INFO)
+
+
+def Read_Img(img_path):
+    """ Read an image as a 2D float array from .csv, .npy or an image file (converted to gray scale). """
+    if img_path.endswith('.csv'):
+        return np.genfromtxt(img_path, delimiter=',')
+    if img_path.endswith('.npy'):
+        return np.load(img_path)
+    return np.array(Image.open(img_path).convert('L')).astype(np.float32)
+
+
+def Fit_Monitor(ls_img_arr_PI, FLAGS):
+    """ Fit the regressor on the first Phase-I image as in simulation_real_img_reg_retro, then the monitor on all of them. """
+    img_arr = np.asarray(ls_img_arr_PI[0], dtype=np.float32)
+    img_arr = (img_arr-np.mean(img_arr))/np.std(img_arr)
+    X, y, _, _ = Generate_Materials_Data(img_arr, FLAGS)
+    model_time_stamp = dt.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')
+    if FLAGS.nnet:
+        reg_model = Nnet_Reg(X, y, X, y, [10], 'l2', FLAGS.penal_param, FLAGS.stopping_lag, FLAGS.training_batch_size,
+                             FLAGS.learning_rate, True, model_time_stamp, FLAGS, normal_flag=False, cv_tasks_info=None, plot_trace_flag=False)
+    else:
+        reg_model = Linear_Reg(np.vstack(X), np.hstack(y), 10**(-8), True, model_time_stamp, FLAGS)
+    reg_model.cal_metrics(X, y, data_info='train') # Set FLAGS.mu_train and FLAGS.Sinv_train.
+    monitor = Spatial_EWMA_T2_Monitor(reg_model, FLAGS, FLAGS.spatial_ewma_sigma, FLAGS.spatial_ewma_wind_len,
+                                      alarm_level=FLAGS.alarm_level, img_norm=FLAGS.img_norm)
+    return monitor.fit(ls_img_arr_PI)
+
+
+def Make_Handler(monitor):
+    # Requests are served one at a time (HTTPServer is not threading), so the monitor and the model are not shared
+    # by concurrent requests.
+    class Monitor_Handler(BaseHTTPRequestHandler):
+        def send_body(self, body, content_type, code=200):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, obj, code=200):
+            self.send_body(json.dumps(obj).encode(), 'application/json', code)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/stats':
+                self.send_json(monitor.stats())
+            else:
+                self.send_json({'error': 'Unknown path {}.'.format(self.path)}, 404)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/monitor':
+                self.send_json({'error': 'Unknown path {}.'.format(self.path)}, 404)
+                return
+            try:
+                img_arr = np.load(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))), allow_pickle=False)
+                if img_arr.ndim != 2:
+                    raise ValueError("The image should be 2D, but its shape is {}.".format(img_arr.shape))
+                res = monitor.monitor(img_arr)
+            except Exception as err:
+                self.send_json({'error': '{}: {}'.format(type(err).__name__, err)}, 400)
+                return
+            if parse_qs(url.query).get('maps', ['0'])[0] == '1':
+                buf = io.BytesIO()
+                np.savez_compressed(buf, **{key: res[key] for key in ['t2', 'dev', 't2_alarm', 'dev_alarm', 'alarm']})
+                self.send_body(buf.getvalue(), 'application/octet-stream')
+            else:
+                self.send_json({'alarm_ratio': res['alarm_ratio'], 'img_alarm': res['img_alarm'], 'latency': res['latency'],
+                                'map_shape': list(res['alarm'].shape)})
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args, extra=d)
+
+    return Monitor_Handler
+
+
+def Load_Test(port, ls_img_arr_PII):
+    """ Send the Phase-II images one after another and report the throughput and the latency. """
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    ls_latency, ls_alarm = [], []
+    start_time = time.time()
+    for img_arr in ls_img_arr_PII:
+        buf = io.BytesIO()
+        np.save(buf, img_arr)
+        req_start_time = time.time()
+        conn.request('POST', '/monitor', body=buf.getvalue())
+        res = json.loads(conn.getresponse().read())
+        ls_latency.append(time.time()-req_start_time)
+        ls_alarm.append(res['img_alarm'])
+    run_time = time.time()-start_time
+    conn.close()
+    print("{} images in {:.2f}s: {:.2f} images/s. Latency (s) p50 {:.4f}, p95 {:.4f}, max {:.4f}. {} images alarmed.".format(
+        len(ls_img_arr_PII), run_time, len(ls_img_arr_PII)/run_time, np.percentile(ls_latency, 50), np.percentile(ls_latency, 95),
+        np.max(ls_latency), np.sum(ls_alarm)))
+
+
+def main(_):
+    tf.random.set_seed(FLAGS.rand_seed)
+    np.random.seed(FLAGS.rand_seed)
+    if not FLAGS.res_root_dir or not os.path.exists(FLAGS.res_root_dir):
+        FLAGS.res_root_dir = tempfile.mkdtemp(prefix='monitor_service_')
+    FLAGS.training_res_folder = os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder)
+    if not os.path.exists(FLAGS.training_res_folder):
+        os.makedirs(FLAGS.training_res_folder)
+    if not FLAGS.reg_model:
+        FLAGS.reg_model = 'lin'
+
+    if FLAGS.PI_img_paths:
+        ls_img_arr_PI = [Read_Img(img_path) for img_path in FLAGS.PI_img_paths.split(',')]
+    else:
+        ls_img_arr_PI = [Generate_Bench_Img(FLAGS.load_test_img_size, FLAGS.rand_seed+idx) for idx in range(5)]
+    monitor = Fit_Monitor(ls_img_arr_PI, FLAGS)
+
+    server = HTTPServer(('127.0.0.1', FLAGS.port), Make_Handler(monitor))
+    logger.info("The monitor is serving at http://127.0.0.1:%s.", server.server_address[1], extra=d)
+    if FLAGS.load_test_num_imgs > 0:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        ls_img_arr_PII = [Generate_Bench_Img(ls_img_arr_PI[0].shape[0], FLAGS.rand_seed+100+idx) for idx in range(FLAGS.load_test_num_imgs)]
+        Load_Test(server.server_address[1], ls_img_arr_PII)
+        server.shutdown()
+    else:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+
+    parser.add_argument(
+        "--PI_img_paths",
+        type=str,
+        default="",
+        help="The Phase-I images (.csv, .npy or image files), separated by comma. If empty, synthetic AR-2D images are used.")
+
+    parser.add_argument(
+        "--img_norm",
+        type=str,
+        default="PI",
+        help="PI: standardize all images with the mean and std of Phase-I images; self: standardize each image by itself.")
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="The port of the local HTTP server. 0 picks a free port.")
+
+    parser.add_argument(
+        "--load_test_num_imgs",
+        type=int,
+        default=0,
+        help="If positive, send this number of synthetic Phase-II images to the server, report images/sec and exit.")
+
+    parser.add_argument(
+        "--load_test_img_size",
+        type=int,
+        default=128,
+        help="The size of the synthetic images when no Phase-I image is given.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -22,6 +22,7 @@ from sklearn.metrics import roc_curve, auc, accuracy_score, precision_score, rec
 
 from control_chart.utils import *
 from control_chart.hotelling import *
+from control_chart.grad_pool import Grad_Worker_Pool
 
 # Cross-validation:
 # 1 factors 8 combinations, 5 replication, 10 folds, 24 cores, max_steps=50000. Took 40 mins.
@@ -572,17 +573,11 @@ class Nnet_Reg(object):
                 **grad_func_kwargs)
         self.penal_matrix = np.diag(self.penal_vec)
 
-    def cal_metrics(self, X, y, data_info='train'):
-        """ 
-            X: Predictor matrix
-            y: In shape (-1, 1)
-        
-        """
-        print("Calculate scores for {}...".format(data_info))
-        start_time = time.time()
+    def cal_grads(self, X, y):
+        """ The per-sample gradients (negative scores) only, without the statistics of cal_metrics. """
         # Cannot directly pass member function into a function that use joblib and that function as parameter.
         # https://stackoverflow.com/a/50704372/4307919
-        from regression.regressors_nnet_utils import obj_grad, loss_reg, loss_pois, residual_reg, residual_pois, dev_reg, dev_pois, fisher_mat_score_cov
+        from regression.regressors_nnet_utils import obj_grad, loss_reg, loss_pois
         grad_func = obj_grad
         grad_func_kwargs = {'model':self.model, 'loss':loss_reg, 'penal_param':self.penal_param}
         grad_func_paral_kwargs = {'model_weights':self.model.get_weights(), 'loss':loss_reg, 'penal_param':self.penal_param}
@@ -592,7 +587,53 @@ class Nnet_Reg(object):
         elif self.FLAGS.reg_model == 'pois' or self.FLAGS.reg_model == 'nnet_pois':
             grad_func_paral_kwargs['loss']=grad_func_kwargs['loss']=loss_pois
 
-        grads = grad_func_batch_paral(X, y, Build_Model, self.build_model_param, grad_func, **grad_func_paral_kwargs)
+        if getattr(self.FLAGS, 'grad_engine', 'paral') == 'vec' and self.FLAGS.activation in ACTI_FUNC:
+            # Closed-form backpropagation for all samples at once instead of one GradientTape per sample.
+            loss_name = 'pois' if self.FLAGS.reg_model in ['pois', 'nnet_pois'] else 'reg'
+            grads = grad_func_batch_vec(X, y, self.model.get_weights(), self.FLAGS.activation, loss_name, self.penal_param)
+        elif getattr(self.FLAGS, 'grad_engine', 'paral') == 'pool':
+            # The workers (with TensorFlow and the model) are started at the first call and kept for later calls.
+            if getattr(self, 'grad_pool', None) is None:
+                self.grad_pool = Grad_Worker_Pool(Build_Model, self.build_model_param, grad_func,
+                                                  num_workers=getattr(self.FLAGS, 'grad_n_jobs', 0) or GRAD_POOL_NUM_WORKERS,
+                                                  loss=grad_func_kwargs['loss'], penal_param=self.penal_param)
+            self.grad_pool.set_weights(self.model.get_weights())
+            grads = self.grad_pool.grads(X, y)
+        else:
+            grads = grad_func_batch_paral(X, y, Build_Model, self.build_model_param, grad_func,
+                                          num_blocks=getattr(self.FLAGS, 'grad_n_jobs', 0) or UTIL_TASK_NJOBS, **grad_func_paral_kwargs)
+        return grads
+
+    def cal_grads_dev(self, X, y):
+        """ The per-sample gradients (negative scores) and deviances only, as in cal_metrics but without the Fisher
+            information matrix, the score mean and inverse covariance, or the R-squared (e.g. for monitoring one image).
+        """
+        from regression.regressors_nnet_utils import residual_reg, residual_pois, dev_reg, dev_pois
+        grads = self.cal_grads(X, y)
+        if self.FLAGS.reg_model == 'lin' or self.FLAGS.reg_model == 'nnet_lin':
+            _, pred = residual_reg(X, y, self.model)
+            dev = dev_reg(pred, y)
+        elif self.FLAGS.reg_model == 'pois' or self.FLAGS.reg_model == 'nnet_pois':
+            _, pred = residual_pois(X, y, self.model)
+            dev = dev_pois(pred, y)
+        return grads, dev.reshape((-1,))
+
+    def close_grad_pool(self):
+        """ Stop the workers of the gradient pool of grad_engine 'pool', if any. """
+        if getattr(self, 'grad_pool', None) is not None:
+            self.grad_pool.close()
+            self.grad_pool = None
+
+    def cal_metrics(self, X, y, data_info='train'):
+        """ 
+            X: Predictor matrix
+            y: In shape (-1, 1)
+        
+        """
+        print("Calculate scores for {}...".format(data_info))
+        start_time = time.time()
+        from regression.regressors_nnet_utils import residual_reg, residual_pois, dev_reg, dev_pois, fisher_mat_score_cov
+        grads = self.cal_grads(X, y)
         print("The calculation for {} takes {}s.".format(data_info, time.time()-start_time))
         fisher_info_mat = fisher_mat_score_cov(grads, fisher_nugget=0, penal_matrix=None)
         
@@ -1519,9 +1560,16 @@ class Linear_Reg(object):
         print(X_train.shape,y_train.shape)
         # alphas = 10.0**np.arange(-4, 1)  # The penalization parameter to try.
         # The cross-validation gives the best Ridge parameter as 0.1.
-        reg_ridge_cv = RidgeCV(alphas=10.0**np.arange(-8, 9))
         print(np.where(np.isnan(X_train)), np.where(np.isnan(y_train)))
-        reg_ridge_cv.fit(X_train, y_train)
+        if getattr(FLAGS, 'lin_engine', 'sklearn') == 'analytic':
+            # The cross-validation and the refit with the best alpha share one eigen-decomposition of the Gram matrix.
+            from regression.regressors_lin_utils import ridgeGCVEigen, ridgeFromCoef
+            alpha, coef, intercept, _ = ridgeGCVEigen(X_train, y_train, 10.0**np.arange(-8, 9))
+            reg_ridge_cv = ridgeFromCoef(alpha, coef, intercept)
+            reg_ridge_cv.alpha_ = alpha
+        else:
+            reg_ridge_cv = RidgeCV(alphas=10.0**np.arange(-8, 9))
+            reg_ridge_cv.fit(X_train, y_train)
         logger.info(
             "The Ridge cv coef: {};\nThe intercept: {};\nThe penalization param: {}.\n".format(
                 reg_ridge_cv.coef_,
@@ -1533,8 +1581,12 @@ class Linear_Reg(object):
         self.reg_ridge_cv = reg_ridge_cv
 
         if self.train_PI_flag:
-            self.reg = Ridge(alpha=reg_ridge_cv.alpha_, max_iter=20000)
-            self.reg.fit(X_train, y_train)
+            if getattr(FLAGS, 'lin_engine', 'sklearn') == 'analytic':
+                # Ridge with the best alpha has the same solution as the one from the cross-validation.
+                self.reg = ridgeFromCoef(reg_ridge_cv.alpha_, reg_ridge_cv.coef_, reg_ridge_cv.intercept_)
+            else:
+                self.reg = Ridge(alpha=reg_ridge_cv.alpha_, max_iter=20000)
+                self.reg.fit(X_train, y_train)
             param = np.array(np.append(self.reg.coef_, self.reg.intercept_), ndmin=2)
             logger.info(
                 "The parameter of ridge regression model (%s) is\n %s",
@@ -1556,17 +1608,39 @@ class Linear_Reg(object):
             extra=d)
 
     
+    def cal_grads(self, X, y):
+        """ The per-sample gradients (negative scores) only, without the statistics of cal_metrics. """
+        from regression.regressors_lin_utils import calGradient
+        return calGradient(self.reg, X, y)[1]
+
+    def cal_grads_dev(self, X, y):
+        """ The per-sample gradients (negative scores) and deviances only, as in cal_metrics but without the Fisher
+            information matrix, the score mean and inverse covariance, or the R-squared (e.g. for monitoring one image).
+        """
+        from regression.regressors_lin_utils import calGradient, calDev
+        pred, grads = calGradient(self.reg, X, y)
+        return grads, calDev(pred, y).reshape((-1,))
+
     def cal_metrics(self, X, y, data_info='train'):
         """
             X: Predictor matrix.
             y: In shape (-1,).
         
         """
-        from regression.regressors_lin_utils import calGradientFisher, calDev
-        pred, grads, fisher_info_mat = calGradientFisher(self.reg, X, y, fisher_nugget=self.penal_param)
+        from regression.regressors_lin_utils import calGradientFisher, calGradientFisherAnalytic, calDev
+        if getattr(self.FLAGS, 'lin_engine', 'sklearn') == 'analytic':
+            # Closed-form scores and Fisher information accumulated in chunks. Each of the score covariance and the
+            # Fisher information matrix is inverted from one eigen-decomposition.
+            pred, grads, fisher_info_mat, score_cov = calGradientFisherAnalytic(self.reg, X, y, fisher_nugget=self.penal_param)
+            mu = np.mean(-grads, axis=0) # Score mean
+            Sinv = Inv_Mat_Rcond_Eigh(score_cov, self.FLAGS.nugget) # Score variance
+            inv_fisher_info_mat = Inv_Mat_Rcond_Eigh(fisher_info_mat, self.FLAGS.nugget)
+        else:
+            pred, grads, fisher_info_mat = calGradientFisher(self.reg, X, y, fisher_nugget=self.penal_param)
 
-        mu = np.mean(-grads, axis=0) # Score mean
-        Sinv = Inv_Cov(-grads, self.FLAGS.nugget) # Score variance
+            mu = np.mean(-grads, axis=0) # Score mean
+            Sinv = Inv_Cov(-grads, self.FLAGS.nugget) # Score variance
+            inv_fisher_info_mat = None
 
         resi = y-pred
         abs_resi = np.absolute(resi)
@@ -1577,6 +1651,8 @@ class Linear_Reg(object):
             logger.info("The training score mean is {}.".format(self.FLAGS.mu_train), extra=d)
             logger.info("The training score Sinv is {}.".format(self.FLAGS.Sinv_train), extra=d)
             self.FLAGS.best_r2_train = r2_score(y, pred)
+            if inv_fisher_info_mat is not None:
+                self.FLAGS.inv_fisher_info_mat_train = inv_fisher_info_mat
         elif data_info == 'PI':
             self.FLAGS.mu_PI, self.FLAGS.Sinv_PI, self.FLAGS.fisher_info_mat_PI = mu, Sinv, fisher_info_mat
             # self.FLAGS.mu_train = self.FLAGS.mu_PI
@@ -5,6 +5,8 @@ import tensorflow as tf
 import logging
 import matplotlib.pyplot as plt
 from sklearn.metrics import roc_curve, auc, accuracy_score, precision_score, recall_score, r2_score
+from sklearn.linear_model import Ridge
+from constants import GRAD_CHUNK_SIZE
 
 FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
 logging.basicConfig(format=FORMAT)
@@ -81,3 +83,74 @@ def calCumErr(abs_resi_PI, pred_PII, y_PII):
     cum_abs_resi_PII = cum_abs_resi_PI_PII[len(abs_resi_PI):]
     return (cum_abs_resi_PI, cum_abs_resi_PII,
             abs_resi_PII, abs_resi_PI_PII)
+
+# The analytic fast path of the Gaussian linear model (Linear_Reg with lin_engine 'analytic'). The score of a
+# sample is the residual times its design row and the Fisher information matrix is from the Gram matrix, so both
+# are accumulated over chunks of samples without forming the design matrix with the intercept column at once.
+def ridgeGCVEigen(X, y, alphas, chunk_size=GRAD_CHUNK_SIZE):
+    """ The same choice of penalization parameter (and coefficients) as RidgeCV(alphas) with its default
+        leave-one-out (generalized) cross-validation, from one eigen-decomposition of the centered Gram matrix
+        instead of the SVD of X, and with X read in chunks.
+
+        Returns:
+            The best alpha, coef, intercept and the leave-one-out mean squared errors of all alphas.
+    """
+    n = X.shape[0]
+    x_mean = np.zeros(X.shape[1])
+    for start in range(0, n, chunk_size):
+        x_mean += np.sum(X[start:start+chunk_size], axis=0, dtype=np.float64)
+    x_mean /= n
+    y_mean = np.mean(y, dtype=np.float64)
+    gram, xty = np.zeros((X.shape[1], X.shape[1])), np.zeros(X.shape[1])
+    for start in range(0, n, chunk_size):
+        X_chunk = X[start:start+chunk_size].astype(np.float64)-x_mean
+        gram += np.matmul(X_chunk.T, X_chunk)
+        xty += np.matmul(X_chunk.T, y[start:start+chunk_size]-y_mean)
+    eig_vals, eig_vecs = np.linalg.eigh(gram)
+    eig_vals = np.clip(eig_vals, 0, None)
+    proj_xty = np.matmul(eig_vecs.T, xty)
+
+    # The hat matrix of ridge regression with an unpenalized intercept is 1/n+X_c(X_c'X_c+alpha*I)^{-1}X_c'.
+    loo_sq_err = np.zeros(len(alphas))
+    for start in range(0, n, chunk_size):
+        proj_X = np.matmul(X[start:start+chunk_size].astype(np.float64)-x_mean, eig_vecs)
+        y_chunk = y[start:start+chunk_size]-y_mean
+        for idx, alpha in enumerate(alphas):
+            shrink = 1/(eig_vals+alpha)
+            resi = y_chunk-np.matmul(proj_X, proj_xty*shrink)
+            hat_diag = 1/n+np.matmul(proj_X**2, shrink)
+            loo_sq_err[idx] += np.sum((resi/(1-hat_diag))**2)
+    loo_sq_err /= n
+    best_alpha = alphas[np.argmin(loo_sq_err)]
+    coef = np.matmul(eig_vecs, proj_xty/(eig_vals+best_alpha))
+    return best_alpha, coef, y_mean-np.dot(x_mean, coef), loo_sq_err
+
+def calGradientFisherAnalytic(reg, X, y, fisher_nugget=0, chunk_size=GRAD_CHUNK_SIZE):
+    """ The same prediction, gradients and Fisher information matrix as calGradientFisher, and the covariance
+        of the scores (the matrix inverted by Inv_Cov), in one pass over chunks of X.
+    """
+    n, dim = X.shape[0], X.shape[1]+1
+    coef = np.append(reg.coef_, reg.intercept_)
+    pred = np.zeros(n)
+    grads = np.zeros((n, dim))
+    gram, grads_gram, grads_sum = np.zeros((dim, dim)), np.zeros((dim, dim)), np.zeros(dim)
+    for start in range(0, n, chunk_size):
+        design_chunk = np.append(X[start:start+chunk_size], np.ones([min(chunk_size, n-start), 1]), axis=1)
+        pred[start:start+chunk_size] = reg.predict(X[start:start+chunk_size])
+        grads_chunk = np.vstack(pred[start:start+chunk_size]-y[start:start+chunk_size])*design_chunk
+        grads[start:start+chunk_size] = grads_chunk
+        gram += np.matmul(design_chunk.T, design_chunk)
+        grads_gram += np.matmul(grads_chunk.T, grads_chunk)
+        grads_sum += np.sum(grads_chunk, axis=0)
+    fisher_info_mat = 2.0*gram/n
+    if fisher_nugget > 0:
+        fisher_info_mat = fisher_info_mat + fisher_nugget*penalMatrix(dim)
+    grads_mu = grads_sum/n
+    score_cov = grads_gram/n-np.outer(grads_mu, grads_mu)
+    return pred, grads, fisher_info_mat, score_cov
+
+def ridgeFromCoef(alpha, coef, intercept, max_iter=20000):
+    """ A fitted Ridge(alpha) with the given solution, e.g., from ridgeGCVEigen, without fitting it again. """
+    reg = Ridge(alpha=alpha, max_iter=max_iter)
+    reg.coef_, reg.intercept_, reg.n_features_in_ = coef, intercept, len(coef)
+    return reg
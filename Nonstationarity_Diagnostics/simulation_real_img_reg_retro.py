@@ -17,6 +17,8 @@ from control_chart.utils import *
 from control_chart.data_generation import *
 from regression.regressors import *
 from control_chart.hotelling import *
+from control_chart.artifact_cache import Artifact_Cache, Artifact_Cache_Key
+from control_chart.tiled_retro import Image_Mean_Std_Chunked, Tiled_Real_Img_Reg_Retro
 
 # %%
 FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s(%(funcName)s)[%(lineno)d]: %(message)s'
@@ -27,10 +29,52 @@ logging.getLogger('simulation_real_img_reg_retro').setLevel(logging.INFO)
 
 # This function reads real image and do the unsupervised learning to find different materials.
 
+def simulation_real_img_reg_retro_tiled(FLAGS):
+    """ The retrospective analysis of an image too large for memory (FLAGS.tiled_mode).
+
+        A .npy image is memory-mapped. The regressor is fitted on the center crop of side FLAGS.tiled_train_size,
+        then the scores and the spatial EWMA-T2 of the whole image are computed tile by tile into .npy files.
+    """
+    FLAGS.real_img_abs_path = os.path.join(FLAGS.res_root_dir, FLAGS.real_img_path)
+    if FLAGS.real_img_abs_path.endswith('.npy'):
+        img_arr = np.load(FLAGS.real_img_abs_path, mmap_mode='r')
+    elif FLAGS.real_img_abs_path.endswith('.csv'):
+        img_arr = np.genfromtxt(FLAGS.real_img_abs_path, delimiter=',')
+    else:
+        img_arr = np.array(Image.open(FLAGS.real_img_abs_path).convert('L'))
+    img_mean, img_std = Image_Mean_Std_Chunked(img_arr)
+    FLAGS.img_hei, FLAGS.img_wid = img_arr.shape
+    FLAGS.training_res_folder = os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder)
+    if not os.path.exists(FLAGS.training_res_folder):
+        os.makedirs(FLAGS.training_res_folder)
+
+    # Fit the regressor on the center crop.
+    train_hei, train_wid = min(FLAGS.tiled_train_size, FLAGS.img_hei), min(FLAGS.tiled_train_size, FLAGS.img_wid)
+    row_start, col_start = (FLAGS.img_hei-train_hei)//2, (FLAGS.img_wid-train_wid)//2
+    train_img_arr = (np.asarray(img_arr[row_start:row_start+train_hei, col_start:col_start+train_wid], dtype=np.float32)-img_mean)/img_std
+    X, y, _, _ = Generate_Materials_Data(train_img_arr, FLAGS)
+    model_time_stamp = dt.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')
+    if FLAGS.nnet:
+        penal_param = FLAGS.penal_param
+        reg_model = Nnet_Reg(X, y, X, y, [10], 'l2', penal_param, FLAGS.stopping_lag, FLAGS.training_batch_size,
+                             FLAGS.learning_rate, True, model_time_stamp, FLAGS, normal_flag=False, cv_tasks_info=None, plot_trace_flag=True)
+    else:
+        penal_param = 10**(-8)
+        reg_model = Linear_Reg(np.vstack(X), np.hstack(y), penal_param, True, model_time_stamp, FLAGS)
+    reg_model.cal_metrics(X, y, data_info='train')
+    FLAGS = reg_model.FLAGS
+    del X, y, train_img_arr
+
+    fig_name = '_'.join([str(FLAGS.rand_seed), 'sim_real_reg_2d_score_retro_tiled', str(penal_param).replace('.', '_')])+'.png'
+    Tiled_Real_Img_Reg_Retro(img_arr, reg_model, FLAGS, img_mean=img_mean, img_std=img_std, fig_name=fig_name)
+
+
 def simulation_real_img_reg_retro(FLAGS):
     """ Real 2d regression model simulation. """
     tf.random.set_seed(FLAGS.rand_seed)
     np.random.seed(seed=FLAGS.rand_seed)
+    if FLAGS.tiled_mode:
+        return simulation_real_img_reg_retro_tiled(FLAGS)
 
     # Read real image
     # In case the input image is not in .csv format.
@@ -51,6 +95,9 @@ def simulation_real_img_reg_retro(FLAGS):
         FLAGS.real_img_abs_path = csv_file_path
     
     img_arr = np.genfromtxt(FLAGS.real_img_abs_path, delimiter=',')
+    # The fitted regressor and the scores only depend on the image and some of FLAGS, so they are reused from cache.
+    use_artifact_cache = getattr(FLAGS, 'use_artifact_cache', 0)
+    cache_key = Artifact_Cache_Key(img_arr, FLAGS)
     # We need to normalize the image for the purpose of computation.
     img_arr = (img_arr.astype(np.float32)-np.mean(img_arr))/np.std(img_arr)
 
@@ -96,6 +143,14 @@ def simulation_real_img_reg_retro(FLAGS):
 
     model_time_stamp = dt.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')
 
+    if use_artifact_cache:
+        artifact_cache = Artifact_Cache(FLAGS.artifact_cache_dir if FLAGS.artifact_cache_dir else os.path.join(FLAGS.res_root_dir, ARTIFACT_CACHE_FOLDER))
+        cache_entry = artifact_cache.get(cache_key)
+    else:
+        cache_entry = None
+    # The FLAGS fields added in Step 1 (e.g., mu_train, Sinv_train) are stored in cache together with scores.
+    flags_keys_before = set(vars(FLAGS))
+
     if FLAGS.nnet:
         penal = "l2"
         hidden_layer_sizes = [10]
@@ -114,7 +169,7 @@ def simulation_real_img_reg_retro(FLAGS):
 
         # Don't have trained parameters for neural network
         # if not os.path.isfile(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv']))):
-        if True:
+        if cache_entry is None:
             if not os.path.exists(FLAGS.training_res_folder):
                 os.makedirs(FLAGS.training_res_folder)
 
@@ -149,20 +204,23 @@ def simulation_real_img_reg_retro(FLAGS):
             #     os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
             #         ['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PI.csv'])),
             #     score_PI, fmt='%.5e', delimiter=',')
-            PII_score_path = os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv']))
-            np.savetxt(PII_score_path, score_PII, fmt='%.5e', delimiter=',')
-            logger.info("The score data has been stored at {}.".format(PII_score_path))
+            # With the artifact cache, the scores are stored in the cache entry instead.
+            if not use_artifact_cache:
+                PII_score_path = os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv']))
+                np.savetxt(PII_score_path, score_PII, fmt='%.5e', delimiter=',')
+                logger.info("The score data has been stored at {}.".format(PII_score_path))
         else:
-            FLAGS = pickle.load(open(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), 'sim_flags.h5'), 'rb'))
-            # score_PI = np.genfromtxt(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
-            #     ['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PI.csv'])), delimiter=',')
-            score_PII = np.genfromtxt(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
-                ['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv'])), delimiter=',')
+            # FLAGS = pickle.load(open(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), 'sim_flags.h5'), 'rb'))
+            # score_PII = np.genfromtxt(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
+            #     ['nnet_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv'])), delimiter=',')
+            score_PII = cache_entry[0]['score_PII']
+            for name, val in cache_entry[1].items():
+                setattr(FLAGS, name, val)
     else:  # Linear regression
         penal_param = 10**(-8)
 
         # if not os.path.exists(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(['lin_reg', str(penal_param).replace('.', '_'), 'score_PII.csv']))):
-        if True:
+        if cache_entry is None:
             # (model, mu_train, Sinv_train, _, _, _, _, _, _, grads_PI, grads_PII,
             #  fisher_info_mat_train, _, cum_abs_resi_PI, cum_abs_resi_PII,
             #  _, abs_resi_PI, abs_resi_PII, _, dev_PI, dev_PII) = Linear_Model_Cum_ewma_resi_ewma_dev(
@@ -177,8 +235,11 @@ def simulation_real_img_reg_retro(FLAGS):
             # score_PI = np.array((-1)*grads_PI)
             score_PII = np.array((-1)*grads_PII)
 
-            inv_fisher_info_mat_train = Inv_Mat_Rcond(
-                FLAGS.fisher_info_mat_train , FLAGS.nugget)
+            if getattr(FLAGS, 'inv_fisher_info_mat_train', None) is not None: # From the analytic engine of Linear_Reg.
+                inv_fisher_info_mat_train = FLAGS.inv_fisher_info_mat_train
+            else:
+                inv_fisher_info_mat_train = Inv_Mat_Rcond(
+                    FLAGS.fisher_info_mat_train , FLAGS.nugget)
 
             S_train = Inv_Mat_Rcond(FLAGS.Sinv_train, FLAGS.nugget)
 
@@ -192,16 +253,25 @@ def simulation_real_img_reg_retro(FLAGS):
             #     os.path.join(FLAGS.training_res_folder, '_'.join(
             #         ['lin_real_reg', str(penal_param).replace('.', '_'), 'score_PI.csv'])),
             #     score_PI, fmt='%.5e', delimiter=',')
-            PII_score_path = os.path.join(FLAGS.training_res_folder, '_'.join(['lin_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv']))
-            np.savetxt(PII_score_path, score_PII, fmt='%.5e', delimiter=',')
-            logger.info("The score data has been stored at {}.".format(PII_score_path))
+            # With the artifact cache, the scores are stored in the cache entry instead.
+            if not use_artifact_cache:
+                PII_score_path = os.path.join(FLAGS.training_res_folder, '_'.join(['lin_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv']))
+                np.savetxt(PII_score_path, score_PII, fmt='%.5e', delimiter=',')
+                logger.info("The score data has been stored at {}.".format(PII_score_path))
         else:
-            FLAGS = pickle.load(open(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), 'sim_flags.h5'), 'rb'))
-            # score_PI = np.genfromtxt(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
-            #     ['lin_real_reg', str(penal_param).replace('.', '_'), 'score_PI.csv'])), delimiter=',')
-            score_PII = np.genfromtxt(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
-                ['lin_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv'])), delimiter=',')
-
+            # FLAGS = pickle.load(open(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), 'sim_flags.h5'), 'rb'))
+            # score_PII = np.genfromtxt(os.path.join(os.path.join(FLAGS.res_root_dir, FLAGS.model_file_folder), '_'.join(
+            #     ['lin_real_reg', str(penal_param).replace('.', '_'), 'score_PII.csv'])), delimiter=',')
+            score_PII = cache_entry[0]['score_PII']
+            for name, val in cache_entry[1].items():
+                setattr(FLAGS, name, val)
+
+    if use_artifact_cache and cache_entry is None:
+        artifact_cache.put(
+            cache_key, {'score_PII': score_PII},
+            {name: val for name, val in vars(FLAGS).items() if name not in flags_keys_before},
+            info={'img': FLAGS.real_img_path, 'reg_model': FLAGS.reg_model, 'nnet': FLAGS.nnet,
+                  'wind_hei': FLAGS.wind_hei, 'wind_wid': FLAGS.wind_wid, 'penal_param': penal_param})
     
     # (FLAGS.mu_train, FLAGS.Sinv_train, FLAGS.moni_stat_hei, FLAGS.moni_stat_wid) = (
     #     mu_train, Sinv_train, moni_stat_hei, moni_stat_wid)
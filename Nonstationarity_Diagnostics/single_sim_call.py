@@ -39,7 +39,8 @@ def main(_):
     pickle.dump(FLAGS, open(flags_archive_path, 'wb'))
 
 
-if __name__ == "__main__":
+def build_parser():
+    """ The argument parser of the simulations. It is also used to get the default FLAGS elsewhere (e.g., benchmarks). """
     parser = argparse.ArgumentParser()
     parser.register("type", "bool", lambda v: v.lower() == "true")
     parser.add_argument(
@@ -174,6 +175,20 @@ if __name__ == "__main__":
         default=2.0,
         help="Multiplier of effective window length (times 1/ewma_parameter).")
 
+    parser.add_argument(
+        "--run_len_engine",
+        type=str,
+        default="batch",
+        help="How the bisection of the alarm level calculates the run lengths of the simulated replicates. "
+             "batch: all replicates as 2D arrays, read once, with the EWMA calculated once per gamma; "
+             "loop: the replicates one by one, read in each iteration")
+
+    parser.add_argument(
+        "--run_len_num_cands",
+        type=int,
+        default=1,
+        help="The number of alarm levels tried per pass of the bisection with run_len_engine batch (1: the same as loop).")
+
     # Add just the size of Phase-I and Phase-II(assume they are the same)
     parser.add_argument(
         "--PII_len",
@@ -264,6 +279,28 @@ if __name__ == "__main__":
         type=int,
         default=0,
         help="Whether add activation at output layer.")
+    parser.add_argument(
+        "--grad_engine",
+        type=str,
+        default="paral",
+        help="The engine to calculate per-sample gradients of neural network. "
+             "vec: closed-form backpropagation for all samples in batch; "
+             "paral: one GradientTape per sample in parallel jobs; "
+             "pool: one GradientTape per sample in a persistent pool of workers holding the model")
+
+    parser.add_argument(
+        "--lin_engine",
+        type=str,
+        default="analytic",
+        help="The engine of the linear regression model. "
+             "analytic: closed-form scores and Fisher information in chunks, one eigen-decomposition for the ridge cv and refit; "
+             "sklearn: RidgeCV, Ridge and the generic score statistics")
+
+    parser.add_argument(
+        "--grad_n_jobs",
+        type=int,
+        default=0,
+        help="The number of parallel jobs (grad_engine paral) or workers (grad_engine pool) for per-sample gradients. 0 means the default of each engine.")
 
     parser.add_argument(
         "--N_rep_find_gamma",
@@ -353,6 +390,14 @@ if __name__ == "__main__":
         default=200,
         help="The size of image of artificially generated samples.")
 
+    parser.add_argument(
+        "--regen_engine",
+        type=str,
+        default="serial",
+        help="The regeneration of images using trained model. "
+             "serial: one pixel per model call, column by column; "
+             "wavefront: all pixels whose causal windows are complete in one model call (see Causal_Wavefronts)")
+
     # ---------------------------------------------------------------------------
     # For autoregressive model. Read the coefficient file.
     parser.add_argument(
@@ -385,6 +430,14 @@ if __name__ == "__main__":
         default=4,
         help="The window width for generating autoregressive image, better to be odd number.")
 
+    parser.add_argument(
+        "--ar_2d_engine",
+        type=str,
+        default="loop",
+        help="The generation of autoregressive 2D images (see Generate_AR_2D_Data). "
+             "loop: pixel by pixel, column by column; "
+             "wavefront: one anti-diagonal of pixels at a time (see Generate_AR_2D_Data_Wavefront)")
+
     # ---------------------------------------------------------------------------
     # For running CNN on cpu.
     parser.add_argument(
@@ -486,6 +539,23 @@ if __name__ == "__main__":
         type=int,
         default=10,
         help="The maximum number of clusters to try using kmeans.")
+
+    parser.add_argument(
+        "--km_engine",
+        type=str,
+        default="full",
+        help="The k-means sweep over the number of clusters. "
+             "full: k-means++ for each number of clusters; "
+             "warm: each number of clusters starts from the centers of one cluster less; "
+             "minibatch: as warm with mini-batch k-means")
+
+    parser.add_argument(
+        "--pca_engine",
+        type=str,
+        default="dense",
+        help="The PCA of the spatial EWMA of scores before clustering. "
+             "dense: eigendecomposition of the covariance of the whole centered score matrix; "
+             "chunked: the covariance is accumulated and the scores are projected chunk by chunk into a temporary memory-mapped file")
     
     parser.add_argument(
         "--loc_coord_wei",
@@ -513,6 +583,42 @@ if __name__ == "__main__":
         # default='/home/ghhgkz/scratch/Data/texture/Brodatz/Nat-5c.pgm',
         help="The path of real image to be processed.")
 
+    parser.add_argument(
+        "--use_artifact_cache",
+        type=int,
+        default=0,
+        help="Whether reuse the fitted regressor and scores of the same image and settings from the artifact cache.")
+
+    parser.add_argument(
+        "--artifact_cache_dir",
+        type=str,
+        default="",
+        help="The folder of the artifact cache. Empty means res_root_dir/artifact_cache.")
+
+    parser.add_argument(
+        "--tiled_mode",
+        type=int,
+        default=0,
+        help="Whether run the retrospective analysis tile by tile with memory-mapped scores and T2 (for images too large for memory).")
+
+    parser.add_argument(
+        "--tile_max_rss_mb",
+        type=float,
+        default=2048,
+        help="The peak resident memory (MB) that the tiled mode sizes its tiles for.")
+
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=0,
+        help="The side of the tiles in the tiled mode. 0 means it is chosen from tile_max_rss_mb.")
+
+    parser.add_argument(
+        "--tiled_train_size",
+        type=int,
+        default=512,
+        help="The side of the center crop of the image that the regressor is fitted on in the tiled mode.")
+
     parser.add_argument(
         "--real_img_folder",
         type=str,
@@ -882,5 +988,10 @@ if __name__ == "__main__":
         default=2020,
         help="The ending year of PII data.")
 
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
     FLAGS, unparsed = parser.parse_known_args()
     tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
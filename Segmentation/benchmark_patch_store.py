@@ -0,0 +1,149 @@
+# %%
+# Compare the sustained read throughput of image patches stored as one png file per patch and as .npy shards.
+from constants import *
+import os
+import shutil
+import numpy as np
+import tensorflow as tf
+import argparse
+import time
+import sys
+from PIL import Image
+
+from seg_utils.generate_collages import *
+from seg_utils.datagenerator import *
+
+
+def gen_synthetic_micrographs(img_folder, img_lab_folder, num_imgs, img_hei, img_wid, num_classes):
+    """ Random RGB images with piecewise constant labels, in case no real micrographs are given. """
+    for folder in [img_folder, img_lab_folder]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    for idx in range(num_imgs):
+        lab_arr = np.random.randint(0, num_classes, size=(img_hei//32+1, img_wid//32+1)).repeat(32, axis=0).repeat(32, axis=1)[:img_hei, :img_wid]
+        img_arr = np.random.randint(0, 256, size=(img_hei, img_wid, 3))
+        Image.fromarray(img_arr.astype(np.uint8), mode='RGB').save(os.path.join(img_folder, '{}.png'.format(idx)))
+        Image.fromarray(lab_arr.astype(np.uint8), mode='L').save(os.path.join(img_lab_folder, '{}_L.png'.format(idx)))
+
+
+def read_throughput(data_file, mode, num_batches, FLAGS):
+    """ Patches per second of LabTextureDataGenerator reading from data_file, after one batch of warm up. """
+    data = LabTextureDataGenerator(data_file, mode=mode, batch_size=FLAGS.batch_size, num_classes=FLAGS.num_classes)
+    num_patches, start_time = 0, None
+    for step, batch in enumerate(data.data.repeat() if mode == 'inference' else data.data):
+        if step == 0:
+            start_time = time.time()
+            continue
+        num_patches += batch[0].shape[0]
+        if step == num_batches:
+            break
+    return num_patches/(time.time()-start_time)
+
+
+def main(_):
+    np.random.seed(RND_SEED)
+    if FLAGS.img_folder:
+        img_folder, img_lab_folder = FLAGS.img_folder, FLAGS.img_lab_folder
+        lab_fname_func = lambda fn: fn.replace('.png', FLAGS.lab_suffix+'.png')
+    else:
+        img_folder, img_lab_folder = os.path.join(FLAGS.save_folder, 'images'), os.path.join(FLAGS.save_folder, 'labels')
+        gen_synthetic_micrographs(img_folder, img_lab_folder, FLAGS.num_imgs, FLAGS.img_hei, FLAGS.img_wid, FLAGS.num_classes)
+        lab_fname_func = lambda fn: fn.replace('.png', '_L.png')
+
+    ls_res = []
+    for patch_store in ['png', 'shards']:
+        store_folder = os.path.join(FLAGS.save_folder, patch_store)
+        if os.path.exists(store_folder):
+            shutil.rmtree(store_folder)
+        os.makedirs(store_folder)
+        start_time = time.time()
+        if patch_store == 'png':
+            generate_image_patches(img_folder, img_lab_folder, store_folder, 'valid', lab_fname_func, stride=FLAGS.stride, patch_size=IMG_SIZE)
+            data_file = os.path.join(store_folder, 'valid.txt')
+        else:
+            generate_image_patch_shards(img_folder, img_lab_folder, store_folder, 'valid', lab_fname_func, stride=FLAGS.stride, patch_size=IMG_SIZE)
+            data_file = patch_shard_index_path(store_folder, 'valid')
+        gen_time = time.time()-start_time
+        num_files = np.sum([len(files) for _, _, files in os.walk(store_folder)])
+        size = np.sum([os.path.getsize(os.path.join(root, fn)) for root, _, files in os.walk(store_folder) for fn in files])
+        with tf.device('/cpu:0'):
+            tr_throughput = read_throughput(data_file, 'training', FLAGS.num_batches, FLAGS)
+            inf_throughput = read_throughput(data_file, 'inference', FLAGS.num_batches, FLAGS)
+        ls_res.append((patch_store, gen_time, num_files, size, tr_throughput, inf_throughput))
+
+    print("{:>8s} {:>12s} {:>8s} {:>10s} {:>22s} {:>23s}".format('store', 'generate(s)', 'files', 'size(MB)', 'training(patches/s)', 'inference(patches/s)'))
+    for patch_store, gen_time, num_files, size, tr_throughput, inf_throughput in ls_res:
+        print("{:>8s} {:>12.1f} {:>8d} {:>10.1f} {:>22.1f} {:>23.1f}".format(patch_store, gen_time, num_files, size/2**20, tr_throughput, inf_throughput))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--save_folder",
+        type=str,
+        default="/tmp/patch_store_benchmark",
+        help="The folder to store patches (and synthetic micrographs).")
+
+    parser.add_argument(
+        "--img_folder",
+        type=str,
+        default="",
+        help="The folder of micrographs. If empty, synthetic micrographs are generated.")
+
+    parser.add_argument(
+        "--img_lab_folder",
+        type=str,
+        default="",
+        help="The folder of labels of micrographs.")
+
+    parser.add_argument(
+        "--lab_suffix",
+        type=str,
+        default="_L",
+        help="The label file name is the image file name with this suffix before '.png'.")
+
+    parser.add_argument(
+        "--num_imgs",
+        type=int,
+        default=4,
+        help="The number of synthetic micrographs.")
+
+    parser.add_argument(
+        "--img_hei",
+        type=int,
+        default=1024,
+        help="The height of synthetic micrographs.")
+
+    parser.add_argument(
+        "--img_wid",
+        type=int,
+        default=1024,
+        help="The width of synthetic micrographs.")
+
+    parser.add_argument(
+        "--num_classes",
+        type=int,
+        default=4,
+        help="The number of classes of labels.")
+
+    parser.add_argument(
+        "--stride",
+        type=int,
+        default=32,
+        help="The stride used to get image patches.")
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=BATCH_SIZE,
+        help="The batch size in reading.")
+
+    parser.add_argument(
+        "--num_batches",
+        type=int,
+        default=100,
+        help="The number of batches to read for each measurement.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,105 @@
+# %%
+# Compare the training steps per second of the eager train_step and the graph-compiled CompiledTrainStep.
+from constants import *
+import os
+import numpy as np
+import tensorflow as tf
+import argparse
+import time
+import sys
+
+from seg_utils.utils import *
+
+
+def steps_per_sec(step_func, model, var_list, batches, optimizer, FLAGS, num_classes):
+    """ Training steps per second over the batches, after one step of warm up (tracing for the compiled step). """
+    train_loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    train_loss = tf.keras.metrics.Mean('train_loss', dtype=DTYPE_FLOAT)
+    train_regu = tf.keras.metrics.Mean('train_regularization', dtype=DTYPE_FLOAT)
+    train_obj_val = tf.keras.metrics.Mean('train_objective_value', dtype=DTYPE_FLOAT)
+    train_accuracy = tf.keras.metrics.SparseCategoricalAccuracy('train_accuracy', dtype=DTYPE_FLOAT)
+    ls_train_cla_tp = [tf.keras.metrics.Mean('train_cla_{}_tp'.format(lab), dtype=DTYPE_FLOAT) for lab in range(num_classes)]
+    for step, (batch_x, batch_y) in enumerate(batches):
+        if step == 1:
+            start_time = time.time()
+        step_func(model, batch_x, batch_y, optimizer, var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp)
+    train_loss.result().numpy() # Wait for the last step.
+    return (len(batches)-1)/(time.time()-start_time)
+
+
+def main(_):
+    np.random.seed(RND_SEED)
+    tf.random.set_seed(RND_SEED)
+    input_shapes = (FLAGS.img_size, FLAGS.img_size, 3)
+    batches = [(tf.convert_to_tensor(np.random.normal(size=(FLAGS.batch_size,)+input_shapes), dtype=DTYPE_FLOAT),
+                tf.convert_to_tensor(np.random.randint(0, FLAGS.num_classes, size=(FLAGS.batch_size,)+input_shapes[:2]), dtype=tf.int32))
+               for _ in range(FLAGS.num_steps+1)]
+
+    ls_res = []
+    for model_name in FLAGS.model_names.split(','):
+        FLAGS.model_name = model_name
+        (keep_prob, dropout_rate, train_layers, last_layer_name,
+         pretrained_wei_path, kwargs, backbone, alpha,
+         output_stride, weights_name) = config_deeplab(FLAGS.num_classes, input_shapes, FLAGS)
+        ls_throughput = []
+        for step_func in [train_step, CompiledTrainStep(FLAGS.num_classes)]:
+            # Same initial weights and a fresh optimizer for both training steps.
+            tf.random.set_seed(RND_SEED)
+            model = construct_model(FLAGS, keep_prob, FLAGS.num_classes, input_shapes, pretrained_wei_path, kwargs)
+            var_list = model.trainable_variables
+            optimizer = tf.optimizers.Adam(FLAGS.learning_rate)
+            ls_throughput.append(steps_per_sec(step_func, model, var_list, batches, optimizer, FLAGS, FLAGS.num_classes))
+        ls_res.append((model_name, ls_throughput[0], ls_throughput[1]))
+
+    print("{:>20s} {:>18s} {:>21s} {:>9s}".format('model', 'eager(steps/s)', 'compiled(steps/s)', 'speedup'))
+    for model_name, eager_throughput, compiled_throughput in ls_res:
+        print("{:>20s} {:>18.3f} {:>21.3f} {:>9.2f}".format(model_name, eager_throughput, compiled_throughput, compiled_throughput/eager_throughput))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--model_names",
+        type=str,
+        default="Unet,DeepLab3Plus",
+        help="The models to compare, separated by comma.")
+
+    parser.add_argument(
+        "--num_classes",
+        type=int,
+        default=4,
+        help="The number of classes.")
+
+    parser.add_argument(
+        "--img_size",
+        type=int,
+        default=IMG_SIZE,
+        help="The size of the image patches.")
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="The batch size.")
+
+    parser.add_argument(
+        "--num_steps",
+        type=int,
+        default=20,
+        help="The number of timed training steps for each model.")
+
+    parser.add_argument(
+        "--learning_rate",
+        type=float,
+        default=1e-4,
+        help="Initial learning rate.")
+
+    parser.add_argument(
+        "--weight_decay",
+        type=float,
+        default=1e-4,
+        help="The weight decay of the kernels.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
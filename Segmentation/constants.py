@@ -21,6 +21,10 @@ VAL_BATCH_RATIO = 1 # Don't change this one. Won't be faster if use larger than
 VAL_RATIO = 8 # Save some time for validation.
 N_THREADS = 30
 PIPLINE_JOBS = 30
+PATCH_SHARD_SIZE = 512 # The number of image patches in each shard of the patch store.
+SHARD_CYCLE_LEN = 4 # The number of patch shards read and mixed at the same time in training.
+TILE_OVERLAP = 64 # The number of pixels shared by neighboring tiles in whole-image inference.
+TILE_BATCH_SIZE = 16 # The number of tiles in one batch of whole-image inference.
 MID_FLOW_BLOCK_NUM = 8 # Default is 16
 MAX_SCALE_RATIO = 0.0
 COLRESET = '\033[0m'
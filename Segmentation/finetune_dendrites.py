@@ -217,13 +217,14 @@ def main(_):
                                                 te_img_folder, te_img_lab_folder,
                                                 save_dir, lab_fname_func,
                                                 targ_labs=np.array([1,2]) if FLAGS.dendrites_data=='XCT' else None,  
-                                                stride=FLAGS.img_stride, patch_size=IMG_SIZE, num_workers=PIPLINE_JOBS, test_img_flag=True)
+                                                stride=FLAGS.img_stride, patch_size=IMG_SIZE, num_workers=PIPLINE_JOBS, test_img_flag=True,
+                                                patch_store=FLAGS.patch_store)
         pickle.dump(lab_wei_map, open(os.path.join(save_dir, 'lab_wei_map.h5'), 'wb'))
     else:
         lab_wei_map = pickle.load(open(os.path.join(save_dir, 'lab_wei_map.h5'), 'rb'))
 
-    tr_file = os.path.join(save_dir, 'train.txt')
-    val_file = os.path.join(save_dir, 'valid.txt')
+    tr_file = os.path.join(save_dir, 'train.txt') if FLAGS.patch_store=='png' else patch_shard_index_path(save_dir, 'train')
+    val_file = os.path.join(save_dir, 'valid.txt') if FLAGS.patch_store=='png' else patch_shard_index_path(save_dir, 'valid')
 
     # Place data loading and preprocessing on the cpu
     # print("The trfm flag is {}.".format(FLAGS.trfm_flag))
@@ -246,7 +247,7 @@ def main(_):
                                 trfm_flag=FLAGS.trfm_flag)
 
     # %% Validate on testing datasets
-    te_file = os.path.join(save_dir, 'test.txt')
+    te_file = os.path.join(save_dir, 'test.txt') if FLAGS.patch_store=='png' else patch_shard_index_path(save_dir, 'test')
     with tf.device('/cpu:0'):
         te_data = LabTextureDataGenerator(te_file,
                                 mode='inference',
@@ -444,6 +445,18 @@ if __name__ == "__main__":
         default=100,
         help="The number of training images.")
 
+    parser.add_argument(
+        "--compiled_train_step",
+        type=int,
+        default=0,
+        help="Whether to use the graph-compiled training step, which keeps the training metrics on device.")
+
+    parser.add_argument(
+        "--train_log_step",
+        type=int,
+        default=100,
+        help="The number of steps between reading back and logging the training metrics with the compiled training step.")
+
     parser.add_argument(
         "--n_threads",
         type=int,
@@ -516,6 +529,12 @@ if __name__ == "__main__":
         default=10,
         help="The stride used to get image patches.")
 
+    parser.add_argument(
+        "--patch_store",
+        type=str,
+        default="png",
+        help="How image patches are stored. png: one png file per patch; shards: a few .npy shards with an index file.")
+
     parser.add_argument(
         "--dendrites_data",
         type=str,
@@ -241,7 +241,7 @@ def main(_):
             
         # Must past in the list of filenames to keep the order and label of textures.
         print(rd_base_dir, rd_idx, rd_ls_fnames)
-        if FLAGS.gen_data_flag:
+        if FLAGS.gen_data_flag and not FLAGS.in_memory_data:
             train_size, valid_size, test_size = FLAGS.train_size, FLAGS.valid_size, FLAGS.test_size
             with tf.device('/cpu:0'):
                 gen_save_train_valid_test_dataset(rd_base_dir, train_size, valid_size, test_size, ls_fnames=rd_ls_fnames, 
@@ -260,25 +260,39 @@ def main(_):
         te_file = os.path.join(rd_base_dir, 'test.txt')
 
         # Place data loading and preprocessing on the cpu
-        with tf.device('/cpu:0'):
-            tr_data = HomoTextureDataGenerator(tr_file,
-                                    mode='training',
-                                    batch_size=FLAGS.batch_size,
-                                    num_classes=rd_num_classes,
-                                    img_norm_flag=FLAGS.img_norm_flag,
-                                    trfm_flag=FLAGS.trfm_flag)
-            val_data = HomoTextureDataGenerator(val_file,
-                                    mode='inference',
-                                    batch_size=FLAGS.batch_size,
-                                    num_classes=rd_num_classes,
-                                    img_norm_flag=FLAGS.img_norm_flag,
-                                    trfm_flag=FLAGS.trfm_flag)
-            te_data = HomoTextureDataGenerator(te_file,
-                                    mode='inference',
-                                    batch_size=FLAGS.batch_size,
-                                    num_classes=rd_num_classes,
-                                    img_norm_flag=FLAGS.img_norm_flag,
-                                    trfm_flag=FLAGS.trfm_flag)
+        if FLAGS.in_memory_data:
+            # Generate collages on the fly instead of reading them from disk. Validation and testing collages
+            # are reproducible from their seeds.
+            rd_textures = generate_texture(rd_base_dir, ls_fnames=rd_ls_fnames, new_size=IMG_SIZE, trfm_flag=FLAGS.trfm_flag)
+            collage_kwargs = {'img_norm_flag': FLAGS.img_norm_flag, 'pwei_flag': FLAGS.pwei_flag, 'normp': FLAGS.normp, 
+                              'trfm_flag': FLAGS.trfm_flag, 'nb': FLAGS.nb, 'max_rots': FLAGS.max_rots}
+            with tf.device('/cpu:0'):
+                tr_data = CollageDataGenerator(rd_textures, mode='training', batch_size=FLAGS.batch_size, 
+                                               sample_size=FLAGS.train_size, seed=RND_SEED+3*rd_idx, **collage_kwargs)
+                val_data = CollageDataGenerator(rd_textures, mode='inference', batch_size=FLAGS.batch_size, 
+                                                sample_size=FLAGS.valid_size, seed=RND_SEED+3*rd_idx+1, **collage_kwargs)
+                te_data = CollageDataGenerator(rd_textures, mode='inference', batch_size=FLAGS.batch_size, 
+                                               sample_size=FLAGS.test_size, seed=RND_SEED+3*rd_idx+2, **collage_kwargs)
+        else:
+            with tf.device('/cpu:0'):
+                tr_data = HomoTextureDataGenerator(tr_file,
+                                        mode='training',
+                                        batch_size=FLAGS.batch_size,
+                                        num_classes=rd_num_classes,
+                                        img_norm_flag=FLAGS.img_norm_flag,
+                                        trfm_flag=FLAGS.trfm_flag)
+                val_data = HomoTextureDataGenerator(val_file,
+                                        mode='inference',
+                                        batch_size=FLAGS.batch_size,
+                                        num_classes=rd_num_classes,
+                                        img_norm_flag=FLAGS.img_norm_flag,
+                                        trfm_flag=FLAGS.trfm_flag)
+                te_data = HomoTextureDataGenerator(te_file,
+                                        mode='inference',
+                                        batch_size=FLAGS.batch_size,
+                                        num_classes=rd_num_classes,
+                                        img_norm_flag=FLAGS.img_norm_flag,
+                                        trfm_flag=FLAGS.trfm_flag)
 
         all_textures = generate_texture(rd_base_dir, ls_fnames=rd_ls_fnames, new_size=IMG_SIZE)
 
@@ -487,6 +501,18 @@ if __name__ == "__main__":
         default=100,
         help="The number of training images.")
 
+    parser.add_argument(
+        "--compiled_train_step",
+        type=int,
+        default=0,
+        help="Whether to use the graph-compiled training step, which keeps the training metrics on device.")
+
+    parser.add_argument(
+        "--train_log_step",
+        type=int,
+        default=100,
+        help="The number of steps between reading back and logging the training metrics with the compiled training step.")
+
     parser.add_argument(
         "--n_threads",
         type=int,
@@ -535,6 +561,12 @@ if __name__ == "__main__":
         default=3,
         help="The max number of rotation in generating the data set.")
 
+    parser.add_argument(
+        "--in_memory_data",
+        type=int,
+        default=0,
+        help="Whether to generate collages on the fly in memory instead of saving them as images and reading them back.")
+
     parser.add_argument(
         "--sample_wei_flag",
         type=int,
@@ -295,6 +295,96 @@ class HomoTextureDataGenerator(object):
         return x_img, y_img, y_bd_img, None 
 
 
+class CollageDataGenerator(object):
+    """Wrapper class around the Tensorflow dataset pipeline for collages generated on the fly.
+
+    It gives the same batches (image, label, boundary label) as HomoTextureDataGenerator, but the collages are built
+    in worker processes and fed into the pipeline directly without being written to and decoded from disk. With trfm_flag,
+    the training collages are also rotated and flipped as a whole, and the inference collages are not.
+    """
+
+    def __init__(self, textures, mode, batch_size, sample_size, seed=RND_SEED, img_norm_flag=False, pwei_flag=False, normp=2, 
+                 trfm_flag=False, nb=2, max_rots=3, num_workers=PIPLINE_JOBS):
+        """Create a new CollageDataGenerator.
+
+        Args:
+            textures: The textures from generate_texture with shape [num_classes, img_size, img_size, 3].
+            mode: Either 'training' or 'inference'. The training data repeats forever with new collages in every epoch,
+                while the inference data has sample_size collages which are the same every time the dataset is iterated.
+            batch_size: Number of images per batch.
+            sample_size: Number of collages (in an epoch for training data).
+            seed: The collage of index i only depends on (seed, i). Use different seeds for training, validation and testing.
+
+        Raises:
+            ValueError: If an invalid mode is passed.
+
+        """
+        self.textures = textures
+        self.num_classes = textures.shape[0]
+        self.img_size = textures.shape[1]
+        self.data_size = sample_size
+        self.seed = seed
+        self.img_norm_flag = img_norm_flag
+        self.trfm_flag = trfm_flag
+        stream_kwargs = {'pwei_flag': pwei_flag, 'normp': normp, 'trfm_flag': trfm_flag, 'nb': nb, 'max_rots': max_rots, 
+                         'num_workers': num_workers}
+        # The worker processes are created at the first iteration and reused in all later epochs.
+        ls_pool = []
+        def get_pool():
+            if num_workers > 1 and not ls_pool:
+                ls_pool.append(make_collage_pool(textures, num_workers))
+            return ls_pool[0] if ls_pool else None
+        # Each epoch of the training data continues from where the last one stops, so that no collage is repeated.
+        # The generators don't refer to self. OW, the dataset iterator alive at exit would hang the interpreter.
+        epoch_counter = itertools.count()
+        def gen_training():
+            return stream_collages(textures, seed, start_index=next(epoch_counter)*sample_size, sample_size=sample_size, 
+                                   pool=get_pool(), **stream_kwargs)
+        def gen_inference():
+            return stream_collages(textures, seed, sample_size=sample_size, pool=get_pool(), **stream_kwargs)
+
+        output_types = (tf.uint8, tf.uint8, tf.uint8)
+        output_shapes = ((self.img_size, self.img_size, 3), (self.img_size, self.img_size), (self.img_size, self.img_size))
+
+        if mode == 'training':
+            data = tf.data.Dataset.from_generator(gen_training, output_types, output_shapes)
+            # The order of collages is already random, so no shuffling is needed. Each repetition generates new collages.
+            # The index of a collage in the stream seeds its rotation and flip.
+            self.data = data.repeat().enumerate().map(self._parse_training_trfm, num_parallel_calls=PIPLINE_JOBS).batch(batch_size).prefetch(buffer_size=int(1.5*PIPLINE_JOBS))
+        elif mode == 'inference':
+            data = tf.data.Dataset.from_generator(gen_inference, output_types, output_shapes)
+            self.data = data.map(self._parse_training, num_parallel_calls=PIPLINE_JOBS).batch(batch_size).prefetch(buffer_size=int(1.5*PIPLINE_JOBS))
+        else:
+            raise ValueError("Invalid mode '%s'." % (mode))
+
+    def _parse_training(self, x_img, y_img, y_bd_img):
+        x_img = tf.subtract(tf.cast(x_img, DTYPE_FLOAT), IMAGENET_MEAN)
+        if self.img_norm_flag:
+            x_img = tf.image.per_image_standardization(x_img)
+        return x_img, tf.cast(y_img, DTYPE_INT), tf.cast(y_bd_img, DTYPE_INT)
+
+    def _parse_training_trfm(self, idx, imgs):
+        """ _parse_training followed by, if trfm_flag, the random rotation by a multiple of 90 degrees and flip of
+            HomoTextureDataGenerator applied to the whole image and its labels.
+
+            The transformation of the collage of index idx in the stream only depends on (seed, idx).
+        """
+        x_img, y_img, y_bd_img = self._parse_training(*imgs)
+        if self.trfm_flag:
+            # One draw in [0, 8): the number of rotations by 90 degrees and whether flip.
+            trfm_idx = tf.random.stateless_uniform(shape=[], seed=tf.stack([tf.constant(self.seed, dtype=tf.int64), idx]), 
+                                                   minval=0, maxval=8, dtype=tf.int32)
+            num_rot90, flip_flag = trfm_idx % 4, trfm_idx >= 4
+            def trfm(img):
+                img = tf.image.rot90(img, k=num_rot90)
+                return tf.cond(flip_flag, lambda: tf.image.flip_left_right(img), lambda: img)
+            x_img = trfm(x_img)
+            # Image must be 3-dimensional.
+            y_img = tf.squeeze(trfm(y_img[..., tf.newaxis]), axis=-1)
+            y_bd_img = tf.squeeze(trfm(y_bd_img[..., tf.newaxis]), axis=-1)
+        return x_img, y_img, y_bd_img
+
+
 class LabTextureDataGenerator(object):
     """ Wrapper class around the new Tensorflow dataset pipeline for pixel-wised labeled image dataset.
 
@@ -311,7 +401,8 @@ class LabTextureDataGenerator(object):
         e.g. a convolutional neural network.
 
         Args:
-            txt_file: Path to the text file.
+            txt_file: Path to the text file, or to the index file (ends with '_shards.json') of the patch shards
+                from generate_image_patch_shards.
             mode: Either 'training' or 'validation'. Depending on this value,
                 different parsing functions will be used.
             batch_size: Number of images per batch.
@@ -344,6 +435,10 @@ class LabTextureDataGenerator(object):
             print("The label weights are: {}.".format(self.lab_wei_arr))
             self.lab_wei_tensor = tf.convert_to_tensor(self.lab_wei_arr.reshape((1,1,-1,1)), dtype=DTYPE_FLOAT)
 
+        if self.txt_file.endswith('_shards.json'):
+            self._init_shards(mode, batch_size)
+            return
+
         # retrieve the data from the text file
         self._read_txt_file()
 
@@ -386,6 +481,38 @@ class LabTextureDataGenerator(object):
                 self.img_paths.append(items[0])
                 self.lab_paths.append(items[1])
 
+    def _init_shards(self, mode, batch_size):
+        """ Create the dataset from patch shards. Each shard is read in one go and several shards are interleaved. """
+        shard_index = load_patch_shard_index(self.txt_file)
+        self.data_size = shard_index['data_size']
+        self.img_paths = tf.convert_to_tensor([shard['x'] for shard in shard_index['shards']], dtype=tf.string)
+        self.lab_paths = tf.convert_to_tensor([shard['y'] for shard in shard_index['shards']], dtype=tf.string)
+        num_shards = len(shard_index['shards'])
+        data = tf.data.Dataset.from_tensor_slices((self.img_paths, self.lab_paths))
+
+        if mode == 'training':
+            # The patches are shuffled when written, so shuffling the order of shards and mixing a few of them is enough.
+            data = data.shuffle(num_shards, reshuffle_each_iteration=True).repeat()
+            cycle_length = min(SHARD_CYCLE_LEN, num_shards)
+            data = data.interleave(self._load_shard, cycle_length=cycle_length, num_parallel_calls=cycle_length)
+            # Shuffle the uint8 patches before parsing, so that the buffer takes a quarter of the memory of float patches.
+            data = data.shuffle(2000, reshuffle_each_iteration=True)
+            data = data.map(self._parse_training_arrays, num_parallel_calls=int(1.2*PIPLINE_JOBS))
+            self.data = data.batch(batch_size).prefetch(buffer_size=int(1.5*PIPLINE_JOBS))
+        elif mode == 'inference':
+            data = data.interleave(self._load_shard, cycle_length=1, num_parallel_calls=1)
+            data = data.map(self._parse_inference_arrays, num_parallel_calls=int(1.2*PIPLINE_JOBS))
+            self.data = data.batch(self.val_batch_ratio*batch_size).prefetch(buffer_size=int(1.5*self.val_batch_ratio*PIPLINE_JOBS))
+        else:
+            raise ValueError("Invalid mode '%s'." % (mode))
+
+    def _load_shard(self, x_path, y_path):
+        [x_shard, y_shard] = tf.numpy_function(func=lambda x_path, y_path: (np.load(x_path), np.load(y_path)), 
+                                               inp=[x_path, y_path], Tout=[tf.uint8, tf.uint8])
+        x_shard.set_shape((None, self.img_size, self.img_size, 3))
+        y_shard.set_shape((None, self.img_size, self.img_size))
+        return tf.data.Dataset.from_tensor_slices((x_shard, y_shard))
+
     def _rot_mirror(self, x_img, y_img):
         """ 
             This function is not used yet.
@@ -483,6 +610,13 @@ class LabTextureDataGenerator(object):
         x_img_decoded = tf.image.decode_png(x_img_string, channels=3)
         y_img_decoded = tf.image.decode_png(y_img_string, channels=1)
 
+        return self._prep_helper(x_img_decoded, y_img_decoded)
+
+    def _prep_helper(self, x_img_decoded, y_img_decoded):
+        """ 
+            x_img_decoded: [h, w, 3] in tf.uint8
+            y_img_decoded: [h, w, 1] in tf.uint8
+        """
         # It is important to let the data as tensor.
         x_img = tf.subtract(tf.cast(x_img_decoded, DTYPE_FLOAT), IMAGENET_MEAN)
         y_img = tf.cast(y_img_decoded, DTYPE_INT)
@@ -545,7 +679,17 @@ class LabTextureDataGenerator(object):
 
     def _parse_training(self, x_path, y_path):
         x_img, y_img = self._parse_helper(x_path, y_path)
+        return self._parse_training_helper(x_img, y_img)
+
+    def _parse_inference_arrays(self, x_arr, y_arr):
+        x_img, y_img = self._prep_helper(x_arr, tf.expand_dims(y_arr, axis=-1))
+        return x_img, tf.squeeze(y_img, axis=-1)
+
+    def _parse_training_arrays(self, x_arr, y_arr):
+        x_img, y_img = self._prep_helper(x_arr, tf.expand_dims(y_arr, axis=-1))
+        return self._parse_training_helper(x_img, y_img)
 
+    def _parse_training_helper(self, x_img, y_img):
         if self.trfm_flag:
             x_img, y_img = self._trfm(x_img, y_img)
 
@@ -8,6 +8,13 @@ import numpy as np
 # import cv2
 import os
 import pickle
+import json
+import itertools
+import collections
+import functools
+import multiprocessing
+import threading
+import atexit
 from PIL import Image
 from joblib import Parallel, parallel_backend, delayed
 from constants import *
@@ -104,10 +111,8 @@ def generate_one_collage_tf(textures,
     batch_y = sum(textures_module_idx[textures_idx[i]] * masks[:,:,:,i:i+1] for i in range(segmentation_regions)) 
     return batch_x.squeeze(axis=0), batch_y.squeeze(axis=(0,-1))
 
-def generate_one_collage(
+def build_one_collage(
         textures,
-        save_folder,
-        index,
         segmentation_regions=10,
         n_points=None,
         pwei_flag=False,
@@ -115,6 +120,13 @@ def generate_one_collage(
         normp=2,
         nb=2,
         nrot=0):
+    """ Build one collage in memory.
+
+    Return:
+        x_arr: The collage with shape (img_size, img_size, 3) in np.uint8.
+        y_arr: The label of each pixel with shape (img_size, img_size) in np.uint8.
+        y_bd_arr: The same as y_arr except that the boundary pixels have label N_textures.
+    """
     # When I call this function in the map, I cannot get the shape of textures.
     N_textures = textures.shape[0]
     # print("The number of texture is {}.".format(N_textures))
@@ -187,14 +199,6 @@ def generate_one_collage(
     
     if np.sum(y_arr>=N_textures):
         raise ValueError("There is an ERROR. The number of label is larger then expected({})!!!".format(N_textures))
-        print(N_textures, masks.shape, textures_idx.shape, textures_module_idx.shape, 
-              batch_x.shape, batch_y.shape, x_arr.shape, y_arr.shape, index, save_folder, n_points, anchor_points)
-        dump_folder = os.path.expanduser(os.path.join(save_folder,'../'))
-        pickle.dump(masks, open(os.path.join(dump_folder, 'masks.h5'), 'wb'))
-        pickle.dump(textures_idx, open(os.path.join(dump_folder, 'textures_idx.h5'), 'wb'))
-        pickle.dump(textures_module_idx, open(os.path.join(dump_folder, 'textures_module_idx.h5'), 'wb'))
-        pickle.dump(batch_x, open(os.path.join(dump_folder, 'batch_x.h5'), 'wb'))
-        pickle.dump(batch_y, open(os.path.join(dump_folder, 'batch_y.h5'), 'wb'))
 
     # None 90-degree rotation
     for _ in range(nrot):
@@ -230,6 +234,21 @@ def generate_one_collage(
         y_bd_arr = np.sum(mark_boundary_batch(y_bd_arr_comp, val=N_textures+1, nb=nb), axis=0) - 1
         x_arr, y_arr, y_bd_arr = x_arr.astype(dtype=np.uint8), y_arr.astype(dtype=np.uint8), y_bd_arr.astype(dtype=np.uint8)
 
+    return x_arr, y_arr, y_bd_arr
+
+def generate_one_collage(
+        textures,
+        save_folder,
+        index,
+        segmentation_regions=10,
+        n_points=None,
+        pwei_flag=False,
+        trfm_flag=False,
+        normp=2,
+        nb=2,
+        nrot=0):
+    x_arr, y_arr, y_bd_arr = build_one_collage(textures, segmentation_regions=segmentation_regions, n_points=n_points, 
+                                               pwei_flag=pwei_flag, trfm_flag=trfm_flag, normp=normp, nb=nb, nrot=nrot)
     x_img = Image.fromarray(x_arr, mode='RGB')
     y_img = Image.fromarray(y_arr, mode='L')
     y_bd_img = Image.fromarray(y_bd_arr, mode='L')
@@ -333,6 +352,79 @@ def gen_save_train_valid_test_dataset(img_folder, train_size, valid_size, test_s
     gen_save_dataset(img_folder, valid_size, 'valid', ls_fnames=ls_fnames, new_size=new_size, pwei_flag=pwei_flag, normp=normp, trfm_flag=trfm_flag, num_gen_batch=num_gen_batch, nb=nb, max_rots=max_rots)
     gen_save_dataset(img_folder, test_size, 'test', ls_fnames=ls_fnames, new_size=new_size, pwei_flag=pwei_flag, normp=normp, trfm_flag=trfm_flag, num_gen_batch=num_gen_batch, nb=nb, max_rots=max_rots)
     
+# %%
+# Generate collages on the fly without writing them to disk.
+# The textures are sent to each worker process once (in the initializer) instead of with every task.
+_worker_textures = None
+# Set at exit, so that a stream still being consumed by tf.data threads stops instead of waiting for terminated workers.
+_exiting = threading.Event()
+atexit.register(_exiting.set)
+
+def _init_collage_worker(textures):
+    global _worker_textures
+    _worker_textures = textures
+
+def collage_seed(seed, index):
+    """ The seed of the index-th collage, so that each collage only depends on (seed, index) but not on the worker generating it. """
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+def build_indexed_collage(index, seed, pwei_flag=False, normp=2, trfm_flag=False, nb=2, max_rots=3, textures=None):
+    """ Build the index-th collage of the stream with the same random settings as gen_save_dataset. """
+    textures = _worker_textures if textures is None else textures
+    np.random.seed(collage_seed(seed, index))
+    num_classes = textures.shape[0]
+    n_points = np.random.randint(2, num_classes+1, size=(1,))
+    n_rot = np.random.randint(0, max_rots+1)
+    return build_one_collage(textures, num_classes, n_points, pwei_flag, trfm_flag, normp, nb, n_rot)
+
+def make_collage_pool(textures, num_workers=PIPLINE_JOBS):
+    """ The worker processes for stream_collages, which can be reused by many streams of the same textures. """
+    # Use spawn instead of fork, because forking a process that already runs tensorflow threads may deadlock.
+    return multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_collage_worker, initargs=(textures,))
+
+def _wait_collage(async_res):
+    """ Wait for the result of a worker. Return None if the interpreter is exiting. """
+    while not async_res.ready():
+        if _exiting.is_set():
+            return None
+        async_res.wait(1)
+    return async_res.get()
+
+def stream_collages(textures, seed, start_index=0, sample_size=None, pwei_flag=False, normp=2, trfm_flag=False, nb=2, max_rots=3, num_workers=PIPLINE_JOBS, max_pending=None, pool=None):
+    """ Yield (x_arr, y_arr, y_bd_arr) of collages built in parallel worker processes.
+
+    The collages are yielded in the order of their indices starting from start_index. It is infinite if sample_size is None.
+    At most max_pending (default 4*num_workers) collages are built ahead of the consumer, so that the memory is bounded.
+    The workers are from pool (made by make_collage_pool with the same textures) if given, OW they are created for this stream.
+    """
+    indices = itertools.count(start_index) if sample_size is None else range(start_index, start_index+sample_size)
+    build_func = functools.partial(build_indexed_collage, seed=seed, pwei_flag=pwei_flag, normp=normp, trfm_flag=trfm_flag, nb=nb, max_rots=max_rots)
+    if pool is None and num_workers <= 1:
+        for index in indices:
+            yield build_func(index, textures=textures)
+        return
+    own_pool = pool is None
+    if own_pool:
+        pool = make_collage_pool(textures, num_workers)
+    max_pending = 4*num_workers if max_pending is None else max_pending
+    pending = collections.deque()
+    try:
+        for index in indices:
+            pending.append(pool.apply_async(build_func, (index,)))
+            if len(pending) >= max_pending:
+                collage = _wait_collage(pending.popleft())
+                if collage is None:
+                    return
+                yield collage
+        while pending:
+            collage = _wait_collage(pending.popleft())
+            if collage is None:
+                return
+            yield collage
+    finally:
+        if own_pool:
+            pool.terminate()
+
 # %%
 # Generate image patches from a big image
 def generate_image_patches(img_folder, img_lab_folder, save_folder, fd_name, lab_fname_func, targ_labs=None, stride=10, patch_size=IMG_SIZE, num_workers=PIPLINE_JOBS):
@@ -426,19 +518,108 @@ def generate_image_patches(img_folder, img_lab_folder, save_folder, fd_name, lab
     return lab_wei_map
         
 
+def patch_shard_index_path(save_folder, fd_name):
+    return os.path.join(save_folder, fd_name+'_shards.json')
+
+def generate_image_patch_shards(img_folder, img_lab_folder, save_folder, fd_name, lab_fname_func, targ_labs=None, stride=10, patch_size=IMG_SIZE, shard_size=PATCH_SHARD_SIZE):
+    """ The same patches as generate_image_patches, but stored in a few .npy shards instead of one png file per patch.
+
+    The patches are shuffled before being written, and each shard has shard_size image patches (except the last one)
+    in one file with shape [n, patch_size, patch_size, 3] and their labels in another file with shape [n, patch_size, patch_size].
+    The index file (fd_name+'_shards.json' in save_folder) lists the shards and keeps the label frequency.
+
+    Return:
+        lab_wei_map: The same as the return of generate_image_patches.
+    """
+    lab_cnt_map = {}
+    ls_ext_img_arr, ls_ext_img_lab_arr = [], []
+    ls_coords = [] # (index of image, row, column) of the upper left corner of each patch.
+
+    for fidx, fn in enumerate(list(os.listdir(img_folder))):
+        print("Processing file {} of file name {}.".format(fidx, fn))
+        if not fn.endswith('.png'):
+            continue
+        img_arr = np.array(Image.open(os.path.join(img_folder, fn)))
+        img_lab_arr = np.array(Image.open(os.path.join(img_lab_folder, lab_fname_func(fn))))
+        if len(img_arr.shape)==2:
+            # The png patches of a gray image are read as 3 identical channels.
+            img_arr = np.repeat(img_arr[..., np.newaxis], 3, axis=-1)
+        img_arr = img_arr[..., :3]
+        # Pad around the boundary using mirror condition only for training data as in generate_image_patches.
+        pad_width = patch_size if fd_name == 'train' else 0
+        ext_img_arr = np.pad(img_arr, pad_width=((pad_width,pad_width),(pad_width,pad_width),(0,0)), mode='reflect').astype(np.uint8)
+        ext_img_lab_arr = np.pad(img_lab_arr, pad_width=pad_width, mode='reflect').astype(np.uint8)
+
+        uni_labs, uni_cnts = np.unique(ext_img_lab_arr, return_counts=True)
+        for lab, cnt in zip(uni_labs, uni_cnts):
+            lab_cnt_map[int(lab)] = lab_cnt_map.get(int(lab), 0) + int(cnt)
+
+        lc_ci, lc_ri = np.meshgrid(np.arange(0, ext_img_arr.shape[1]-patch_size+1, stride), np.arange(0, ext_img_arr.shape[0]-patch_size+1, stride))
+        for ri, ci in zip(lc_ri.ravel(order='C'), lc_ci.ravel(order='C')):
+            if targ_labs is None or np.isin(ext_img_lab_arr[ri:ri+patch_size, ci:ci+patch_size], targ_labs).any():
+                # Only store those images has matrix and inclusion, excluding edge background.
+                ls_coords.append((len(ls_ext_img_arr), ri, ci))
+        ls_ext_img_arr.append(ext_img_arr)
+        ls_ext_img_lab_arr.append(ext_img_lab_arr)
+
+    # Shuffle the order of all image patches
+    coords = np.array(ls_coords, dtype=np.int64).reshape((-1, 3))
+    np.random.shuffle(coords)
+
+    shard_folder = os.path.join(save_folder, fd_name)
+    if not os.path.exists(shard_folder):
+        os.makedirs(shard_folder)
+    ls_shards = []
+    for sidx, start in enumerate(range(0, coords.shape[0], shard_size)):
+        shard_coords = coords[start:start+shard_size]
+        x_shard = np.empty((shard_coords.shape[0], patch_size, patch_size, 3), dtype=np.uint8)
+        y_shard = np.empty((shard_coords.shape[0], patch_size, patch_size), dtype=np.uint8)
+        for idx, (fidx, ri, ci) in enumerate(shard_coords):
+            x_shard[idx] = ls_ext_img_arr[fidx][ri:ri+patch_size, ci:ci+patch_size]
+            y_shard[idx] = ls_ext_img_lab_arr[fidx][ri:ri+patch_size, ci:ci+patch_size]
+        x_path = os.path.join(shard_folder, 'shard_{:05d}_x.npy'.format(sidx))
+        y_path = os.path.join(shard_folder, 'shard_{:05d}_y.npy'.format(sidx))
+        np.save(x_path, x_shard)
+        np.save(y_path, y_shard)
+        ls_shards.append({'x': x_path, 'y': y_path, 'size': int(shard_coords.shape[0])})
+
+    tot_cnt = np.sum(list(lab_cnt_map.values()))
+    lab_wei_map = {lab: tot_cnt/cnt/len(lab_cnt_map) for lab, cnt in lab_cnt_map.items()}
+    with open(patch_shard_index_path(save_folder, fd_name), 'w') as f:
+        json.dump({'patch_size': patch_size, 'data_size': int(coords.shape[0]), 'shards': ls_shards, 'lab_cnt_map': lab_cnt_map}, f, indent=1)
+
+    print("The total number of pixels: {}".format(tot_cnt))
+    print("The label frequency are: {}".format(lab_cnt_map))
+    print("The label weight are: {}".format(lab_wei_map))
+    print("{} patches are stored in {} shards in {}.".format(coords.shape[0], len(ls_shards), shard_folder))
+    return lab_wei_map
+
+def load_patch_shard_index(index_path):
+    """ Read the index file written by generate_image_patch_shards. The keys of label frequency are converted back to int. """
+    with open(index_path, 'r') as f:
+        shard_index = json.load(f)
+    shard_index['lab_cnt_map'] = {int(lab): cnt for lab, cnt in shard_index['lab_cnt_map'].items()}
+    return shard_index
+
 def gen_save_train_valid_test_patch_dataset(
     tr_img_folder, tr_img_lab_folder,
     val_img_folder, val_img_lab_folder,
     te_img_folder, te_img_lab_folder,
     save_folder, lab_fname_func, targ_labs=None, stride=10, 
-    patch_size=IMG_SIZE, num_workers=PIPLINE_JOBS, test_img_flag=True):
-    lab_wei_map_train = generate_image_patches(tr_img_folder, tr_img_lab_folder, save_folder, 'train', lab_fname_func, 
-        targ_labs=targ_labs, stride=stride, patch_size=patch_size, num_workers=num_workers)
-    lab_wei_map_valid = generate_image_patches(val_img_folder, val_img_lab_folder, save_folder, 'valid', lab_fname_func, 
-        targ_labs=targ_labs, stride=stride, patch_size=patch_size, num_workers=num_workers) 
+    patch_size=IMG_SIZE, num_workers=PIPLINE_JOBS, test_img_flag=True, patch_store='png'):
+    """ patch_store: 'png' for one png file per patch listed in fd_name+'.txt', or 'shards' for generate_image_patch_shards. """
+    if patch_store == 'shards':
+        gen_func = lambda img_folder, img_lab_folder, fd_name: generate_image_patch_shards(img_folder, img_lab_folder, save_folder, fd_name, 
+            lab_fname_func, targ_labs=targ_labs, stride=stride, patch_size=patch_size)
+    elif patch_store == 'png':
+        gen_func = lambda img_folder, img_lab_folder, fd_name: generate_image_patches(img_folder, img_lab_folder, save_folder, fd_name, 
+            lab_fname_func, targ_labs=targ_labs, stride=stride, patch_size=patch_size, num_workers=num_workers)
+    else:
+        raise ValueError("Invalid patch store '%s'." % (patch_store))
+    lab_wei_map_train = gen_func(tr_img_folder, tr_img_lab_folder, 'train')
+    lab_wei_map_valid = gen_func(val_img_folder, val_img_lab_folder, 'valid')
     if test_img_flag:
-        lab_wei_map_test = generate_image_patches(te_img_folder, te_img_lab_folder, save_folder, 'test', lab_fname_func, 
-            targ_labs=targ_labs, stride=stride, patch_size=patch_size, num_workers=num_workers) # We don't want to padding validation data sets
+        lab_wei_map_test = gen_func(te_img_folder, te_img_lab_folder, 'test') # We don't want to padding validation data sets
     else:
         lab_wei_map_test = None
     return lab_wei_map_train, lab_wei_map_valid, lab_wei_map_test
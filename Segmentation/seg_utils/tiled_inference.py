@@ -0,0 +1,101 @@
+import numpy as np
+import tensorflow as tf
+
+from constants import *
+from seg_utils.datagenerator import IMAGENET_MEAN
+
+
+def tile_starts(length, tile_size, stride):
+    """ The start positions of tiles along one axis. The last tile is aligned with the end, so every pixel is covered. """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length-tile_size, stride))
+    return starts+[length-tile_size]
+
+
+def blend_window(tile_size, overlap):
+    """ The weights of a tile in blending: 1 in the middle and a sin^2 ramp over the overlap at each side.
+
+        The ramps of two neighboring tiles sum to 1 when their overlap is exactly `overlap`, and the weights are
+        positive everywhere, so that pixels covered by only one tile (e.g., at the image border) are still defined.
+    """
+    ramp = np.sin(np.pi/2*(np.arange(overlap)+0.5)/max(overlap, 1))**2
+    win_1d = np.ones(tile_size, dtype=np.float32)
+    win_1d[:overlap] = ramp
+    win_1d[tile_size-overlap:] = ramp[::-1]
+    return np.outer(win_1d, win_1d).astype(np.float32)
+
+
+def pad_to_tile(img, tile_size):
+    """ Reflect-pad images smaller than a tile at the bottom and the right. """
+    pad_hei, pad_wid = max(tile_size-img.shape[0], 0), max(tile_size-img.shape[1], 0)
+    if pad_hei == 0 and pad_wid == 0:
+        return img
+    return np.pad(img, ((0, pad_hei), (0, pad_wid), (0, 0)), mode='reflect' if min(img.shape[:2]) > 1 else 'edge')
+
+
+def prep_tiles(tiles, img_norm_flag=False):
+    """ The same preprocessing as the inference mode of LabTextureDataGenerator. """
+    x_tiles = tf.subtract(tf.cast(tiles, DTYPE_FLOAT), IMAGENET_MEAN)
+    if img_norm_flag:
+        x_tiles = tf.image.per_image_standardization(x_tiles)
+    return x_tiles
+
+
+def tiled_predict(model, img, num_classes, out=None, tile_size=IMG_SIZE, overlap=TILE_OVERLAP, batch_size=TILE_BATCH_SIZE, img_norm_flag=False, stats=None):
+    """ Segment a whole micrograph of any size with a model trained on tile_size patches.
+
+        The image is cut into overlapping tiles, the tiles are predicted in batches and the outputs of the model are
+        blended with blend_window before the argmax. Tiles are processed one row of tiles at a time, and only the
+        blended outputs of the current row (tile_size x width x num_classes) are kept, so the memory does not grow
+        with the height of the image. Both img and out can be np.memmap for images that do not fit in memory.
+
+        Args:
+            img: [h, w, 3] uint8 array (or [h, w], which is repeated into 3 channels tile by tile).
+            out: [h, w] integer array to write the labels into. If None, a new uint8 array is allocated.
+            overlap: The number of pixels shared by neighboring tiles, at most tile_size/2.
+            stats: If a dict is given, the number of tiles and the number of batches are added to it.
+
+        Returns:
+            out
+    """
+    if overlap < 0 or 2*overlap > tile_size:
+        raise ValueError("The overlap ({}) should be in [0, tile_size/2={}].".format(overlap, tile_size//2))
+    hei, wid = img.shape[:2]
+    if out is None:
+        out = np.zeros((hei, wid), dtype=np.uint8)
+    pad_hei, pad_wid = max(hei, tile_size), max(wid, tile_size)
+    stride = tile_size-overlap
+    row_starts, col_starts = tile_starts(pad_hei, tile_size, stride), tile_starts(pad_wid, tile_size, stride)
+    window = blend_window(tile_size, overlap)[..., np.newaxis]
+
+    # The weighted sum of the outputs of the tiles covering the rows from r0 to r0+tile_size. It is not divided by
+    # the sum of the weights, because the weights are positive and the same for all classes of a pixel.
+    band = np.zeros((tile_size, pad_wid, num_classes), dtype=np.float32)
+    num_tiles, num_batches = 0, 0
+    for row_idx, r0 in enumerate(row_starts):
+        img_rows = img[r0:r0+tile_size]
+        if img_rows.ndim == 2:
+            img_rows = np.repeat(img_rows[..., np.newaxis], 3, axis=-1)
+        img_rows = pad_to_tile(np.asarray(img_rows[..., :3]), tile_size)
+        for b0 in range(0, len(col_starts), batch_size):
+            batch_cols = col_starts[b0:b0+batch_size]
+            tiles = np.stack([img_rows[:, c0:c0+tile_size] for c0 in batch_cols], axis=0)
+            pred = model(prep_tiles(tiles, img_norm_flag)).numpy()
+            for c0, tile_pred in zip(batch_cols, pred):
+                band[:, c0:c0+tile_size] += tile_pred*window
+            num_tiles += len(batch_cols)
+            num_batches += 1
+
+        # The rows above the next row of tiles will not be touched any more.
+        next_r0 = row_starts[row_idx+1] if row_idx+1 < len(row_starts) else r0+tile_size
+        num_done = next_r0-r0
+        done_rows = min(num_done, hei-r0)
+        if done_rows > 0:
+            out[r0:r0+done_rows] = np.argmax(band[:done_rows, :wid], axis=-1)
+        band[:tile_size-num_done] = band[num_done:]
+        band[tile_size-num_done:] = 0
+    if stats is not None:
+        stats['num_tiles'] = stats.get('num_tiles', 0)+num_tiles
+        stats['num_batches'] = stats.get('num_batches', 0)+num_batches
+    return out
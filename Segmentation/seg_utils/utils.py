@@ -71,6 +71,64 @@ def train_step(model, x, y, optimizer, var_list, weight_decay, train_loss_object
         num_cla = tf.reduce_sum(tf.cast(cla_all, tf.float32)).numpy()
         ls_train_cla_tp[lab].update_state(tf.reduce_sum(tf.cast(cla_corr, tf.float32)).numpy()/num_cla)
 
+class CompiledTrainStep(object):
+    """ The graph-compiled version of train_step, called with the same arguments.
+
+        The per-class true positive rates are accumulated on device in a confusion matrix instead of being
+        computed with np.unique every step, so the step never waits for the host. The rates are only read back
+        by update_cla_tp (at logging intervals), and they are pooled over the pixels of all steps since the last
+        reset_states, rather than averaged over the per-step rates as in train_step.
+    """
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.conf_mat = tf.Variable(tf.zeros((num_classes, num_classes), dtype=tf.float32), trainable=False, name='train_conf_mat')
+        # One compiled function for each combination of model, variable list, metrics and grad_masks, because the
+        # optimizer creates its slot variables in the first call, which is only allowed in the first tracing.
+        self.step_funcs = {}
+
+    def __call__(self, model, x, y, optimizer, var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, grad_masks=None, sample_wei=None):
+        key = tuple(id(obj) for obj in (model, optimizer, var_list, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, grad_masks))+(weight_decay,)
+        if key not in self.step_funcs:
+            self.step_funcs[key] = tf.function(self.make_step(model, optimizer, var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, grad_masks))
+        self.step_funcs[key](x, y, sample_wei)
+
+    def make_step(self, model, optimizer, var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, grad_masks):
+        kernel_list = [var for var in var_list if re.search(r'kernel', var.name)]
+        def step(x, y, sample_wei):
+            with tf.GradientTape() as gtape:
+                pred = model(x, training=True) # return logits
+                loss = tf.cast(train_loss_object(y, pred, sample_weight=sample_wei), dtype=DTYPE_FLOAT)
+                regu = weight_decay*tf.reduce_sum([tf.nn.l2_loss(var) for var in kernel_list])
+                obj_val = loss + regu
+
+            gradients = gtape.gradient(obj_val, var_list)
+            if grad_masks is not None:
+                gradients = [grad*mask for grad, mask in zip(gradients, grad_masks)]
+            optimizer.apply_gradients(zip(gradients, var_list))
+
+            train_loss.update_state(loss)
+            train_regu.update_state(regu)
+            train_obj_val.update_state(obj_val)
+            train_accuracy.update_state(y, pred)
+            self.conf_mat.assign_add(tf.math.confusion_matrix(tf.reshape(tf.cast(y, tf.int32), [-1]), tf.reshape(tf.argmax(pred, axis=-1, output_type=tf.int32), [-1]),
+                                                              num_classes=self.num_classes, dtype=tf.float32))
+        return step
+
+    def cla_tp(self):
+        """ The true positive rate of each class. The classes not seen since the last reset have rate 0. """
+        conf_mat = self.conf_mat.numpy()
+        num_cla = np.sum(conf_mat, axis=1)
+        return np.diag(conf_mat)/np.maximum(num_cla, 1)
+
+    def update_cla_tp(self, ls_train_cla_tp):
+        """ Read the confusion matrix back to the host and put the rates into the metrics printed by the training loop. """
+        for train_cla_tp, cla_tp in zip(ls_train_cla_tp, self.cla_tp()):
+            train_cla_tp.reset_states()
+            train_cla_tp.update_state(cla_tp)
+
+    def reset_states(self):
+        self.conf_mat.assign(tf.zeros_like(self.conf_mat))
+
 # @tf.function
 def valid_step(model, x, y, valid_loss_object, valid_loss, valid_accuracy, ls_valid_cla_tp):
     # Forward pass.
@@ -0,0 +1,147 @@
+# %%
+# Segment whole micrographs of any size with a trained model by tiled inference, and report the throughput and the peak memory.
+from constants import *
+import os
+import numpy as np
+import tensorflow as tf
+import argparse
+import time
+import sys
+import resource
+from PIL import Image
+
+from seg_utils.utils import *
+from seg_utils.tiled_inference import *
+
+
+def open_micrograph(img_path):
+    """ Load .npy files as memmap so that huge micrographs are read tile by tile, and other images with PIL. """
+    if img_path.endswith('.npy'):
+        return np.load(img_path, mmap_mode='r')
+    Image.MAX_IMAGE_PIXELS = None # Allow multi-gigapixel micrographs.
+    return np.array(Image.open(img_path))
+
+
+def peak_rss_mb():
+    """ The peak resident set size of this process in MB (ru_maxrss is in KB on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+
+def main(_):
+    np.random.seed(RND_SEED)
+    input_shapes = (IMG_SIZE, IMG_SIZE, 3)
+    (keep_prob, dropout_rate, train_layers, last_layer_name,
+     pretrained_wei_path, kwargs, backbone, alpha,
+     output_stride, weights_name) = config_deeplab(FLAGS.num_classes, input_shapes, FLAGS)
+    model = construct_model(FLAGS, keep_prob, FLAGS.num_classes, input_shapes, pretrained_wei_path, kwargs, load_model_path=FLAGS.model_path)
+
+    if FLAGS.img_path:
+        img = open_micrograph(FLAGS.img_path)
+    else:
+        # A random micrograph for measuring the throughput and memory only.
+        img = np.lib.format.open_memmap(os.path.join(FLAGS.save_folder, 'random_micrograph.npy'), mode='w+', dtype=np.uint8, shape=(FLAGS.img_hei, FLAGS.img_wid, 3))
+        for r0 in range(0, FLAGS.img_hei, IMG_SIZE):
+            img[r0:r0+IMG_SIZE] = np.random.randint(0, 256, size=img[r0:r0+IMG_SIZE].shape)
+    print("The micrograph has shape {}. The peak RSS before inference is {:.1f} MB.".format(img.shape, peak_rss_mb()))
+
+    fname = os.path.splitext(os.path.basename(FLAGS.img_path))[0] if FLAGS.img_path else 'random_micrograph'
+    if FLAGS.save_npy:
+        out = np.lib.format.open_memmap(os.path.join(FLAGS.save_folder, fname+'_seg.npy'), mode='w+', dtype=np.uint8, shape=img.shape[:2])
+    else:
+        out = None
+    stats = {}
+    start_time = time.time()
+    out = tiled_predict(model, img, FLAGS.num_classes, out=out, overlap=FLAGS.tile_overlap, batch_size=FLAGS.tile_batch_size,
+                        img_norm_flag=FLAGS.img_norm_flag, stats=stats)
+    run_time = time.time()-start_time
+    if FLAGS.save_npy:
+        out.flush()
+    else:
+        Image.fromarray(out).save(os.path.join(FLAGS.save_folder, fname+'_seg.png'))
+    print("{} tiles in {} batches take {:.1f}s: {:.2f} tiles/s, {:.3f} megapixels/s. The peak RSS is {:.1f} MB.".format(
+        stats['num_tiles'], stats['num_batches'], run_time, stats['num_tiles']/run_time, img.shape[0]*img.shape[1]/run_time/1e6, peak_rss_mb()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--img_path",
+        type=str,
+        default="",
+        help="The micrograph (.png/.tif or .npy of [h, w, 3] uint8). If empty, a random micrograph is generated.")
+
+    parser.add_argument(
+        "--img_hei",
+        type=int,
+        default=4096,
+        help="The height of the random micrograph.")
+
+    parser.add_argument(
+        "--img_wid",
+        type=int,
+        default=4096,
+        help="The width of the random micrograph.")
+
+    parser.add_argument(
+        "--save_folder",
+        type=str,
+        default="/tmp",
+        help="The folder to save the segmentation.")
+
+    parser.add_argument(
+        "--save_npy",
+        type=int,
+        default=0,
+        help="Whether to write the segmentation into a .npy memmap instead of a png, for micrographs that do not fit in memory.")
+
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default='Unet',
+        help="The model name to do the segmentation.")
+
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        default="",
+        help="The checkpoint of the trained model. If empty, the model is randomly initialized.")
+
+    parser.add_argument(
+        "--weights_name",
+        type=str,
+        default='',
+        help="The name of weights used in original DeepLab3Plus model.")
+
+    parser.add_argument(
+        "--backbone",
+        type=str,
+        default='mobilenetv2',
+        help="The name of backbone in the DeepLabV3Plus model.")
+
+    parser.add_argument(
+        "--num_classes",
+        type=int,
+        default=2,
+        help="The number of classes of the trained model.")
+
+    parser.add_argument(
+        "--img_norm_flag",
+        type=int,
+        default=1,
+        help="Whether to standardize image before loading to mean 0, std 1. Should be the same as in training.")
+
+    parser.add_argument(
+        "--tile_overlap",
+        type=int,
+        default=TILE_OVERLAP,
+        help="The number of pixels shared by neighboring tiles.")
+
+    parser.add_argument(
+        "--tile_batch_size",
+        type=int,
+        default=TILE_BATCH_SIZE,
+        help="The number of tiles in one batch.")
+
+    FLAGS, unparsed = parser.parse_known_args()
+    tf.compat.v1.app.run(main=main, argv=[sys.argv[0]] + unparsed)
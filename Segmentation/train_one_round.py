@@ -106,6 +106,11 @@ def train_one_round_bd(rd_idx, tr_data, val_data, te_data,
     grad_masks = [tf.convert_to_tensor(var, dtype=DTYPE_FLOAT) for var in grad_masks]
     # print("The gradient mask is {}.".format(grad_masks))
 
+    # The compiled training step only reads the metrics back to the host every train_log_step steps.
+    compiled_train_step = getattr(FLAGS, 'compiled_train_step', 0)
+    train_step_func = CompiledTrainStep(rd_num_classes) if compiled_train_step else train_step
+    train_log_step = FLAGS.train_log_step if compiled_train_step else 1
+
     # for var in var_list:
     #     print("The variable name is {}.".format(var.name))
 
@@ -154,9 +159,9 @@ def train_one_round_bd(rd_idx, tr_data, val_data, te_data,
                     else:
                         print("The last layer is {}.".format(model.model.model.get_layer(name=last_layer_name).trainable_variables))
                 if FLAGS.last_layer_mask:
-                    train_step(model, batch_x, batch_y, optimizer, fine_tuning_var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, grad_masks=grad_masks)
+                    train_step_func(model, batch_x, batch_y, optimizer, fine_tuning_var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, grad_masks=grad_masks)
                 else:
-                    train_step(model, batch_x, batch_y, optimizer, fine_tuning_var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp)
+                    train_step_func(model, batch_x, batch_y, optimizer, fine_tuning_var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp)
             else:
                 if step == 1:
                     # print(len(var_list), train_layers)
@@ -164,19 +169,20 @@ def train_one_round_bd(rd_idx, tr_data, val_data, te_data,
                         print("The last layer is {}.".format(model.model.get_layer(name=last_layer_name).trainable_variables))
                     else:
                         print("The last layer is {}.".format(model.model.model.get_layer(name=last_layer_name).trainable_variables))
-                train_step(model, batch_x, batch_y, optimizer, var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp)
+                train_step_func(model, batch_x, batch_y, optimizer, var_list, weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp)
             # # Log profile tracing
             # with profile_summary_writer.as_default():
             #     tf.summary.trace_export("training_profile", step=accu_step+step, profiler_outdir=profile_log_dir)
 
             # Log metrics for training
-            with train_summary_writer.as_default():
-                print("The training metrics at step {}: loss:{:.4f},regu:{:.4f},obj:{:.4f},acc:{:.4f}.".format(
-                    accu_step+step, train_loss.result(), train_regu.result(), train_obj_val.result(), train_accuracy.result()))
-                tf.summary.scalar('loss', train_loss.result(), step=accu_step+step)
-                tf.summary.scalar('regularization', train_regu.result(), step=accu_step+step)
-                tf.summary.scalar('objective value', train_obj_val.result(), step=accu_step+step)
-                tf.summary.scalar('accuracy', train_accuracy.result(), step=accu_step+step)
+            if (accu_step+step) % train_log_step == 0:
+                with train_summary_writer.as_default():
+                    print("The training metrics at step {}: loss:{:.4f},regu:{:.4f},obj:{:.4f},acc:{:.4f}.".format(
+                        accu_step+step, train_loss.result(), train_regu.result(), train_obj_val.result(), train_accuracy.result()))
+                    tf.summary.scalar('loss', train_loss.result(), step=accu_step+step)
+                    tf.summary.scalar('regularization', train_regu.result(), step=accu_step+step)
+                    tf.summary.scalar('objective value', train_obj_val.result(), step=accu_step+step)
+                    tf.summary.scalar('accuracy', train_accuracy.result(), step=accu_step+step)
 
             if step % FLAGS.display_step == 0:
                 pred = model(batch_x) # Here, we don't use dropout, so that here has some overfitting and is not exactly training metrics.
@@ -196,16 +202,21 @@ def train_one_round_bd(rd_idx, tr_data, val_data, te_data,
                 # print("{} training step: %i, loss: %f, accuracy: %f" % (datetime.now(), step, loss, acc*100))
                 print(output_prefix+" {} round {} training step: {}, loss: {:.4f}, accuracy: {:.4f}".format(datetime.now(), rd_idx, step, loss, acc*100))
                 # The class are not for this example, but accumulated results.
+                if compiled_train_step:
+                    train_step_func.update_cla_tp(ls_train_cla_tp)
                 for lab, train_cla_tp in enumerate(ls_train_cla_tp):
                     print("The class lab {} has tp {:.4f}".format(lab, train_cla_tp.result()))
 
-            # Reset metrics every step (batch)
-            train_loss.reset_states()
-            train_regu.reset_states()
-            train_obj_val.reset_states()
-            train_accuracy.reset_states()
-            for train_cla_tp in ls_train_cla_tp:
-                train_cla_tp.reset_states()
+            # Reset metrics every step (batch), or every train_log_step steps for the compiled training step
+            if (accu_step+step) % train_log_step == 0:
+                train_loss.reset_states()
+                train_regu.reset_states()
+                train_obj_val.reset_states()
+                train_accuracy.reset_states()
+                for train_cla_tp in ls_train_cla_tp:
+                    train_cla_tp.reset_states()
+                if compiled_train_step:
+                    train_step_func.reset_states()
 
             # Validation
             if accu_step+step == val_start_step:
@@ -470,6 +481,11 @@ def train_one_round(rd_idx, tr_data, val_data, te_data,
     grad_masks = [tf.convert_to_tensor(var, dtype=DTYPE_FLOAT) for var in grad_masks]
     # print("The gradient mask is {}.".format(grad_masks))
 
+    # The compiled training step only reads the metrics back to the host every train_log_step steps.
+    compiled_train_step = getattr(FLAGS, 'compiled_train_step', 0)
+    train_step_func = CompiledTrainStep(rd_num_classes) if compiled_train_step else train_step
+    train_log_step = FLAGS.train_log_step if compiled_train_step else 1
+
     # for var in var_list:
     #     print("The variable name is {}.".format(var.name))
 
@@ -531,9 +547,9 @@ def train_one_round(rd_idx, tr_data, val_data, te_data,
                     else:
                         print("The last layer is {}.".format(model.model.model.get_layer(name=last_layer_name).trainable_variables))
                 if FLAGS.last_layer_mask:
-                    train_step(model, batch_x, batch_y, optimizer, fine_tuning_var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, grad_masks=grad_masks, sample_wei=sample_wei)
+                    train_step_func(model, batch_x, batch_y, optimizer, fine_tuning_var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, grad_masks=grad_masks, sample_wei=sample_wei)
                 else:
-                    train_step(model, batch_x, batch_y, optimizer, fine_tuning_var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, sample_wei=sample_wei)
+                    train_step_func(model, batch_x, batch_y, optimizer, fine_tuning_var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, sample_wei=sample_wei)
             else:
                 if step == 1:
                     # print(len(var_list), train_layers)
@@ -542,19 +558,20 @@ def train_one_round(rd_idx, tr_data, val_data, te_data,
                     else:
                         print("The last layer is {}.".format(model.model.model.get_layer(name=last_layer_name).trainable_variables))
                     # print(sample_wei.shape, sample_wei[0], np.unique(sample_wei[0].numpy()))
-                train_step(model, batch_x, batch_y, optimizer, var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, sample_wei=sample_wei)
+                train_step_func(model, batch_x, batch_y, optimizer, var_list, FLAGS.weight_decay, train_loss_object, train_loss, train_regu, train_obj_val, train_accuracy, ls_train_cla_tp, sample_wei=sample_wei)
             # # Log profile tracing
             # with profile_summary_writer.as_default():
             #     tf.summary.trace_export("training_profile", step=accu_step+step, profiler_outdir=profile_log_dir)
 
             # Log metrics for training
-            with train_summary_writer.as_default():
-                print("The training metrics at step {}: loss:{:.4f},regu:{:.4f},obj:{:.4f},acc:{:.4f}.".format(accu_step+step,
-                    train_loss.result(), train_regu.result(), train_obj_val.result(), train_accuracy.result()))
-                tf.summary.scalar('loss', train_loss.result(), step=accu_step+step)
-                tf.summary.scalar('regularization', train_regu.result(), step=accu_step+step)
-                tf.summary.scalar('objective value', train_obj_val.result(), step=accu_step+step)
-                tf.summary.scalar('accuracy', train_accuracy.result(), step=accu_step+step)
+            if (accu_step+step) % train_log_step == 0:
+                with train_summary_writer.as_default():
+                    print("The training metrics at step {}: loss:{:.4f},regu:{:.4f},obj:{:.4f},acc:{:.4f}.".format(accu_step+step,
+                        train_loss.result(), train_regu.result(), train_obj_val.result(), train_accuracy.result()))
+                    tf.summary.scalar('loss', train_loss.result(), step=accu_step+step)
+                    tf.summary.scalar('regularization', train_regu.result(), step=accu_step+step)
+                    tf.summary.scalar('objective value', train_obj_val.result(), step=accu_step+step)
+                    tf.summary.scalar('accuracy', train_accuracy.result(), step=accu_step+step)
 
             if step % FLAGS.display_step == 0:
                 pred = model(batch_x) # Here, we don't use dropout, so that here has some overfitting and is not exactly training metrics.
@@ -574,16 +591,21 @@ def train_one_round(rd_idx, tr_data, val_data, te_data,
                 # print("{} training step: %i, loss: %f, accuracy: %f" % (datetime.now(), step, loss, acc*100))
                 print(output_prefix+" {} round {} training step: {}, loss: {:.4f}, accuracy: {:.4f}".format(datetime.now(), rd_idx, step, loss, acc*100))
                 # The class are not for this example, but accumulated results.
+                if compiled_train_step:
+                    train_step_func.update_cla_tp(ls_train_cla_tp)
                 for lab, train_cla_tp in enumerate(ls_train_cla_tp):
                     print("The class lab {} has tp {:.4f}".format(lab, train_cla_tp.result()))
 
-            # Reset metrics every step (batch)
-            train_loss.reset_states()
-            train_regu.reset_states()
-            train_obj_val.reset_states()
-            train_accuracy.reset_states()
-            for train_cla_tp in ls_train_cla_tp:
-                train_cla_tp.reset_states()
+            # Reset metrics every step (batch), or every train_log_step steps for the compiled training step
+            if (accu_step+step) % train_log_step == 0:
+                train_loss.reset_states()
+                train_regu.reset_states()
+                train_obj_val.reset_states()
+                train_accuracy.reset_states()
+                for train_cla_tp in ls_train_cla_tp:
+                    train_cla_tp.reset_states()
+                if compiled_train_step:
+                    train_step_func.reset_states()
 
             # Validation
             if accu_step + step == val_start_step: